@@ -1,46 +1,80 @@
 import io
+import os
 import sys
+import time
+import mmap
+import errno
 import os.path
 import numpy
+import itertools
+import collections
+import gevent.lock
 import gevent.queue
 import gevent.event
 
 from clusterdfs.common import ClassLogger
 
+try:
+    # The mmap module of Python 2 has no madvise.
+    import ctypes
+    import ctypes.util
+    madvise = ctypes.CDLL(ctypes.util.find_library('c')).madvise
+    madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+except (OSError, AttributeError):
+    madvise = None
+# Linux values.
+MADV_SEQUENTIAL = 2
+MADV_DONTNEED = 4
+
 @ClassLogger
 class IOBuffer(object):
     defsize = 4*io.DEFAULT_BUFFER_SIZE
-    pool = []
+    pool = None # Global IOBufferPool, set at the end of its definition.
     
     @staticmethod
-    def create(factory, *args, **kwargs):      
-        if len(IOBuffer.pool)>0:
-            obj = IOBuffer.pool.pop()
-            obj.reset(factory, *args, **kwargs)
-            return obj
-        
-        else:
-            return IOBuffer(factory, *args, **kwargs)
+    def create(factory, size=None, block=None):      
+        if block is not None:
+            # Buffers over memory of their own (a mapped file) are not pooled.
+            return IOBuffer(factory, size, block=block)
+        return IOBuffer.pool.acquire(factory, size)
             
     def free(self):
-        self.factory.event.set()
-
-    '''
-    def __del__(self):
-        IOBuffer.pool.append(self)
-        if self.factory: self.factory.event.set()
-    '''
+        if self.factory!=None and not self.released:
+            self.factory.release(self)
+        IOBuffer.pool.release(self)
          
-    def __init__(self, factory=None, size=None):
+    def __init__(self, factory=None, size=None, block=None, size_class=None,
+                 offset=None):
+        '''
+        Without a 'block' the buffer owns a private bytearray. Buffers handed
+        out by the IOBufferPool get a 'block' (a numpy view over the pool
+        slab), and the 'size_class' and slab 'offset' it is returned to.
+        '''
         if size==None:
             size = IOBuffer.defsize
-        self.buff = bytearray(size)
-        self.mem = memoryview(self.buff)
+        self.block = block if block is not None else bytearray(size)
+        self.size_class = size_class
+        self.offset = offset
+        # Bytes of a private buffer counted by the pool as out of the slab.
+        self.overflow = 0
+        self.released = False
+        self.size = None
         self.reset(factory=factory, size=size)
 
     def reset(self, factory=None, size=None):
         if size==None:
             size = IOBuffer.defsize
+        if size>len(self.block):
+            raise ValueError("Size %d does not fit in a %d bytes block."\
+                             %(size, len(self.block)))
+        if size!=self.size:
+            # Slab blocks are numpy arrays, so slicing them does not copy.
+            self.buff = self.block if size==len(self.block)\
+                        else self.block[:size]
+            self.mem = memoryview(self.buff)
+            # Views over the buffer, kept while it is pooled: None for the
+            # numpy array and each bitfield for its GaloisBuffer.
+            self.views = {}
         self.factory = factory
         self.size = size
         self.length = 0
@@ -61,42 +95,398 @@ class IOBuffer(object):
         return iobuffer
 
     def as_numpy_byte_array(self):
-        return numpy.ndarray((self.size,), dtype=numpy.uint8, buffer=self.buff)
+        array = self.views.get(None)
+        if array is None:
+            array = self.views[None] = numpy.ndarray((self.size,), 
+                                                     dtype=numpy.uint8, 
+                                                     buffer=self.buff)
+        return array
+
+    def as_galois_buffer(self, bitfield=8):
+        view = self.views.get(bitfield)
+        if view is None:
+            # The coding extension is only needed by coding streams.
+            from galoisbuffer import GaloisBuffer
+            view = self.views[bitfield] = GaloisBuffer(self.size, 
+                                                       bitfield=bitfield,
+                                                       buffer=self.buff)
+        return view
 
 @ClassLogger
-class IOBufferFactory(object):    
-    def __init__(self, max_active=5):
-        self.max_active = max_active
-        self.active = 0
-        self.event = gevent.event.Event()
+class IOBufferPool(object):
+    '''
+    Process-wide IOBuffer allocator. Buffers are carved from a single slab
+    preallocated on first use, in power-of-two size classes aligned to their
+    size, and free() puts them back in the free list of their class. Once
+    the slab is carved, a class with no free buffers splits a free block of
+    a larger class in halves, merging free halves (buddies) back first if 
+    none is left. Requests that still do not fit, or above the largest
+    class, get a private buffer that is not kept when freed. At most
+    'overflow' bytes of those are out at once, past that acquire() raises
+    MemoryError: 'capacity' plus 'overflow' bounds the memory of buffers.
+    '''
+    min_class = 4096
+
+    def __init__(self, capacity=64*1024*1024, max_class=4*1024*1024,
+                 overflow=16*1024*1024):
+        self.slab = None
+        self.configure(capacity, max_class, overflow)
+
+    def configure(self, capacity=None, max_class=None, overflow=None):
+        if self.slab is not None:
+            raise ValueError("Cannot reconfigure a pool that is in use.")
+        if capacity!=None:
+            self.capacity = capacity
+        if max_class!=None:
+            self.max_class = max_class
+        if overflow!=None:
+            self.overflow = overflow
+        self.offset = 0
+        # Free buffers of each class by offset in the slab.
+        self.free_lists = collections.defaultdict(dict)
+        self.overflows = 0
+        self.overflow_used = 0
+
+    def size_class(self, size):
+        sc = self.min_class
+        while sc<size:
+            sc <<= 1
+        return sc
+
+    def _block(self, offset, size_class, factory=None, size=None):
+        return IOBuffer(factory, size or size_class, 
+                        block=self.slab[offset:offset+size_class],
+                        size_class=size_class, offset=offset)
+
+    def _add_free(self, offset, size_class):
+        iobuffer = self._block(offset, size_class)
+        iobuffer.released = True
+        self.free_lists[size_class][offset] = iobuffer
+
+    def _carve(self, size_class):
+        start = -(-self.offset//size_class)*size_class
+        if size_class>self.max_class or start+size_class>self.capacity:
+            return None
+        if self.slab is None:
+            if __debug__: self.logger.debug("Allocating %d bytes slab.",
+                                            self.capacity)
+            # Anonymous maps are page aligned, and so are all the blocks
+            # (their offsets are multiples of min_class), as O_DIRECT needs.
+            self.slab = numpy.ndarray((self.capacity,), dtype=numpy.uint8,
+                                      buffer=mmap.mmap(-1, self.capacity,
+                                                       flags=mmap.MAP_PRIVATE))
+        # The gap left by the alignment is freed in the largest blocks.
+        while self.offset<start:
+            sc = self.min_class
+            while self.offset%(2*sc)==0 and self.offset+2*sc<=start:
+                sc <<= 1
+            self._add_free(self.offset, sc)
+            self.offset += sc
+        self.offset = start+size_class
+        return start
+
+    def _split(self, size_class):
+        sc = size_class
+        while sc<=self.max_class and not self.free_lists[sc]:
+            sc <<= 1
+        if sc>self.max_class:
+            return None
+        offset = self.free_lists[sc].popitem()[0]
+        while sc>size_class:
+            sc >>= 1
+            self._add_free(offset+sc, sc)
+        return offset
+
+    def _merge(self):
+        merged = False
+        sc = self.min_class
+        while 2*sc<=self.max_class:
+            free_list = self.free_lists[sc]
+            for offset in [offset for offset in free_list 
+                           if offset%(2*sc)==0 and offset+sc in free_list]:
+                del free_list[offset], free_list[offset+sc]
+                self._add_free(offset, 2*sc)
+                merged = True
+            sc <<= 1
+        return merged
+
+    def acquire(self, factory=None, size=None):
+        if size==None:
+            size = IOBuffer.defsize
+        size_class = self.size_class(size)
+        free_list = self.free_lists[size_class]
+        if free_list:
+            iobuffer = free_list.popitem()[1]
+            iobuffer.reset(factory, size)
+            iobuffer.released = False
+            return iobuffer
+
+        offset = self._carve(size_class)
+        if offset==None:
+            offset = self._split(size_class)
+        if offset==None and size_class<=self.max_class and self._merge():
+            offset = self._split(size_class)
+        if offset!=None:
+            return self._block(offset, size_class, factory, size)
+
+        if self.overflow_used+size>self.overflow:
+            raise MemoryError("Buffer pool exhausted: %d bytes out of the "
+                              "%d bytes slab."%(self.overflow_used, 
+                                                self.capacity))
+        if self.overflows==0:
+            self.logger.warning("Buffer pool exhausted (%d bytes), "
+                                "allocating out of the slab.", self.capacity)
+        self.overflows += 1
+        self.overflow_used += size
+        iobuffer = IOBuffer(factory, size)
+        iobuffer.overflow = size
+        return iobuffer
+
+    def release(self, iobuffer):
+        if iobuffer.released:
+            if __debug__: self.logger.debug("Ignoring double free of %s.", 
+                                            hex(id(iobuffer)))
+            return
+        iobuffer.released = True
+        iobuffer.factory = None
+        if iobuffer.size_class!=None:
+            free_list = self.free_lists[iobuffer.size_class]
+            free_list[iobuffer.offset] = iobuffer
+        else:
+            self.overflow_used -= iobuffer.overflow
+
+IOBuffer.pool = IOBufferPool()
+
+class AdaptiveBufferSize(object):
+    '''
+    Chooses the IOBuffer size of a reader: it starts at 'size' and doubles it
+    after every 'window' buffers while the observed throughput improves at
+    least by a 'threshold' factor. Once it stops improving the size is
+    frozen to the best one seen.
+    '''
+    def __init__(self, size, max_size, window=8, threshold=1.05):
+        self.size = size
+        self.max_size = max_size
+        self.window = window
+        self.threshold = threshold
+        self.frozen = size>=max_size
+        self.best_size = size
+        self.best_rate = 0.0
+        self.count = 0
+        self.nbytes = 0
+        self.start = None
+
+    def update(self, nbytes):
+        if self.frozen:
+            return self.size
+
+        now = time.time()
+        if self.start==None:
+            self.start = now
+            return self.size
+
+        self.count += 1
+        self.nbytes += nbytes
+        if self.count<self.window or now<=self.start:
+            return self.size
+
+        rate = self.nbytes/(now-self.start)
+        if rate>=self.best_rate*self.threshold:
+            self.best_rate = rate
+            self.best_size = self.size
+            self.size = min(2*self.size, self.max_size)
+            self.frozen = self.size==self.best_size
+        else:
+            self.size = self.best_size
+            self.frozen = True
+
+        self.count = 0
+        self.nbytes = 0
+        self.start = now
+        return self.size
+
+class ReadAhead(object):
+    '''
+    Bytes an async reader keeps read ahead of its consumer: 'factor' times
+    the bytes the consumer takes while one read of the stream completes,
+    bounded by 'min_depth' and 'max_depth'. A slow stream is kept busy and
+    a fast one does not buffer more than the consumer needs. The read time
+    and the consumer rate are averaged with weight 'alpha'.
+    '''
+    def __init__(self, min_depth, max_depth, factor=2.0, alpha=0.25):
+        self.min_depth = min_depth
+        self.max_depth = max(min_depth, max_depth)
+        self.factor = factor
+        self.alpha = alpha
+        self.depth = min_depth
+        self.read_time = 0.0
+        self.rate = 0.0
+        self.taken = 0
+        self.busy_since = None
+
+    def _average(self, value, sample):
+        return sample if value==0.0 else value+self.alpha*(sample-value)
+
+    def _update(self):
+        depth = int(self.factor*self.rate*self.read_time)
+        self.depth = min(max(depth, self.min_depth), self.max_depth)
+
+    def read(self, elapsed):
+        '''A read of the stream took 'elapsed' seconds.'''
+        self.read_time = self._average(self.read_time, elapsed)
+        self._update()
 
-    def create(self, *args, **kwargs):
-        #gc.collect()
-        #return IOBuffer(self, *args, **kwargs)
+    def waiting(self):
+        '''The consumer asks for the next buffer.'''
+        if self.busy_since==None:
+            return
+        elapsed = time.time()-self.busy_since
+        self.busy_since = None
+        if elapsed>0:
+            # Time spent waiting for the buffers is not counted, otherwise
+            # a stalled consumer would look slower and get less read-ahead.
+            self.rate = self._average(self.rate, self.taken/elapsed)
+            self._update()
+
+    def consumed(self, nbytes):
+        '''The consumer got a buffer of 'nbytes'.'''
+        self.taken = nbytes
+        self.busy_since = time.time()
+
+@ClassLogger
+class ByteBudget(object):
+    '''
+    Bytes that can be held at once (unlimited if 'limit' is None). Requests
+    wait while they are exhausted and get their bytes in order as they are
+    released. A request larger than the whole budget is granted when 
+    nothing else is held, so it can not wait forever.
+    '''
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.waiters = collections.deque()
+
+    def fits(self, nbytes):
+        return self.limit==None or self.used==0 or\
+               self.used+nbytes<=self.limit
+
+    def request(self, nbytes, block=True):
         '''
-        if self.active>10*self.max_active:
-            gc.collect()
-        assert self.active<=10*self.max_active
+        Takes the bytes if they fit (or unconditionally if not 'block') and 
+        returns None. Otherwise returns the waiter to pass to wait().
         '''
-        if self.active==self.max_active:
-            self.event.wait()
-            self.active -= 1
-            self.event.clear()
-            '''
-            if self.event.wait(1):
-                self.active -= 1
-                self.event.clear()
-            '''
+        if not block or (not self.waiters and self.fits(nbytes)):
+            self.used += nbytes
+            return None
+        waiter = (nbytes, gevent.event.Event())
+        self.waiters.append(waiter)
+        return waiter
+
+    def wait(self, waiter):
+        if waiter==None:
+            return
+        try:
+            waiter[1].wait()
+        except:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+            else:
+                self.release(waiter[0])
+            raise
+
+    def acquire(self, nbytes, block=True):
+        self.wait(self.request(nbytes, block))
+
+    def grant(self, waiter):
+        '''
+        Gives its bytes to a waiter before its turn.
+        '''
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+            self.used += waiter[0]
+            waiter[1].set()
+
+    def release(self, nbytes):
+        self.used -= nbytes
+        while self.waiters and self.fits(self.waiters[0][0]):
+            nbytes, event = self.waiters.popleft()
+            self.used += nbytes
+            event.set()
+
+class IOBufferFactory(object):
+    '''
+    Credits of the buffers of a stream: at most 'max_active' buffers are out
+    at once, and create() blocks until free() returns them. The bytes of 
+    the buffers also count against the stream budget of 'max_bytes' 
+    (IOBufferFactory.stream_bytes if None) and the node 'budget', shared by
+    all the streams. Only the buffers beyond the first 'reserved' ones out
+    wait for the budgets: the consumer of a stream (a coding batch) always
+    gets those, so the streams can not starve each other, and the budgets
+    throttle the buffers read ahead.
+    '''
+    stream_bytes = None
+    budget = ByteBudget()
+
+    def __init__(self, max_active=5, max_bytes=None, reserved=1):
+        self.credits = gevent.lock.Semaphore(max_active)
+        self.bytes = ByteBudget(max_bytes if max_bytes!=None\
+                                else IOBufferFactory.stream_bytes)
+        self.reserved = reserved
+        self.active = 0
+        self.waiting = None
+
+    def take(self, budget, nbytes):
+        waiter = budget.request(nbytes, self.active>=self.reserved)
+        self.waiting = (budget, waiter) if waiter!=None else None
+        try:
+            budget.wait(waiter)
+        finally:
+            self.waiting = None
+
+    def create(self, size=None, **kwargs):
+        if size==None:
+            size = IOBuffer.defsize
+        self.credits.acquire()
+        taken = []
+        try:
+            for budget in (self.bytes, IOBufferFactory.budget):
+                self.take(budget, size)
+                taken.append(budget)
+        except:
+            for budget in taken:
+                budget.release(size)
+            self.credits.release()
+            raise
         self.active += 1
-        return IOBuffer.create(self, *args, **kwargs)
+        return IOBuffer.create(self, size=size, **kwargs)
+
+    def release(self, iobuffer):
+        self.active -= 1
+        IOBufferFactory.budget.release(iobuffer.size)
+        self.bytes.release(iobuffer.size)
+        self.credits.release()
+        # A buffer read ahead is now needed by the consumer.
+        if self.waiting!=None and self.active<self.reserved:
+            self.waiting[0].grant(self.waiting[1])
     
 @ClassLogger
 class InputStreamReader(object):
     def __init__(self, input_stream, debug_name=None, num_buffers=2, size=None,
-                  async=False):
+                  async=False, buffer_size=None, adaptive=False, batch=1,
+                  read_ahead=None):
         '''
         If the 'size' is larger than the 'available()' bytes in the input
         stream, then garbage is read to achieve 'size'.
+        
+        The 'buffer_size' defaults to the one preferred by the input stream.
+        When 'adaptive' is set it is only the initial size, and it grows
+        while the throughput of the reader keeps improving.
+
+        Input streams with 'read_many' are read 'batch' buffers at a time,
+        which needs 'num_buffers' to be larger than 'batch'.
+
+        Async readers given 'read_ahead' read up to that many bytes ahead of
+        the consumer (see ReadAhead) instead of one buffer.
         '''
         if not isinstance(input_stream, InputStream):
             raise TypeError('input_stream must be an InputStream instance.')
@@ -104,11 +494,32 @@ class InputStreamReader(object):
         self.debug_name = debug_name
         self.exc_info = None
         self.input_stream = input_stream
-        self.buffer_fact = IOBufferFactory(num_buffers)
         self.finalized = False        
         self.size = size if size!=None else self.input_stream.size
         self.bytes_left = self.size
         self.async = async
+        self.buffer_size = buffer_size or self.input_stream.buffer_size\
+                           or IOBuffer.defsize
+        # Only the buffers read ahead wait for the node budget: the others
+        # can be held by the consumer (a coding batch) waiting for more.
+        reserved = max(num_buffers-1, 1)
+        if self.async and read_ahead:
+            self.read_ahead = ReadAhead(self.buffer_size, read_ahead)
+            self.queued = 0
+            self.room = gevent.event.Event()
+            num_buffers += -(-read_ahead//self.buffer_size)
+        else:
+            self.read_ahead = None
+        self.buffer_fact = IOBufferFactory(num_buffers, reserved=reserved)
+        if adaptive:
+            self.adaptive = AdaptiveBufferSize(self.buffer_size, 
+                                               IOBuffer.pool.max_class)
+        else:
+            self.adaptive = None
+        self.batch = batch if hasattr(input_stream, 'read_many') else 1
+        # Streams with 'view' hand out their own buffers, without copies.
+        self.mapped = hasattr(input_stream, 'view')
+        self.pending = collections.deque()
         
         if self.async:
             self.queue = gevent.queue.Queue()
@@ -126,8 +537,20 @@ class InputStreamReader(object):
         if __debug__: self.logger.debug("Starting %s internal async process.",
                                         self.debug_name or hex(id(self)))
         try:
-            while self.bytes_left>0:
-                self.queue.put(self._get_sync())
+            while self.bytes_left>0 or self.pending:
+                if self.read_ahead==None or self.pending:
+                    self.queue.put(self._get_sync())
+                    continue
+                while self.queued>=self.read_ahead.depth:
+                    self.room.clear()
+                    self.room.wait()
+                start = time.time()
+                iobuffer = self._get_sync()
+                self.read_ahead.read(time.time()-start)
+                self.queued += iobuffer.length
+                self.queue.put(iobuffer)
+                for iobuffer in self.pending:
+                    self.queued += iobuffer.length
             if __debug__: self.logger.debug("Reader has successfully finished.")
             return False
         
@@ -146,37 +569,84 @@ class InputStreamReader(object):
         if __debug__: self.logger.debug("Calling async get in %s.", 
                                         self.debug_name or hex(id(self)))
         try:
-            iobuffer = self.queue.get()
+            iobuffer = self._take()
             if self.exc_info:
                 raise self.exc_info[1], None, self.exc_info[2]
             return iobuffer
         except StopIteration:
             raise IOError("Reader ended before it was expected!")
 
+    def _take(self):
+        if self.read_ahead==None:
+            return self.queue.get()
+        self.read_ahead.waiting()
+        iobuffer = self.queue.get()
+        if isinstance(iobuffer, IOBuffer):
+            self.queued -= iobuffer.length
+            self.read_ahead.consumed(iobuffer.length)
+            self.room.set()
+        return iobuffer
+
     def _get_sync(self):
         if __debug__: self.logger.debug("Calling sync get in %s.", 
                                         self.debug_name or hex(id(self)))
+        if self.pending:
+            return self.pending.popleft()
+
         assert self.bytes_left>0
         if __debug__: self.logger.debug("%s get iteration %d/%d.", 
                                         self.debug_name or hex(id(self)),
                                         self.size-self.bytes_left, self.size)
+
+        if self.batch>1:
+            return self._get_batch()
         
-        iobuffer = self.buffer_fact.create()
         avail = self.input_stream.available()
-        if avail>0:
+        if self.mapped and avail>=self.buffer_size:
+            nbytes = min(self.buffer_size, self.bytes_left)
+            iobuffer = self.input_stream.view(self.buffer_fact, 
+                                              self.buffer_size, nbytes)
+            self.bytes_left -= nbytes
+            
+        elif avail>0:
+            iobuffer = self.buffer_fact.create(size=self.buffer_size)
             nbytes = min(iobuffer.size, avail, self.bytes_left)
-            self.bytes_left -= self.input_stream.read(iobuffer, nbytes=nbytes)
+            try:
+                nbytes = self.input_stream.read(iobuffer, nbytes=nbytes)
+            except:
+                # Also when the reader is killed in the middle of the read.
+                iobuffer.free()
+                raise
+            self.bytes_left -= nbytes
             
         else:
+            iobuffer = self.buffer_fact.create(size=self.buffer_size)
             nbytes = min(self.bytes_left, iobuffer.size)
             iobuffer.length = nbytes
             self.bytes_left -= nbytes
+        
+        if self.adaptive:
+            self.buffer_size = self.adaptive.update(iobuffer.length)
          
         return iobuffer   
+
+    def _get_batch(self):
+        count = min(self.batch, -(-self.bytes_left//self.buffer_size))
+        iobuffers = []
+        try:
+            for i in xrange(count):
+                iobuffers.append(self.buffer_fact.create(size=self.buffer_size))
+            self.bytes_left -= sum(self.input_stream.read_many(iobuffers))
+        except:
+            for iobuffer in iobuffers:
+                iobuffer.free()
+            raise
+        self.pending.extend(iobuffers)
+        return self.pending.popleft()
         
     def __iter__(self):
         if self.async:
-            for iobuffer in self.queue:
+            for iobuffer in iter(self._take, StopIteration):
                 if self.exc_info:
                     raise self.exc_info[1], None, self.exc_info[2]
                 yield iobuffer
@@ -184,7 +654,7 @@ class InputStreamReader(object):
                 raise self.exc_info[1], None, self.exc_info[2]
             
         else:
-            while self.bytes_left>0:
+            while self.bytes_left>0 or self.pending:
                 yield self._get_sync()
   
             if __debug__: self.logger.debug("Reader has successfully finished.")
@@ -200,13 +670,36 @@ class InputStreamReader(object):
     def finalize(self, kill=False):
         if self.async:
             self.process.kill()
+            # The buffers read ahead and not consumed are returned to the
+            # budgets, as the writers do with the ones they do not write.
+            while not self.queue.empty():
+                iobuffer = self.queue.get_nowait()
+                if iobuffer is not StopIteration:
+                    iobuffer.free()
+        while self.pending:
+            self.pending.popleft().free()
         if kill:
             self.input_stream.finalize()
 
 @ClassLogger
 class OutputStreamWriter(object):
-    def __init__(self, output_stream, async=False, debug_name=None):
+    # Buffers queued in async mode before write() blocks, so a slow output
+    # stream throttles its producer.
+    max_queued = 32
+
+    def __init__(self, output_stream, async=False, debug_name=None, 
+                  max_batch=16, close=False):
+        '''
+        In async mode, the buffers already queued when the internal process
+        wakes up (up to 'max_batch') are written at once if the output
+        stream supports 'write_many'.
+
+        With 'close' the writer owns the output stream: join() finalizes it.
+        '''
         self.output_stream = output_stream
+        self.close = close
+        self.max_batch = max_batch if hasattr(output_stream, 'write_many')\
+                         else 1
         self.exc_info = None
         self.finalizing = False
         self.finalized = False
@@ -214,7 +707,8 @@ class OutputStreamWriter(object):
         self.async = async
         
         if self.async:
-            self.queue = gevent.queue.Queue()
+            self.queue = gevent.queue.Queue(max(OutputStreamWriter.max_queued,
+                                                max_batch))
             self.process = gevent.spawn(self._run)
         else:
             self.queue = None
@@ -244,29 +738,65 @@ class OutputStreamWriter(object):
     def _run(self):
         try:
             for iobuffer in self.queue:
-                if __debug__: self.logger.debug('Processing a buffer to write.')
-                self.output_stream.write(iobuffer)
-                if __debug__: self.logger.debug('Freeing written buffer.')
-                iobuffer.free()
-                del iobuffer
+                batch = [iobuffer]
+                while len(batch)<self.max_batch and not self.queue.empty():
+                    iobuffer = self.queue.get_nowait()
+                    if iobuffer is StopIteration:
+                        self.queue.put(StopIteration)
+                        break
+                    batch.append(iobuffer)
+                
+                if __debug__: self.logger.debug('Processing %d buffers to '
+                                                'write.', len(batch))
+                if len(batch)==1:
+                    self.output_stream.write(batch[0])
+                else:
+                    self.output_stream.write_many(batch)
+                if __debug__: self.logger.debug('Freeing written buffers.')
+                for iobuffer in batch:
+                    iobuffer.free()
+                del batch, iobuffer
             return False
 
         except Exception, e:
-            if self.exc_info!=None:
-                self.exc_info = sys.exc_info()
-                return True
-            else:
-                return False
+            self.exc_info = sys.exc_info()
+            return True
 
         finally:
             self.finalizing = False
             self.finalized = True
+            # Producers blocked on a full queue must not wait for a writer
+            # that is gone.
+            while not self.queue.empty():
+                iobuffer = self.queue.get_nowait()
+                if iobuffer is not StopIteration:
+                    iobuffer.free()
+
+    def abort(self):
+        '''
+        Stops writing and drops the buffers queued. An output stream owned by
+        the writer is aborted if it supports it (see FileOutputStream).
+        '''
+        self.finalizing = False
+        self.finalized = True
+        if self.async:
+            self.process.kill()
+        if self.close:
+            getattr(self.output_stream, 'abort', 
+                    self.output_stream.finalize)()
 
     def join(self):
-        if self.async and self.process.get():
-            raise self.exc_info[1], None, self.exc_info[2]
+        try:
+            if self.async and self.process.get():
+                raise self.exc_info[1], None, self.exc_info[2]
+        finally:
+            if self.close:
+                self.output_stream.finalize()
 
 class InputStream(object):
+    # Preferred IOBuffer size to read this stream (None for IOBuffer.defsize).
+    buffer_size = None
+
     def __init__(self, size):
         if (type(size)!=int and type(size)!=long) or size<=0:
             raise TypeError("Parameter size must be a positive integer, "
@@ -307,19 +837,342 @@ class FileInputStream(InputStream):
     def finalize(self):
         self.fileio.close()
 
+@ClassLogger
+class MappedFileInputStream(InputStream):
+    '''
+    Reads a file through a private memory map: view() returns IOBuffers over
+    the mapped pages instead of copying them. Writes to those buffers (the
+    coding instructions work in place) are copy-on-write and never reach the
+    file. The map is advised sequential, and the pages of the buffers freed
+    are dropped behind the cursor.
+    '''
+    def __init__(self, filename, offset=0):
+        InputStream.__init__(self, os.path.getsize(filename)-offset)
+        self.fileio = io.open(filename, 'rb')
+        self.map = mmap.mmap(self.fileio.fileno(), 0, access=mmap.ACCESS_COPY)
+        self.array = numpy.ndarray((len(self.map),), dtype=numpy.uint8, 
+                                   buffer=self.map)
+        self.offset = offset
+        self.dropped = 0
+        self.views = collections.deque()
+        self.advise(0, len(self.map), MADV_SEQUENTIAL)
+
+    def advise(self, start, end, advice):
+        if madvise!=None and end>start:
+            madvise(self.array.ctypes.data+start, end-start, advice)
+
+    def view(self, factory, size, nbytes):
+        '''
+        Returns an IOBuffer of 'size' bytes over the map holding the next
+        'nbytes' of the file. The file must have 'size' bytes left.
+        '''
+        if self.offset+size>len(self.map):
+            raise ValueError("Cannot map %d bytes past the end of the file."\
+                             %size)
+        iobuffer = factory.create(size=size, 
+                                  block=self.array[self.offset:
+                                                   self.offset+size])
+        iobuffer.length = nbytes
+        self.views.append((self.offset, iobuffer))
+        self.offset += nbytes
+        self.bytes_left -= nbytes
+        self.drop()
+        return iobuffer
+
+    def drop(self):
+        # Dropping a page still in use would discard what was written to it,
+        # so only the pages before the first buffer not freed are dropped.
+        while self.views and self.views[0][1].released:
+            self.views.popleft()
+        end = self.views[0][0] if self.views else self.offset
+        end -= end%mmap.PAGESIZE
+        if end>self.dropped:
+            self.advise(self.dropped, end, MADV_DONTNEED)
+            self.dropped = end
+
+    def read(self, iobuffer, nbytes=None):
+        if nbytes==None:
+            nbytes = iobuffer.size
+        nbytes = min(iobuffer.size, nbytes, self.bytes_left)
+        if nbytes<=0:
+            raise IOError("Reached end of file.")
+        iobuffer.mem[:nbytes] = self.array[self.offset:self.offset+nbytes]
+        iobuffer.length = nbytes
+        self.offset += nbytes
+        self.bytes_left -= nbytes
+        return nbytes
+
+    def finalize(self):
+        # The map is unmapped when the last buffer over it is gone.
+        self.fileio.close()
+        self.views.clear()
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@ClassLogger
+class GroupCommit(object):
+    '''
+    Commits files in groups: the first commit waits 'delay' seconds for
+    others to join, then all their files are fsynced at once from the hub's
+    threadpool (so the filesystem journal can batch them), renamed, and
+    their directories fsynced once.
+    '''
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.group = None
+
+    def commit(self, temp, path):
+        if self.group==None:
+            self.group = []
+            gevent.spawn_later(self.delay, self._run, self.group)
+        result = gevent.event.AsyncResult()
+        self.group.append((temp, path, result))
+        result.get()
+
+    def _run(self, group):
+        if self.group is group:
+            self.group = None
+        if __debug__: self.logger.debug("Committing %d files.", len(group))
+        threadpool = gevent.get_hub().threadpool
+        try:
+            for sync in [threadpool.spawn(fsync_path, temp) 
+                         for temp, path, result in group]:
+                sync.get()
+        except Exception, e:
+            for temp, path, result in group:
+                result.set_exception(e)
+            return
+        # Each file fails on its own: the ones renamed are committed even
+        # if the rename of another one fails.
+        renamed = []
+        for temp, path, result in group:
+            try:
+                os.rename(temp, path)
+                renamed.append((path, result))
+            except Exception, e:
+                result.set_exception(e)
+        for directory in set(os.path.dirname(path) or '.' 
+                             for path, result in renamed):
+            try:
+                threadpool.apply(fsync_path, (directory,))
+            except Exception, e:
+                for path, result in renamed:
+                    if (os.path.dirname(path) or '.')==directory:
+                        result.set_exception(e)
+        for path, result in renamed:
+            if not result.ready():
+                result.set()
+
 @ClassLogger
 class FileOutputStream(object):
-    def __init__(self, filename):
-        if __debug__: self.logger.debug("Opening (w): %s", filename)
-        self.fileio = io.open(filename, 'wb')
+    # When the files written are fsynced: 'none', at 'close' or 'periodic'
+    # (every 'fsync_interval' seconds while writing, and at close).
+    fsync = 'none'
+    fsync_interval = 1.0
+    # GroupCommit of the atomic files, None renames them right away.
+    group_commit = None
+    temp_ids = itertools.count()
+
+    def __init__(self, filename, atomic=False):
+        '''
+        With 'atomic' the file is written to a temporary name and renamed to
+        'filename' at finalize(), so it is never seen incomplete. abort()
+        removes it instead.
+        '''
+        self.open_path(filename, atomic)
+        if __debug__: self.logger.debug("Opening (w): %s", self.path)
+        self.fileio = io.open(self.path, 'wb')
+        self.synced = time.time()
+
+    def open_path(self, filename, atomic):
+        self.filename = filename
+        if atomic:
+            self.path = '%s.%d-%d.tmp'%(filename, os.getpid(), 
+                                        next(FileOutputStream.temp_ids))
+        else:
+            self.path = filename
+
+    def commit(self):
+        if self.path==self.filename:
+            return
+        if FileOutputStream.group_commit!=None:
+            FileOutputStream.group_commit.commit(self.path, self.filename)
+        else:
+            os.rename(self.path, self.filename)
+
+    def remove(self):
+        if self.path==self.filename:
+            return
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno!=errno.ENOENT:
+                raise
 
     def write(self, iobuffer):
         num = self.fileio.write(iobuffer.data())
         if num!=iobuffer.length:
             raise IOError("Error writing to file.")
+        if FileOutputStream.fsync=='periodic':
+            self.sync(self.fileio.fileno(), False)
+
+    def sync(self, fd, closing):
+        policy = FileOutputStream.fsync
+        if policy=='none' or (policy=='close' and not closing):
+            return
+        now = time.time()
+        if closing or now-self.synced>=FileOutputStream.fsync_interval:
+            if self.fileio!=None:
+                self.fileio.flush()
+            # Flushing the disk takes long: only this greenlet waits for it.
+            gevent.get_hub().threadpool.apply(os.fsync, (fd,))
+            self.synced = now
 
     def finalize(self):
+        if self.fileio.closed:
+            return
+        try:
+            self.sync(self.fileio.fileno(), True)
+        except:
+            self.abort()
+            raise
+        self.fileio.close()
+        try:
+            self.commit()
+        except:
+            self.remove()
+            raise
+
+    def abort(self):
         self.fileio.close()
+        self.remove()
+
+@ClassLogger
+class DirectFileOutputStream(FileOutputStream):
+    '''
+    Writes a file with O_DIRECT, so the blocks written do not evict the ones
+    being read from the page cache. The buffers are gathered in two aligned
+    staging buffers of 'write_size' bytes: one is written from the hub's
+    threadpool while the other is filled. The last write is padded to the
+    'alignment' and the file truncated back at close. Where O_DIRECT is not
+    supported the same writes go through the page cache.
+    '''
+    write_size = 1024*1024
+    alignment = 4096
+
+    def __init__(self, filename, atomic=False):
+        self.open_path(filename, atomic)
+        if __debug__: self.logger.debug("Opening (w, direct): %s", self.path)
+        flags = os.O_WRONLY|os.O_CREAT|os.O_TRUNC
+        try:
+            self.fd = os.open(self.path, flags|getattr(os, 'O_DIRECT', 0), 
+                              0666)
+        except OSError, e:
+            if e.errno!=errno.EINVAL:
+                raise
+            self.logger.warning("No O_DIRECT support for %s.", self.path)
+            self.fd = os.open(self.path, flags, 0666)
+        self.fileio = None
+        self.closed = False
+        self.synced = time.time()
+        self.length = 0
+        self.fill = 0
+        self.staging = self.new_staging()
+        self.spare = self.new_staging()
+        self.pending = None
+
+    def new_staging(self):
+        size = DirectFileOutputStream.write_size
+        try:
+            iobuffer = IOBuffer.pool.acquire(None, size)
+        except MemoryError:
+            iobuffer = None
+        if iobuffer==None or\
+           iobuffer.as_numpy_byte_array().ctypes.data%self.alignment:
+            # The pool is exhausted: an anonymous map is aligned as well.
+            if iobuffer!=None:
+                iobuffer.free()
+            block = numpy.ndarray((size,), dtype=numpy.uint8, 
+                                  buffer=mmap.mmap(-1, size, 
+                                                   flags=mmap.MAP_PRIVATE))
+            iobuffer = IOBuffer(None, size, block=block)
+        return iobuffer
+
+    def _write_all(self, iobuffer, nbytes):
+        # Runs in a thread of the hub's threadpool.
+        written = 0
+        while written<nbytes:
+            written += os.write(self.fd, iobuffer.mem[written:nbytes])
+
+    def wait(self):
+        if self.pending!=None:
+            pending, self.pending = self.pending, None
+            pending.get()
+
+    def submit(self, nbytes):
+        self.wait()
+        self.pending = gevent.get_hub().threadpool.spawn(self._write_all, 
+                                                         self.staging, nbytes)
+        self.staging, self.spare = self.spare, self.staging
+        self.fill = 0
+
+    def write(self, iobuffer):
+        data = iobuffer.mem[:iobuffer.length]
+        written = 0
+        while written<len(data):
+            num = min(len(data)-written, self.staging.size-self.fill)
+            self.staging.mem[self.fill:self.fill+num] = \
+                data[written:written+num]
+            self.fill += num
+            written += num
+            if self.fill==self.staging.size:
+                self.submit(self.fill)
+        self.length += written
+        if FileOutputStream.fsync=='periodic':
+            self.sync(self.fd, False)
+
+    def finalize(self):
+        if self.closed:
+            return
+        try:
+            if self.fill>0:
+                padded = -(-self.fill//self.alignment)*self.alignment
+                self.submit(padded)
+            self.wait()
+            if os.fstat(self.fd).st_size>self.length:
+                os.ftruncate(self.fd, self.length)
+            self.sync(self.fd, True)
+        except:
+            self.abort()
+            raise
+        self.close()
+        try:
+            self.commit()
+        except:
+            self.remove()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.wait()
+        finally:
+            os.close(self.fd)
+            self.staging.free()
+            self.spare.free()
+
+    def abort(self):
+        try:
+            self.close()
+        finally:
+            self.remove()
 
 @ClassLogger
 class NetworkInputStream(InputStream):
@@ -352,6 +1205,9 @@ class NetworkOutputStream(object):
 
     def write(self, iobuffer):
         self.endpoint.send(iobuffer)
+
+    def write_many(self, iobuffers):
+        self.endpoint.send_buffers(iobuffers)
     
     def finalize(self):
         if __debug__: self.logger.debug("Finalizing.")
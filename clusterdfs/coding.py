@@ -1,12 +1,14 @@
 import os
+import sys
 import collections
 import gevent.queue
+import gevent.threadpool
 
 from headers import DataNodeHeader
 from common import ClassLogger
 from bufferedio import InputStreamReader, InputStream
 from networking import Client
-from galoisbuffer import GaloisBuffer
+from galoisbuffer import multiplier, multadd_many, combine_many
 
 class CodingException(Exception):
     pass
@@ -29,9 +31,9 @@ class TemporalBufferQueue(gevent.queue.Queue):
 @ClassLogger
 class RemoteNetCodingReader(InputStreamReader):
     def __init__(self, node_addr, block_id, coding_id, stream_id,
-                  nodes, **kwargs):
-        nodes = ';'.join(map(str, nodes))
-        self.client = Client(*node_addr)
+                  nodes, multiplexed=False, pooled=False, **kwargs):
+        self.client = Client(*node_addr, multiplexed=multiplexed, 
+                             pooled=pooled)
         self.header = DataNodeHeader.generate(DataNodeHeader.OP_CODING, 
                                               block_id, coding_id, stream_id, 
                                               nodes)
@@ -41,8 +43,13 @@ class RemoteNetCodingReader(InputStreamReader):
                                                     async=True, **kwargs)
     
     def finalize(self, kill=False):
+        if kill and self.client.pooled and self.bytes_left==0 and\
+           self.exc_info==None:
+            # The whole stream was received, the connection can be reused.
+            kill = False
         if not kill:
             self.client.assert_ack()
+            self.client.release()
         super(RemoteNetCodingReader, self).finalize(kill)
 
 @ClassLogger
@@ -68,6 +75,17 @@ class NetCodingExecutor(object):
     queues = {}
     sizes = {}
     numreg = collections.defaultdict(int)
+    # Threads running the Galois arithmetic without the GIL, so the hub keeps
+    # serving I/O meanwhile (0 runs it in the calling greenlet). Smaller 
+    # buffers than 'offload_size' are not worth the thread handoff.
+    threads = 0
+    offload_size = 64*1024
+    threadpool = None
+    # Execute chains of COPY and MULADDs as single pass COMBINEs.
+    fuse = True
+    # Chunks processed by each instruction before the next one runs. The
+    # readers need 'batch'+1 buffers.
+    batch = 1
 
     def __init__(self, operations, resolver, stream_id, bf=16):
         self.stream_id = stream_id
@@ -75,9 +93,9 @@ class NetCodingExecutor(object):
         self.resolver = resolver
         self.finalized = False
         self.bitfield_op = bf
+        self.instructions = operations.program(bf, NetCodingExecutor.fuse)
 
         # Create dictionaries
-        self.buffers = {}
         self.readers = {}
         self.writers = {}
         
@@ -121,10 +139,19 @@ class NetCodingExecutor(object):
         
         # Keep track of which iobuffers we have to free here.
         self.disposable_buffers = set()
+        self.processed = 0
         
         NetCodingExecutor.sizes[self.stream_id] = self.size
         NetCodingExecutor.numreg[self.stream_id] += 1
 
+        # Buffers are referenced by their index in the slots of each chunk,
+        # resolved once.
+        self.slot_index = {}
+        if self.operations.output!=None:
+            self.output_slot = self.slot(self.operations.output)
+        self.steps = [(instruction, self.compile(instruction))
+                      for instruction in self.instructions]
+
     def finalize(self):
         if self.finalized:
             return
@@ -139,16 +166,38 @@ class NetCodingExecutor(object):
         '''               
         if __debug__: self.logger.debug('Finalizing coding...')
         
+        # Every reader and writer is finalized even if some of them fail,
+        # and the first error is raised at the end.
+        errors = []
         for reader in self.readers.itervalues():
-            reader.finalize(True)
-            
+            try:
+                reader.finalize(True)
+            except Exception:
+                errors.append(sys.exc_info())
+        
+        # The blocks of an interrupted (or not acknowledged) execution are
+        # not committed.
+        complete = self.processed>=self.size and not errors
         for writer in self.writers.itervalues():
-            writer.finalize()
+            try:
+                if complete:
+                    writer.finalize()
+                else:
+                    writer.abort()
+            except Exception:
+                errors.append(sys.exc_info())
             
         if __debug__: self.logger.debug('Waiting for writers..')    
         
-        for writer in self.writers.itervalues():
-            writer.join()
+        if complete:
+            for writer in self.writers.itervalues():
+                try:
+                    writer.join()
+                except Exception:
+                    errors.append(sys.exc_info())
+
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
 
         '''            
         if __debug__: self.logger.debug('Killing clients..')
@@ -157,124 +206,182 @@ class NetCodingExecutor(object):
                 reader.finalize(kill)
         '''
                  
-    def execute_instruction(self, instruction):
-        if __debug__: self.logger.debug('NetCodingInputStream %s is '
-                                        'processing instruction %s',
-                                        self.stream_id, str(instruction))
-       
-        bytes_processed = None
+    def offload(self, size, function, *args, **kwargs):
+        '''
+        Runs function in the thread pool, blocking only the calling greenlet.
+        '''
+        if NetCodingExecutor.threads<=0 or size<NetCodingExecutor.offload_size:
+            return function(*args, **kwargs)
+        if NetCodingExecutor.threadpool==None:
+            # Created on first use, so pre-forked workers get their own.
+            NetCodingExecutor.threadpool = gevent.threadpool.ThreadPool(
+                                                    NetCodingExecutor.threads)
+        return NetCodingExecutor.threadpool.apply(function, args, kwargs)
+
+    def slot(self, name):
+        '''
+        Index of the buffer named 'name' in the slots of a chunk.
+        '''
+        if name not in self.slot_index:
+            self.slot_index[name] = len(self.slot_index)
+        return self.slot_index[name]
+
+    def check_sources(self, dst_buffer, src_buffer):
+        if src_buffer.length==0:
+            raise CodingException('Empty buffer.')
+        if src_buffer.size!=dst_buffer.size:
+            self.logger.error('Buffer sizes are not aligned.')
+            raise CodingException('Buffer sizes are not aligned.')
+
+    def compile(self, instruction):
+        '''
+        Returns a function executing instruction on a batch of chunks, given
+        the slots of each one, which returns the bytes processed in each.
+        The arithmetic of the whole batch is one call of the extension, and
+        one thread handoff when offloaded.
+        '''
+        bf = self.bitfield_op
+        op = instruction[0]
 
-        if instruction[0]=='COPY':
-            dst_buffer = self.buffers[instruction[1]]
-            src_buffer = self.buffers[instruction[2]]
-            src_buffer.copy_to(dst_buffer)
-            bytes_processed = dst_buffer.length
+        if op=='COPY':
+            dst, src = self.slot(instruction[1]), self.slot(instruction[2])
+            def step(chunks):
+                return [slots[src].copy_to(slots[dst]).length 
+                        for slots in chunks]
         
-        elif instruction[0]=='PUSH':
-            queue = instruction[1]
-            buff = self.buffers[instruction[2]]
-            #if __debug__: self.logger.debug("Non disposable: %d", id(buff))
-            self.disposable_buffers.remove(buff)
-            NetCodingExecutor.queues[self.stream_id][queue].put(buff)
-            bytes_processed = buff.length
+        elif op=='PUSH':
+            queue = NetCodingExecutor.queues[self.stream_id][instruction[1]]
+            src = self.slot(instruction[2])
+            disposable = self.disposable_buffers
+            def step(chunks):
+                for slots in chunks:
+                    disposable.remove(slots[src])
+                    queue.put(slots[src])
+                return [slots[src].length for slots in chunks]
         
-        elif instruction[0]=='POP':
-            assert self.stream_id in NetCodingExecutor.queues
-            queue = instruction[1]
-            buff = NetCodingExecutor.queues[self.stream_id][queue].get()
-            #if __debug__: self.logger.debug("Make disposable: %d", id(buff))
-            self.disposable_buffers.add(buff)
-            self.buffers[instruction[2]] = buff
-            bytes_processed = buff.length
+        elif op=='POP':
+            queue = NetCodingExecutor.queues[self.stream_id][instruction[1]]
+            dst = self.slot(instruction[2])
+            disposable = self.disposable_buffers
+            def step(chunks):
+                for slots in chunks:
+                    buff = slots[dst] = queue.get()
+                    disposable.add(buff)
+                return [slots[dst].length for slots in chunks]
             
-        elif instruction[0]=='LOAD':
-            buff = self.readers[instruction[2]].get()
-            self.buffers[instruction[1]] = buff
-            #if __debug__: self.logger.debug("Make disposable: %d", id(buff))
-            self.disposable_buffers.add(buff)
-            bytes_processed = self.buffers[instruction[1]].length
+        elif op=='LOAD':
+            dst = self.slot(instruction[1])
+            reader = self.readers[instruction[2]]
+            disposable = self.disposable_buffers
+            def step(chunks):
+                for slots in chunks:
+                    buff = slots[dst] = reader.get()
+                    disposable.add(buff)
+                return [slots[dst].length for slots in chunks]
         
-        elif instruction[0]=='WRITE':
-            buff = self.buffers[instruction[1]]
-            dst_stream = self.writers[instruction[2]]
-            #if __debug__: self.logger.debug("Non disposable: %d", id(buff))
-            self.disposable_buffers.remove(buff)
-            dst_stream.write(buff)
-            bytes_processed = buff.length
+        elif op=='WRITE':
+            src = self.slot(instruction[1])
+            writer = self.writers[instruction[2]]
+            disposable = self.disposable_buffers
+            def step(chunks):
+                lengths = [slots[src].length for slots in chunks]
+                for slots in chunks:
+                    disposable.remove(slots[src])
+                    writer.write(slots[src])
+                return lengths
            
-        elif instruction[0]=='IADD':
-            src_buffer = self.buffers[instruction[2]]
-            dst_buffer = self.buffers[instruction[1]]
-            src = GaloisBuffer(src_buffer.size, bitfield=self.bitfield_op, 
-                               buffer=src_buffer.buff)
-            dst = GaloisBuffer(dst_buffer.size, bitfield=self.bitfield_op, 
-                               buffer=dst_buffer.buff)
-            dst += src
-            dst_buffer.length = src_buffer.length
-            bytes_processed = dst_buffer.length
+        elif op=='IADD':
+            dst, src = self.slot(instruction[1]), self.slot(instruction[2])
+            def iadd(pairs):
+                for dst_view, src_view in pairs:
+                    dst_view.__iadd__(src_view)
+            def step(chunks):
+                pairs = [(slots[dst].as_galois_buffer(bf), 
+                          slots[src].as_galois_buffer(bf)) for slots in chunks]
+                self.offload(self.batch_size(chunks, dst), iadd, pairs)
+                return self.set_lengths(chunks, dst, src)
             
-        elif instruction[0]=='MULADD':
-            src_buffer = self.buffers[instruction[3]]
+        elif op=='MULADD' or op=='MULT':
+            dst, src = self.slot(instruction[1]), self.slot(instruction[3])
             literal_value = instruction[2]
-            dst_buffer = self.buffers[instruction[1]]
-            
-            if src_buffer.length==0:
-                raise CodingException('Empty buffer.')
-            if src_buffer.size!=dst_buffer.size:
-                self.logger.error('Buffer sizes are not aligned.')
-                raise CodingException('Buffers sizes are not aligned.')
-
-            src = GaloisBuffer(src_buffer.size, bitfield=self.bitfield_op, 
-                               buffer=src_buffer.buff)
-            dst = GaloisBuffer(dst_buffer.size, bitfield=self.bitfield_op, 
-                               buffer=dst_buffer.buff)
-            src.multadd(literal_value, dest=dst, add=True)
-            dst_buffer.length = src_buffer.length
-            bytes_processed = dst_buffer.length
-
-        elif instruction[0]=='MULT':
-            src_buffer = self.buffers[instruction[3]]
-            literal_value = instruction[2]
-            dst_buffer = self.buffers[instruction[1]]
-           
-            if src_buffer.length==0:
-                raise CodingException('Empty buffer.')
-            if src_buffer.size!=dst_buffer.size:
-                self.logger.error('Buffer sizes are not aligned.')
-                raise CodingException('Buffer sizes are not aligned.')
+            add = op=='MULADD'
+            def step(chunks):
+                for slots in chunks:
+                    self.check_sources(slots[dst], slots[src])
+                self.offload(self.batch_size(chunks, src), multadd_many,
+                             [slots[src].as_galois_buffer(bf) 
+                              for slots in chunks],
+                             literal_value, 
+                             [slots[dst].as_galois_buffer(bf) 
+                              for slots in chunks], add=add)
+                return self.set_lengths(chunks, dst, src)
 
-            src = GaloisBuffer(src_buffer.size, bitfield=self.bitfield_op, 
-                               buffer=src_buffer.buff)
-            dst = GaloisBuffer(dst_buffer.size, bitfield=self.bitfield_op, 
-                               buffer=dst_buffer.buff)
-            src.multadd(literal_value, dest=dst, add=False)
-            dst_buffer.length = src_buffer.length
-            bytes_processed = dst_buffer.length
+        elif op=='COMBINE':
+            dst, base = self.slot(instruction[1]), self.slot(instruction[2])
+            srcs = map(self.slot, instruction[3])
+            coefficients, other_coefficients = instruction[4], instruction[6]
+            other = self.slot(instruction[5]) if instruction[5]!=None else None
+            def step(chunks):
+                for slots in chunks:
+                    for src in srcs:
+                        self.check_sources(slots[dst], slots[src])
+                view = lambda index: [slots[index].as_galois_buffer(bf) 
+                                      for slots in chunks]
+                self.offload(self.batch_size(chunks, dst), combine_many,
+                             view(dst), 
+                             [[slots[src].as_galois_buffer(bf) 
+                               for src in srcs] for slots in chunks],
+                             coefficients, bases=view(base),
+                             others=view(other) if other!=None else None,
+                             other_coefficients=other_coefficients)
+                lengths = self.set_lengths(chunks, dst, srcs[-1])
+                if other!=None:
+                    self.set_lengths(chunks, other, srcs[-1])
+                return lengths
 
         else:
             raise CodingException('Invalid coding instruction: %s'\
                                   %(str(instruction)))
 
-        if bytes_processed==None:
-            raise CodingException('The number of processed bytes was not set '
-                                  'for instruction: %s'%(str(instruction)))
+        return step
 
-        return bytes_processed
+    @staticmethod
+    def batch_size(chunks, index):
+        return sum(slots[index].size for slots in chunks)
+
+    @staticmethod
+    def set_lengths(chunks, dst, src):
+        '''
+        Gives the buffers 'dst' of the chunks the length of their 'src'.
+        '''
+        for slots in chunks:
+            slots[dst].length = slots[src].length
+        return [slots[dst].length for slots in chunks]
 
     def execute_step(self, output=None):
-        bytes_processed = None
-        
+        return self.execute_steps([output])[0]
+
+    def execute_steps(self, outputs):
+        '''
+        Processes len(outputs) consecutive chunks, running each instruction
+        over all of them at once before the next one. Returns the bytes 
+        processed for each chunk.
+        '''
+        chunks = [[None]*len(self.slot_index) for output in outputs]
         if self.operations.output!=None:
-            if output!=None:
-                self.buffers[self.operations.output] = output
-            else:
-                assert False
+            for slots, output in zip(chunks, outputs):
+                assert output!=None
+                slots[self.output_slot] = output
 
-        for instruction in self.operations.instructions:
-            bp = self.execute_instruction(instruction)
-            if bytes_processed!=None and bytes_processed!=bp:
+        bytes_processed = None
+        for instruction, step in self.steps:
+            if __debug__: self.logger.debug('NetCodingInputStream %s is '
+                                            'processing instruction %s',
+                                            self.stream_id, str(instruction))
+            lengths = step(chunks)
+            if bytes_processed!=None and lengths!=bytes_processed:
                 raise CodingException('Buffer sizes are not aligned.')
-            bytes_processed = bp
+            bytes_processed = lengths
             
         # Release used buffers
         for iobuffer in self.disposable_buffers:
@@ -282,15 +389,21 @@ class NetCodingExecutor(object):
         self.disposable_buffers.clear()
         
         if __debug__: self.logger.debug('Coding processed %d bytes.', 
-                                        bytes_processed)
+                                        sum(bytes_processed))
+        self.processed += sum(bytes_processed)
         return bytes_processed
 
     def execute(self):
+        # Without an output stream the chunk size is the one of the readers.
+        chunk_size = min([reader.buffer_size for reader in 
+                          self.readers.itervalues()] or [self.size])
         read = 0
         while read<self.size:
             if __debug__: self.logger.debug('execute iter %d/%d', 
                                             read, self.size)
-            read += self.execute_step()
+            chunks = min(NetCodingExecutor.batch, 
+                         -(-(self.size-read)//chunk_size))
+            read += sum(self.execute_steps([None]*chunks))
             yield read
             
 
@@ -318,15 +431,104 @@ class NetCodingInputStream(InputStream):
         assert num_read==iobuffer.length, (num_read,iobuffer.length)
         return num_read
 
+    def read_many(self, iobuffers):
+        num_read = self.executor.execute_steps(iobuffers)
+        assert num_read==[iobuffer.length for iobuffer in iobuffers]
+        return num_read
+
 class NetCodingOperations(object):
     def __init__(self, node, streams=[], output=None):
         self.node = node
         self.streams = streams
         self.output = output
         self.instructions = []
+        self.fused_instructions = None
+        self.programs = {}
 
     def add(self, inst):
         self.instructions.append(inst)
+        self.fused_instructions = None
+        self.programs = {}
+
+    def program(self, bitfield, fuse=True):
+        '''
+        Returns the instructions to execute (fused if 'fuse') with their 
+        coefficients replaced by GaloisMultipliers, so the multiplication
+        tables of each constant are built once.
+        '''
+        if (bitfield, fuse) not in self.programs:
+            m = lambda c: multiplier(c, bitfield)
+            program = []
+            for inst in (self.fused() if fuse else self.instructions):
+                if inst[0] in ('MULT', 'MULADD'):
+                    inst = inst[:2]+(m(inst[2]),)+inst[3:]
+                elif inst[0]=='COMBINE':
+                    inst = inst[:4]+(tuple(map(m, inst[4])), inst[5],
+                           tuple(map(m, inst[6])) if inst[6]!=None else None)
+                program.append(inst)
+            self.programs[(bitfield, fuse)] = program
+        return self.programs[(bitfield, fuse)]
+
+    def fused(self):
+        '''
+        Returns the instructions with each COPY followed by MULADDs into the
+        copy (and then into the copied buffer, from the same sources) merged
+        into a COMBINE, which computes them in one pass over the buffers:
+        ('COMBINE', dst, base, sources, coefficients, other, other_coefs).
+        Consecutive MULADDs into the same buffer are merged as well. IADDs
+        among them (the streams of a fan-in) are terms with coefficient 1.
+        '''
+        if self.fused_instructions!=None:
+            return self.fused_instructions
+
+        def muladds(i, dst, excluded):
+            terms = []
+            while i<len(self.instructions):
+                inst = self.instructions[i]
+                if inst[0]=='MULADD' and inst[1]==dst and\
+                   inst[3] not in excluded:
+                    terms.append(inst[2:])
+                elif inst[0]=='IADD' and inst[1]==dst and\
+                     inst[2] not in excluded:
+                    terms.append((1, inst[2]))
+                else:
+                    break
+                i += 1
+            return terms
+
+        fused = []
+        i = 0
+        while i<len(self.instructions):
+            inst = self.instructions[i]
+            if inst[0]=='COPY' and inst[1]!=inst[2]:
+                dst, base = inst[1], inst[2]
+                terms = muladds(i+1, dst, (dst, base))
+                other_terms = muladds(i+1+len(terms), base, (dst, base))
+                if terms:
+                    sources = tuple(src for c, src in terms)
+                    if tuple(src for c, src in other_terms)==sources:
+                        fused.append(('COMBINE', dst, base, sources, 
+                                      tuple(c for c, src in terms), base,
+                                      tuple(c for c, src in other_terms)))
+                        i += 1+2*len(terms)
+                    else:
+                        fused.append(('COMBINE', dst, base, sources,
+                                      tuple(c for c, src in terms), None, None))
+                        i += 1+len(terms)
+                    continue
+            elif inst[0] in ('MULADD', 'IADD'):
+                terms = muladds(i, inst[1], (inst[1],))
+                if len(terms)>1:
+                    fused.append(('COMBINE', inst[1], inst[1], 
+                                  tuple(src for c, src in terms),
+                                  tuple(c for c, src in terms), None, None))
+                    i += len(terms)
+                    continue
+            fused.append(inst)
+            i += 1
+
+        self.fused_instructions = fused
+        return fused
 
     def is_stream(self):
         return self.output!=None
@@ -1,5 +1,7 @@
 import os
+import re
 import math
+import errno
 import uuid
 import gevent
 import logging
@@ -9,9 +11,11 @@ import importlib
 from common import Config, ClassLogger
 from coding import  NetCodingExecutor, NetCodingInputStream
 from headers import DataNodeHeader, NameNodeHeader
-from networking import Client, Server, ServerHandle
+from networking import Client, Server, ServerHandle, MultiplexedConnection
 from bufferedio import FileInputStream, FileOutputStream, InputStreamReader,\
-                       OutputStreamWriter
+                       OutputStreamWriter, IOBuffer, NetworkInputStream,\
+                       IOBufferFactory, ByteBudget, MappedFileInputStream,\
+                       DirectFileOutputStream, GroupCommit
 
 class DataNodeConfig(Config):
     port = 13100
@@ -23,12 +27,62 @@ class DataNodeConfig(Config):
     fakeout = False
     isolated = False
     coding_mod_name = 'clusterdfs.rapidraid'
+    buffer_pool_size = 64*1024*1024
+    # Bytes of buffers allocated out of the pool at once when it is full.
+    buffer_pool_overflow = 16*1024*1024
+    # Bytes the buffers of all the streams (buffer_budget) and of each one
+    # (stream_buffer_bytes) can hold before reading ahead stops, and bytes
+    # a multiplexed stream sends ahead of its reader. None for no limit.
+    buffer_budget = None
+    stream_buffer_bytes = None
+    multiplex_window = 1024*1024
+    # Bytes the coding readers read ahead of the executor at most, adapted
+    # to the rate it consumes them (None reads one buffer ahead).
+    read_ahead = None
+    # Coding programs read local blocks from a memory map, without copies.
+    mapped_reads = True
+    # Write blocks with O_DIRECT, bypassing the page cache.
+    direct_writes = False
+    # When written blocks are fsynced: 'none', at 'close' or 'periodic'
+    # (every fsync_interval seconds, and at close).
+    fsync = 'none'
+    fsync_interval = 1.0
+    # Blocks are written to a temporary file renamed once complete. With
+    # group_commit the renames are made durable (with the data) in groups,
+    # gathered for group_commit_delay seconds, and fsync can be 'none'.
+    group_commit = False
+    group_commit_delay = 0.0
+    # IOBuffer sizes per stream type (None for IOBuffer.defsize).
+    disk_buffer_size = None
+    network_buffer_size = None
+    coding_buffer_size = None
+    adaptive_buffers = False
+    # Threads for the coding arithmetic (0 runs it in the hub's thread).
+    coding_threads = 0
+    # Chunks each coding instruction processes before the next one.
+    coding_batch = 1
+    # Serve RETRIEVE with sendfile when it is available.
+    zero_copy = True
+    # Share one connection per DataNode pair for all the coding streams.
+    multiplex = False
+    # Reuse connections to other DataNodes for sequential requests.
+    keep_alive = False
+    keep_alive_timeout = 60
+    # Processes accepting on 'port' (pre-fork mode when greater than 1). 
+    # The buffer pool is allocated per worker.
+    workers = 1
     
     def check(self):
         if self.datadir==None:
             self.datadir = tempfile.mkdtemp()
         if not self.datadir.endswith('/'):
             self.datadir = self.datadir+'/'
+        if self.coding_buffer_size==None:
+            # Coding readers mix disk and network streams, so they cannot
+            # fall back to the per stream type defaults.
+            self.coding_buffer_size = IOBuffer.defsize
+        if self.fsync not in ('none', 'close', 'periodic'):
+            raise ValueError("Unknown fsync policy '%s'."%self.fsync)
         return self
     
     def _get_coding_mod(self, singleton=[]):
@@ -43,6 +97,33 @@ class BlockStoreManager(object):
     def __init__(self, config):
         self.data_dir = config.datadir
         self.fake_out = config.fakeout
+        self.direct_writes = config.direct_writes
+        self.remove_temps()
+
+    def remove_temps(self):
+        '''
+            Removes the temporary files of the blocks not committed by
+            processes that are gone. The data directory can be shared by
+            several DataNodes, whose writes in progress are kept.
+        '''
+        for name in os.listdir(self.data_dir):
+            match = re.search(r'\.(\d+)-\d+\.tmp$', name)
+            if match==None or self.is_alive(int(match.group(1))):
+                continue
+            self.logger.warning("Removing uncommitted block file %s.", name)
+            try:
+                os.unlink(os.path.join(self.data_dir, name))
+            except OSError, e:
+                if e.errno!=errno.ENOENT:
+                    raise
+
+    @staticmethod
+    def is_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno!=errno.ESRCH
+        return True
 
     def path(self, block_id):
         return os.path.join(self.data_dir, block_id)
@@ -61,24 +142,40 @@ class BlockStoreManager(object):
 
     def get_output_stream(self, block_id):
         '''
-            Returns a FileOutputStream for the block with block_id.
+            Returns a FileOutputStream (DirectFileOutputStream with
+            direct_writes) for the block with block_id. The block is 
+            written to a temporary file and committed on finalize().
         '''
-        pathfunc = self.fake_path if self.fake_out else self.path
-        return FileOutputStream(pathfunc(block_id))
+        if self.fake_out:
+            return FileOutputStream(self.fake_path(block_id))
+        elif self.direct_writes:
+            return DirectFileOutputStream(self.path(block_id), atomic=True)
+        else:
+            return FileOutputStream(self.path(block_id), atomic=True)
 
-    def get_reader(self, block_id, debug_name=None):
+    def get_reader(self, block_id, debug_name=None, buffer_size=None,
+                   num_buffers=2, read_ahead=None, mapped=False):
         '''
-            Returns a FileInputStream for the block with block_id.
+            Returns a reader of the block with block_id, over a 
+            MappedFileInputStream if 'mapped' or a FileInputStream if not.
         '''
-        return InputStreamReader(self.get_input_stream(block_id), 
-                                 debug_name=debug_name)
+        if mapped:
+            input_stream = MappedFileInputStream(self.path(block_id))
+        else:
+            input_stream = self.get_input_stream(block_id)
+        return InputStreamReader(input_stream, 
+                                 debug_name=debug_name, 
+                                 buffer_size=buffer_size,
+                                 num_buffers=num_buffers,
+                                 async=read_ahead!=None,
+                                 read_ahead=read_ahead)
 
     def get_writer(self, block_id, debug_name=None):
         '''
             Returns a FileOutputStream for the block with block_id.
         '''
         return OutputStreamWriter(self.get_output_stream(block_id), 
-                                  debug_name=debug_name)
+                                  debug_name=debug_name, close=True)
 
 @ClassLogger   
 class DataNodeQuery(ServerHandle):
@@ -104,12 +201,15 @@ class DataNodeQuery(ServerHandle):
     def store_block(self, block_id=None, **kwargs):
         self.logger.info("Storing block '%s'.", block_id)
 
-        reader = self.recv_reader()
+        reader = self.recv_reader(adaptive=self.server.config.adaptive_buffers)
 
         # processing
-        writer = OutputStreamWriter(self.server.block_store\
-                                    .get_output_stream(block_id))
-        reader.flush(writer)
+        writer = self.server.block_store.get_writer(block_id)
+        try:
+            reader.flush(writer)
+        except:
+            writer.abort()
+            raise
         writer.finalize()
         writer.join()
         
@@ -118,12 +218,20 @@ class DataNodeQuery(ServerHandle):
     def retrieve_block(self, block_id=None, **kwargs):
         self.logger.info("Sending block '%s'.", block_id)
         input_stream = self.server.block_store.get_input_stream(block_id)
-        self.send(input_stream)
-        reader = InputStreamReader(input_stream, debug_name='retrieve')
-        writer = self.new_writer()
-        reader.flush(writer)
-        writer.finalize()
-        writer.join()
+        try:
+            self.send(input_stream)
+            if self.server.config.zero_copy and\
+               self.can_sendfile(input_stream):
+                self.send_file(input_stream)
+            else:
+                reader = InputStreamReader(input_stream, debug_name='retrieve',
+                                   adaptive=self.server.config.adaptive_buffers)
+                writer = self.new_writer()
+                reader.flush(writer)
+                writer.finalize()
+                writer.join()
+        finally:
+            input_stream.finalize()
         self.logger.info('Block %s sent successfully.', block_id)
 
     def insert_data(self, block_id=None, **kwargs):
@@ -136,10 +244,14 @@ class DataNodeQuery(ServerHandle):
                          store_size, block_size)
         for i in xrange(coding.k):
             self.logger.info("Inserting part %d of %d.", i, coding.k)
-            reader = InputStreamReader(instream, size=block_size)
-            writer = OutputStreamWriter(self.server.block_store\
-                                .get_output_stream(block_id+"_part%d"%i))
-            reader.flush(writer)
+            reader = InputStreamReader(instream, size=block_size, 
+                                   adaptive=self.server.config.adaptive_buffers)
+            writer = self.server.block_store.get_writer(block_id+"_part%d"%i)
+            try:
+                reader.flush(writer)
+            except:
+                writer.abort()
+                raise
             writer.finalize()
             writer.join()
 
@@ -147,7 +259,7 @@ class DataNodeQuery(ServerHandle):
 
 
     def node_coding(self, block_id='', coding_id=None, stream_id='', 
-                     nodes='', **kwargs):
+                     nodes=(), **kwargs):
         if not block_id:
             raise ValueError("'block_id' is not provided.")
         if not coding_id:
@@ -169,7 +281,6 @@ class DataNodeQuery(ServerHandle):
                              stream_id)
             coding = self.server.config.coding_mod
             
-            nodes = map(eval, nodes.split(';'))
             coding_operations = coding.operations[coding_id]
             resolver = coding.RapidRaidResolver(block_id, stream_id, 
                                                 self.server.block_store, 
@@ -182,11 +293,14 @@ class DataNodeQuery(ServerHandle):
             if coding_operations.is_stream():
                 if __debug__: self.logger.debug("Forwarding coding stream.")
                 input_stream = NetCodingInputStream(coding_executor)
+                batch = self.server.config.coding_batch
                 reader = InputStreamReader(input_stream, 
                                            debug_name='coding_result', 
-                                           async=False)
+                                           async=False, buffer_size=self.\
+                                           server.config.coding_buffer_size,
+                                           num_buffers=batch+1, batch=batch)
                 self.send(input_stream)
-                writer = self.new_writer(async=False)
+                writer = self.new_writer()
                 reader.flush(writer)
                 writer.finalize()
                 writer.join()
@@ -248,7 +362,26 @@ class DataNode(Server):
                           self.config.port)
         self.logger.info("DataNode data dir: %s", config.datadir)
         self.logger.info("Using a fake out? %s", unicode(config.fakeout))
+        self.logger.info("Buffer pool size: %d bytes", config.buffer_pool_size)
+        self.logger.info("Worker processes: %d", config.workers)
+        IOBuffer.pool.configure(capacity=self.config.buffer_pool_size,
+                                overflow=self.config.buffer_pool_overflow)
+        IOBufferFactory.budget = ByteBudget(self.config.buffer_budget)
+        IOBufferFactory.stream_bytes = self.config.stream_buffer_bytes
+        MultiplexedConnection.window = self.config.multiplex_window
+        FileInputStream.buffer_size = self.config.disk_buffer_size
+        FileOutputStream.fsync = self.config.fsync
+        FileOutputStream.fsync_interval = self.config.fsync_interval
+        if self.config.group_commit:
+            FileOutputStream.group_commit = GroupCommit(self.config.\
+                                                        group_commit_delay)
+        else:
+            FileOutputStream.group_commit = None
+        NetworkInputStream.buffer_size = self.config.network_buffer_size
+        NetCodingExecutor.threads = self.config.coding_threads
+        NetCodingExecutor.batch = self.config.coding_batch
         Server.__init__(self, DataNodeQuery, port=self.config.port)
+        self.keep_alive_timeout = self.config.keep_alive_timeout
 
         self.block_store = BlockStoreManager(self.config)
 
@@ -256,7 +389,12 @@ class DataNode(Server):
             self.notifier = DataNodeNotifier(self.config, self)
 
     def init(self):
-        self.serve()
+        self.serve(self.config.workers)
+
+    def init_worker(self):
+        # Only the supervisor notifies the NameNode.
+        if not self.config.isolated:
+            self.notifier.stop()
 
     def finalize(self):
         if not self.config.isolated:
@@ -264,8 +402,9 @@ class DataNode(Server):
 
 @ClassLogger
 class DataNodeClient(Client):
-    def __init__(self, address, port):
-        super(DataNodeClient, self).__init__(address, port)
+    def __init__(self, address, port, multiplexed=False, pooled=False):
+        super(DataNodeClient, self).__init__(address, port, multiplexed, 
+                                             pooled)
     
     def insert(self, block_id, local_path):
         self.send(DataNodeHeader.generate(DataNodeHeader.OP_INSERT, block_id))
@@ -279,6 +418,7 @@ class DataNodeClient(Client):
         istream.finalize()
         if __debug__: self.logger.debug("Wating for ACK.")
         self.assert_ack()
+        self.release()
         if __debug__: self.logger.debug("END.")
     
     def retrieve(self, block_id, local_path):
@@ -292,6 +432,7 @@ class DataNodeClient(Client):
         ostream.finalize()
         if __debug__: self.logger.debug("Wating for ACK.")
         self.assert_ack()
+        self.release()
         if __debug__: self.logger.debug("END.")
         
     def coding(self, block_id, coding_id, nodes):        
@@ -308,4 +449,5 @@ class DataNodeClient(Client):
             if __debug__: self.logger.debug("Got %d out of %d.",read, size)
         assert size==read
         self.assert_ack()
+        self.release()
         if __debug__: self.logger.debug("END.")
\ No newline at end of file
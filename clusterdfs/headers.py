@@ -1,3 +1,5 @@
+import ast
+import struct
 import avro.io
 import avro.schema
 
@@ -7,11 +9,28 @@ except ImportError:
     from StringIO import StringIO
     
 class DataNodeHeader(object):
+    '''Binary structure of a DataNode request header (all big-endian):
+     + 1 byte  --> format version (VERSION)
+     + 1 byte  --> operation ('op' code)
+     + string  --> block_id
+     + string  --> coding_id
+     + string  --> stream_id
+     + 2 bytes --> number of nodes, followed by each node as a string (host)
+                   and 2 bytes (port)
+     Strings are a 2 bytes length followed by the UTF-8 encoded bytes.
+     
+     Headers not starting with VERSION are parsed as the former Avro record
+     (an Avro encoded operation never has the highest bit set).
+    '''
     # Available 'op' codes:
     OP_STORE = 0
     OP_RETRIEVE = 1
     OP_CODING = 2
     OP_INSERT = 3
+    
+    VERSION = 0x81
+    PREFIX = struct.Struct('!BB')
+    LENGTH = struct.Struct('!H')
             
     schema = avro.schema.parse("""\
                     {"type": "record",
@@ -27,23 +46,104 @@ class DataNodeHeader(object):
     def parse(s):
         if not isinstance(s, str):
             raise TypeError("must be a string")
-        reader = StringIO(s)
-        decoder = avro.io.BinaryDecoder(reader)
-        datum_reader = avro.io.DatumReader(writers_schema=DataNodeHeader.schema,
-                                           readers_schema=DataNodeHeader.schema)
-        return datum_reader.read(decoder)
+        if not s or ord(s[0])!=DataNodeHeader.VERSION:
+            return DataNodeHeader.parse_avro(s)
+        
+        length_unpack = DataNodeHeader.LENGTH.unpack_from
+        _, operation = DataNodeHeader.PREFIX.unpack_from(s)
+        offset = DataNodeHeader.PREFIX.size
+        
+        strings = []
+        for i in xrange(3):
+            length, = length_unpack(s, offset)
+            offset += 2
+            strings.append(s[offset:offset+length])
+            offset += length
+        
+        num_nodes, = length_unpack(s, offset)
+        offset += 2
+        nodes = []
+        for i in xrange(num_nodes):
+            length, = length_unpack(s, offset)
+            offset += 2
+            host = s[offset:offset+length]
+            offset += length
+            port, = length_unpack(s, offset)
+            offset += 2
+            nodes.append((host, port))
+
+        if offset!=len(s):
+            raise ValueError("Malformed DataNodeHeader.")
+        
+        block_id, coding_id, stream_id = strings
+        return {'operation':operation, 'block_id':block_id, 
+                'coding_id':coding_id, 'stream_id':stream_id, 'nodes':nodes}
+
+    @staticmethod
+    def parse_avro(s):
+        decoder = avro.io.BinaryDecoder(StringIO(s))
+        header = {}
+        for name, read, _ in DataNodeHeader.avro_fields:
+            header[name] = read(decoder)
+        nodes = header['nodes']
+        header['nodes'] = map(ast.literal_eval, nodes.split(';'))\
+                          if nodes else []
+        return header
     
     @staticmethod
-    def generate(operation, block_id=None, coding_id='', stream_id='', 
-                 nodes=''):
+    def generate_avro(operation, block_id=None, coding_id='', stream_id='', 
+                      nodes=()):
+        '''
+        Generates the former Avro header, understood by older DataNodes.
+        '''
+        datum = {'operation':operation, 'block_id':block_id, 
+                 'coding_id':coding_id, 'stream_id':stream_id,
+                 'nodes':';'.join(map(str, nodes))}
         writer = StringIO()
         encoder = avro.io.BinaryEncoder(writer)
-        datum_writer = avro.io.DatumWriter(writers_schema=DataNodeHeader.schema)
-        datum_writer.write({'operation':operation,'block_id':block_id,
-                            'coding_id':coding_id,'stream_id':stream_id,
-                            'nodes':nodes}, encoder)
-        return writer.getvalue() 
+        for name, _, write in DataNodeHeader.avro_fields:
+            write(encoder, datum[name])
+        return writer.getvalue()
+
+    @staticmethod
+    def _pack_string(parts, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        parts.append(DataNodeHeader.LENGTH.pack(len(s)))
+        parts.append(s)
+
+    @staticmethod
+    def generate(operation, block_id=None, coding_id='', stream_id='', 
+                 nodes=()):
+        '''
+        The 'nodes' are a sequence of (host, port) tuples.
+        '''
+        if isinstance(nodes, basestring):
+            raise TypeError("nodes must be a sequence of (host, port) tuples, "
+                            "not a string.")
+        parts = [DataNodeHeader.PREFIX.pack(DataNodeHeader.VERSION, operation)]
+        DataNodeHeader._pack_string(parts, block_id or '')
+        DataNodeHeader._pack_string(parts, coding_id)
+        DataNodeHeader._pack_string(parts, stream_id)
+        parts.append(DataNodeHeader.LENGTH.pack(len(nodes)))
+        for host, port in nodes:
+            DataNodeHeader._pack_string(parts, host)
+            parts.append(DataNodeHeader.LENGTH.pack(port))
+        return ''.join(parts)
     
+# Decoder and encoder methods of each DataNodeHeader.schema field, resolved
+# once: writer and reader schemas are the same and all fields are primitive,
+# so DatumReader/DatumWriter schema resolution is not needed for each header.
+_avro_primitives = {'int':('read_int', 'write_int'),
+                    'long':('read_long', 'write_long'),
+                    'string':('read_utf8', 'write_utf8')}
+DataNodeHeader.avro_fields = []
+for _field in DataNodeHeader.schema.fields:
+    _read, _write = _avro_primitives[_field.type.type]
+    DataNodeHeader.avro_fields.append((_field.name, 
+                                       getattr(avro.io.BinaryDecoder, _read),
+                                       getattr(avro.io.BinaryEncoder, _write)))
+
 class NameNodeHeader:
     OP_PING = 0
     OP_GETNODES = 1
@@ -1,14 +1,88 @@
+import os
 import sys
+import time
+import signal
+import errno
+import select
 import struct
+import numpy
 import commands
+import collections
+import gevent
+import gevent.lock
+import gevent.event
+import gevent.os
+import gevent.queue
 import gevent.server
 import gevent.socket
 import traceback
 import socket
 
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        # Python 2 needs the pysendfile package.
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+try:
+    # Python 2 sockets have no sendmsg: vectored sends use writev from libc.
+    import ctypes
+    import ctypes.util
+    class iovec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+    writev = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True).writev
+    writev.argtypes = [ctypes.c_int, ctypes.POINTER(iovec), ctypes.c_int]
+    writev.restype = ctypes.c_ssize_t
+except (OSError, AttributeError):
+    writev = None
+
 from common import ClassLogger
 from bufferedio import NetworkOutputStream, OutputStreamWriter, InputStream,\
-                       InputStreamReader, NetworkInputStream, IOBuffer
+                       InputStreamReader, NetworkInputStream, IOBuffer,\
+                       FileInputStream
+
+def send_vector(sock, chunks):
+    '''
+    Sends all the chunks through the socket with as few writev calls as
+    possible (IOV_MAX is 1024 in Linux), waiting in the hub when the socket
+    buffer is full.
+    '''
+    # Arrays over the chunks keep their memory alive while it is sent.
+    arrays = [numpy.asarray(chunk) if isinstance(chunk, (numpy.ndarray, 
+              memoryview)) else numpy.frombuffer(chunk, dtype=numpy.uint8) 
+              for chunk in chunks if len(chunk)>0]
+    fd = sock.fileno()
+    first = offset = 0
+    while first<len(arrays):
+        count = min(len(arrays)-first, 1024)
+        iov = (iovec*count)()
+        for i in xrange(count):
+            array = arrays[first+i]
+            skip = offset if i==0 else 0
+            iov[i].iov_base = array.ctypes.data+skip
+            iov[i].iov_len = len(array)-skip
+        sent = writev(fd, iov, count)
+        if sent<0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                gevent.socket.wait_write(fd, timeout=sock.gettimeout())
+            elif err!=errno.EINTR:
+                raise socket.error(err, os.strerror(err))
+            continue
+        if sent==0:
+            raise IOError("Connection lost while sending bytes.")
+        while sent>0:
+            left = len(arrays[first])-offset
+            if sent>=left:
+                sent -= left
+                first += 1
+                offset = 0
+            else:
+                offset += sent
+                sent = 0
 
 class NetworkHeader(object):
     ERROR = 1
@@ -18,6 +92,15 @@ class NetworkHeader(object):
     # and consequent buffers, each of them indicating its length too.
     STREAM_HEADER = 4  
     STREAM_BUFFER = 5
+    # First header of a connection carrying MultiplexedConnection frames.
+    MULTIPLEX = 6
+    # Sent before a request to keep the connection open after its ACK.
+    KEEP_ALIVE = 7
+    
+    # signed 1 byte integer (type) + signed 4 byte integer (length)
+    FORMAT = struct.Struct('!bi')
+    # signed 8 bytes integer
+    INTEGER_FORMAT = struct.Struct('!q')
 
 class NetworkException(Exception):
     def __init__(self, message='', trace=''):
@@ -33,6 +116,9 @@ class NetworkException(Exception):
         self.trace = '  dfs://%s:%d\n'%(node) + self.trace
 
     def serialize(self):
+        # Messages of unicode exceptions make the trace unicode.
+        if isinstance(self.trace, unicode):
+            return self.trace.encode('utf-8')
         return self.trace
 
     @classmethod
@@ -44,6 +130,9 @@ class NetworkException(Exception):
 
 @ClassLogger
 class NetworkEndpoint(object):
+    # Size of the read-ahead buffer used for headers and small messages.
+    recv_ahead_size = 4096
+
     def __init__(self, socket):
         self.socket = socket
         self.reading_stream = None
@@ -62,11 +151,41 @@ class NetworkEndpoint(object):
                                             "function.")
             self._send_bytes = self._send_bytes_iter
 
+        '''
+            Frame headers and payloads are coalesced by _send_vector, so
+            Nagle's algorithm would only delay the last segment of each
+            message. Without sendmsg the vector goes through writev.
+        '''
+        if hasattr(self.socket, 'sendmsg'):
+            self._send_vector = self._send_vector_sendmsg
+        elif writev!=None and hasattr(self.socket, 'fileno'):
+            self._send_vector = self._send_vector_writev
+        else:
+            self._send_vector = self._send_vector_sequential
+        self._set_nodelay()
+
         self._streamed = 0
         self._to_stream = 0
         self._partial_buffer = 0
+        self.keep_alive = False
+        
+        # Bytes in _rbuf[_rstart:_rend] are received but not consumed yet.
+        self._rbuf = bytearray(self.recv_ahead_size)
+        self._rmem = memoryview(self._rbuf)
+        self._rstart = 0
+        self._rend = 0
     
-    def new_writer(self, async=False):
+    def _set_nodelay(self):
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            if __debug__: self.logger.debug("Cannot set TCP_NODELAY.")
+
+    def new_writer(self, async=True):
+        '''
+        Streams are written from their own greenlet by default, so the
+        buffers queued meanwhile go out together in one vectored send.
+        '''
         return OutputStreamWriter(self.output_stream, async=async)
     
     def recv_stream(self):
@@ -75,26 +194,47 @@ class NetworkEndpoint(object):
             raise TypeError("An InputStream was expected.")
         return stream
 
-    def recv_reader(self, async=False):
-        return InputStreamReader(self.recv_stream(), async=async)
+    def recv_reader(self, async=False, **kwargs):
+        return InputStreamReader(self.recv_stream(), async=async, **kwargs)
+
+    def _recv_ahead(self, num_bytes):
+        '''
+        Makes sure there are at least 'num_bytes' in the read-ahead buffer.
+        Each recv fills as much of the buffer as possible, so a header and 
+        the beginning of its payload are usually received together.
+        '''
+        if self._rend-self._rstart>=num_bytes:
+            return
+        
+        if self._rstart==self._rend:
+            self._rstart = self._rend = 0
+        elif self._rstart+num_bytes>len(self._rbuf):
+            pending = self._rend-self._rstart
+            self._rbuf[:pending] = self._rbuf[self._rstart:self._rend]
+            self._rstart = 0
+            self._rend = pending
+
+        while self._rend-self._rstart<num_bytes:
+            received = self.socket.recv_into(self._rmem[self._rend:])
+            if received==0:
+                raise IOError("Connection lost while receiving bytes.")
+            self._rend += received
 
     def _recv_integer(self):
-        # signed 8 bytes integer
-        return struct.unpack('!q', self._recv_bytes(8))[0]
-    
-    def _send_integer(self, integer):
-        # signed 8 bytes integer
-        return self._send_bytes(struct.pack('!q', integer))
+        self._recv_ahead(NetworkHeader.INTEGER_FORMAT.size)
+        value, = NetworkHeader.INTEGER_FORMAT.unpack_from(self._rbuf,
+                                                          self._rstart)
+        self._rstart += NetworkHeader.INTEGER_FORMAT.size
+        return value
     
     def _recv_header(self):
-        raw_data = self._recv_bytes(5)
-        # signed 1 byte integer + signed 4 byte integer
-        return struct.unpack('!bi', raw_data) 
+        self._recv_ahead(NetworkHeader.FORMAT.size)
+        header = NetworkHeader.FORMAT.unpack_from(self._rbuf, self._rstart)
+        self._rstart += NetworkHeader.FORMAT.size
+        return header
 
     def _send_header(self, header_type, len_packet=0):
-        # signed 1 byte integer + signed 4 byte integer
-        data = struct.pack('!bi', header_type, len_packet)
-        self._send_bytes(data)
+        self._send_bytes(NetworkHeader.FORMAT.pack(header_type, len_packet))
     
     def _send_bytes_sendall(self, data):
         ret = self.socket.sendall(data)
@@ -107,6 +247,41 @@ class NetworkEndpoint(object):
             sent += self.socket.send(data[sent:])
         if __debug__: self.logger.debug("Sent %d bytes."%(sent)) 
 
+    def _send_vector_sendmsg(self, chunks):
+        chunks = [memoryview(chunk) for chunk in chunks]
+        while chunks:
+            # IOV_MAX is 1024 in Linux.
+            sent = self.socket.sendmsg(chunks[:1024])
+            if sent==0:
+                raise IOError("Connection lost while sending bytes.")
+            while sent>0:
+                if sent>=len(chunks[0]):
+                    sent -= len(chunks.pop(0))
+                else:
+                    chunks[0] = chunks[0][sent:]
+                    sent = 0
+
+    def _send_vector_writev(self, chunks):
+        send_vector(self.socket, chunks)
+
+    def _send_vector_sequential(self, chunks):
+        for chunk in chunks:
+            self._send_bytes(chunk)
+
+    def send_buffers(self, iobuffers):
+        '''
+        Sends several IOBuffers as STREAM_BUFFER frames in a single 
+        vectored send.
+        '''
+        if __debug__: self.logger.debug('Sending %d stream buffers', 
+                                        len(iobuffers))
+        chunks = []
+        for iobuffer in iobuffers:
+            chunks.append(NetworkHeader.FORMAT.pack(NetworkHeader.STREAM_BUFFER,
+                                                    iobuffer.length))
+            chunks.append(iobuffer.data())
+        self._send_vector(chunks)
+
     def _recv_error(self, error_len):
         raw_data = self._recv_bytes(error_len)
         error = NetworkException.unserialize(raw_data)
@@ -115,16 +290,23 @@ class NetworkEndpoint(object):
         raise error
 
     def _recv_bytes(self, num_bytes):
-        data = ''
-        old_len = 0
-        while len(data)<num_bytes:
-            data += self.socket.recv(num_bytes-old_len)
-            new_len = len(data)
-            if new_len==old_len:
+        if num_bytes<=len(self._rbuf):
+            self._recv_ahead(num_bytes)
+            data = self._rmem[self._rstart:self._rstart+num_bytes].tobytes()
+            self._rstart += num_bytes
+            return data
+
+        data = bytearray(num_bytes)
+        mem = memoryview(data)
+        received = self._rend-self._rstart
+        mem[:received] = self._rmem[self._rstart:self._rend]
+        self._rstart = self._rend = 0
+        while received<num_bytes:
+            new_recv = self.socket.recv_into(mem[received:])
+            if new_recv==0:
                 raise IOError("Connection lost while receiving bytes.")
-            old_len = new_len
-        assert len(data)==num_bytes
-        return data
+            received += new_recv
+        return str(data)
 
     def recv(self):
         try:
@@ -139,6 +321,9 @@ class NetworkEndpoint(object):
                 self.reading_stream = None
 
             packet_type, data_len = self._recv_header()
+            while packet_type==NetworkHeader.KEEP_ALIVE:
+                self.keep_alive = True
+                packet_type, data_len = self._recv_header()
             if __debug__: self.logger.debug("Received header: %d %d.",
                                             packet_type, data_len)
 
@@ -173,7 +358,15 @@ class NetworkEndpoint(object):
 
     def _fill(self, memview):
         nbytes = min(self._partial_buffer, len(memview))
-        received = self.socket.recv_into(memview[:nbytes])
+        buffered = self._rend-self._rstart
+        if buffered>0:
+            # Payload bytes that arrived together with the header.
+            received = min(buffered, nbytes)
+            memview[:received] = self._rmem[self._rstart:\
+                                            self._rstart+received]
+            self._rstart += received
+        else:
+            received = self.socket.recv_into(memview[:nbytes])
         if received == 0:
             raise IOError("Connection reset.")
         self._partial_buffer -= received 
@@ -229,13 +422,14 @@ class NetworkEndpoint(object):
         if isinstance(obj, NetworkException):
             if __debug__: self.logger.debug('Sending exception')
             data = obj.serialize()
-            self._send_header(NetworkHeader.ERROR, len(data))
-            self._send_bytes(data)
+            self._send_vector([NetworkHeader.FORMAT.pack(NetworkHeader.ERROR,
+                                                         len(data)), data])
 
         elif isinstance(obj, IOBuffer):
             if __debug__: self.logger.debug('Sending stream buffer')
-            self._send_header(NetworkHeader.STREAM_BUFFER, obj.length)
-            self._send_bytes(obj.data())
+            self._send_vector([NetworkHeader.FORMAT.pack(
+                               NetworkHeader.STREAM_BUFFER, obj.length), 
+                               obj.data()])
 
         elif isinstance(obj, InputStream):
             if __debug__: self.logger.debug('Sending stream header')
@@ -243,26 +437,364 @@ class NetworkEndpoint(object):
 
         elif isinstance(obj, str):
             if __debug__: self.logger.debug('Sending string')
-            self._send_header(NetworkHeader.STRING, len(obj))
-            self._send_bytes(obj)
+            self._send_vector([NetworkHeader.FORMAT.pack(NetworkHeader.STRING,
+                                                         len(obj)), obj])
             
         elif isinstance(obj, int) or isinstance(obj, long):
             if __debug__: self.logger.debug('Sending integer')
-            self._send_header(NetworkHeader.INTEGER)
-            self._send_integer(obj)
+            # Both fit in a single small message.
+            self._send_bytes(NetworkHeader.FORMAT.pack(NetworkHeader.INTEGER, 0)
+                             + struct.pack('!q', obj))
         
         else:
             raise TypeError('Invalid type.')
 
+    def can_sendfile(self, input_stream):
+        return sendfile!=None and isinstance(input_stream, FileInputStream)\
+               and hasattr(self.socket, 'fileno')
+
+    def send_file(self, input_stream, extent=64*1024*1024):
+        '''
+        Sends the remaining bytes of a FileInputStream using sendfile, so
+        file pages go from the page cache to the socket without being copied
+        to user space. Each 'extent' bytes are framed as one STREAM_BUFFER.
+        '''
+        if not self.can_sendfile(input_stream):
+            raise TypeError("Cannot sendfile this input stream.")
+
+        infd = input_stream.fileio.fileno()
+        outfd = self.socket.fileno()
+        offset = input_stream.fileio.tell()
+        while input_stream.bytes_left>0:
+            nbytes = min(input_stream.bytes_left, extent)
+            self._send_header(NetworkHeader.STREAM_BUFFER, nbytes)
+            sent = 0
+            while sent<nbytes:
+                try:
+                    num = sendfile(outfd, infd, offset+sent, nbytes-sent)
+                except (OSError, IOError) as e:
+                    if e.errno==errno.EAGAIN:
+                        gevent.socket.wait_write(outfd)
+                        continue
+                    raise
+                if num==0:
+                    raise IOError("Connection lost while sending file.")
+                sent += num
+            if __debug__: self.logger.debug("Sendfile sent %d bytes.", sent)
+            offset += sent
+            input_stream.bytes_left -= sent
+        input_stream.fileio.seek(offset)
+
     def local_address(self):
         ifconfig = commands.getoutput("/sbin/ifconfig")
         return ifconfig.split("\n")[1].split()[1][5:]
 
     def kill(self):
+        if self.socket==None:
+            # Already released or killed.
+            return
         if __debug__: self.logger.debug("Killing socket.")
-        self.socket.shutdown(socket.SHUT_WR)
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+        except socket.error:
+            # Already killed or never connected.
+            pass
         self.socket.close()
 
+class MultiplexedSocket(object):
+    '''
+    One stream of a MultiplexedConnection. It offers the subset of the
+    socket API used by NetworkEndpoint, so the usual framing runs unchanged
+    on top of it.
+    '''
+    def __init__(self, connection, stream_id):
+        self.connection = connection
+        self.stream_id = stream_id
+        # Pooled IOBuffers with the payloads received, the number of bytes
+        # received straight into the buffer 'waiting' for them, or None at
+        # the end of the stream.
+        self.queue = gevent.queue.Queue()
+        self.waiting = None
+        self.chunk = None
+        self.offset = 0
+        self.eof = False
+        self.shut = False
+        # Bytes the peer accepts before it grants more with a CREDIT frame,
+        # and the bytes consumed here that have not been granted back yet.
+        self.window = MultiplexedConnection.window
+        self.window_event = gevent.event.Event()
+        self.window_event.set()
+        self.consumed = 0
+        # The peer closed the stream: what is sent is dropped, unthrottled.
+        self.peer_closed = False
+
+    def deliver(self, data):
+        self.queue.put(data)
+
+    def grant(self, nbytes):
+        self.window += nbytes
+        if self.window>0:
+            self.window_event.set()
+
+    def wait_window(self):
+        while self.window<=0 and not self.peer_closed and\
+              not self.connection.closed:
+            self.window_event.clear()
+            self.window_event.wait()
+        if self.connection.closed:
+            raise IOError("Multiplexed connection is closed.")
+
+    def gettimeout(self):
+        return None
+
+    def setsockopt(self, *args):
+        pass
+
+    def recv_into(self, buff, nbytes=0):
+        nbytes = min(nbytes or len(buff), len(buff))
+        if self.chunk==None:
+            if self.eof:
+                return 0
+            if self.queue.empty():
+                # Nothing is queued: the next payload is received into 'buff'
+                # by the connection, without copies.
+                self.waiting = memoryview(buff)[:nbytes]
+            try:
+                data = self.queue.get()
+            finally:
+                self.waiting = None
+            if data==None:
+                self.eof = True
+                return 0
+            if isinstance(data, IOBuffer):
+                self.chunk = data
+                self.offset = 0
+
+        if self.chunk!=None:
+            num = min(self.chunk.length-self.offset, nbytes)
+            buff[:num] = self.chunk.mem[self.offset:self.offset+num]
+            self.offset += num
+            if self.offset==self.chunk.length:
+                self.chunk.free()
+                self.chunk = None
+        else:
+            num = data
+        self.consumed += num
+        if self.consumed>=MultiplexedConnection.window//2 and\
+           not self.connection.closed:
+            self.connection.send_frame(MultiplexedConnection.CREDIT,
+                                       self.stream_id, [], self.consumed)
+            self.consumed = 0
+        return num
+
+    def sendall(self, data):
+        data = memoryview(data)
+        while len(data)>0:
+            data = data[self.sendmsg([data]):]
+
+    def sendmsg(self, chunks):
+        '''
+        Sends the chunks, or as much of them as the window allows, and
+        returns the bytes sent.
+        '''
+        self.wait_window()
+        if not self.peer_closed:
+            room = self.window
+            fitting = []
+            for chunk in chunks:
+                if room<=0:
+                    break
+                chunk = memoryview(chunk)
+                if len(chunk)>room:
+                    chunk = chunk[:room]
+                fitting.append(chunk)
+                room -= len(chunk)
+            chunks = fitting
+        sent = self.connection.send_frame(MultiplexedConnection.DATA,
+                                          self.stream_id, chunks)
+        self.window -= sent
+        return sent
+
+    def shutdown(self, how):
+        if not self.shut:
+            self.shut = True
+            self.connection.send_frame(MultiplexedConnection.CLOSE,
+                                       self.stream_id, [])
+
+    def close(self):
+        self.connection.streams.pop(self.stream_id, None)
+        # Payloads not read are returned to the pool.
+        if self.chunk!=None:
+            self.chunk.free()
+            self.chunk = None
+        while not self.queue.empty():
+            data = self.queue.get_nowait()
+            if isinstance(data, IOBuffer):
+                data.free()
+
+@ClassLogger
+class MultiplexedConnection(object):
+    '''
+    Carries several streams over one TCP connection. Each frame starts with
+    its type, the stream id and the payload length. Clients share one
+    connection per (host, port) and open streams with increasing ids. The
+    server side calls 'on_new_stream' with a MultiplexedSocket for every new
+    stream id it receives.
+
+    Each stream sends up to 'window' bytes ahead of what its peer has read:
+    the reader grants them back with CREDIT frames (their length field is
+    the bytes granted), so a slow stream stops its sender instead of
+    queueing data here, and does not block the other streams.
+    '''
+    DATA = 1
+    CLOSE = 2
+    CREDIT = 3
+    # signed 1 byte integer (type) + 2 signed 4 byte integers (id, length)
+    FORMAT = struct.Struct('!bii')
+    window = 1024*1024
+    
+    connections = {}
+
+    @classmethod
+    def get(cls, address):
+        connection = cls.connections.get(address)
+        if connection==None or connection.closed:
+            sock = gevent.socket.create_connection(address, timeout=None)
+            sock.sendall(NetworkHeader.FORMAT.pack(NetworkHeader.MULTIPLEX, 0))
+            connection = cls(sock)
+            cls.connections[address] = connection
+        return connection
+
+    @classmethod
+    def accept(cls, sock, on_new_stream):
+        header = bytearray(NetworkHeader.FORMAT.size)
+        cls._recv_exact(sock, memoryview(header))
+        packet_type, _ = NetworkHeader.FORMAT.unpack_from(header)
+        if packet_type!=NetworkHeader.MULTIPLEX:
+            raise TypeError("Incompatible NetworkHeader value %d."\
+                            %(packet_type))
+        return cls(sock, on_new_stream)
+
+    @staticmethod
+    def _recv_exact(sock, memview):
+        received = 0
+        while received<len(memview):
+            num = sock.recv_into(memview[received:])
+            if num==0:
+                raise IOError("Connection lost while receiving bytes.")
+            received += num
+
+    def __init__(self, sock, on_new_stream=None):
+        self.socket = sock
+        self.on_new_stream = on_new_stream
+        self.streams = {}
+        self.last_id = 0
+        self.closed = False
+        self.lock = gevent.lock.Semaphore()
+        try:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except socket.error:
+            if __debug__: self.logger.debug("Cannot set TCP_NODELAY.")
+        self.process = gevent.spawn(self._run)
+
+    def open_stream(self):
+        if self.closed:
+            raise IOError("Multiplexed connection is closed.")
+        self.last_id += 1
+        stream = MultiplexedSocket(self, self.last_id)
+        self.streams[self.last_id] = stream
+        return stream
+
+    def send_frame(self, frame_type, stream_id, chunks, length=None):
+        if length==None:
+            length = sum(len(chunk) for chunk in chunks)
+        header = self.FORMAT.pack(frame_type, stream_id, length)
+        with self.lock:
+            if writev!=None:
+                send_vector(self.socket, [header]+list(chunks))
+            else:
+                self.socket.sendall(header)
+                for chunk in chunks:
+                    self.socket.sendall(chunk)
+        return length
+
+    def _drop(self, length):
+        if length>0:
+            iobuffer = IOBuffer.pool.acquire(None, length)
+            try:
+                self._recv_exact(self.socket, iobuffer.mem)
+            finally:
+                iobuffer.free()
+
+    def _recv_payload(self, stream, length):
+        '''
+        Receives a DATA payload into the buffer of the reader waiting on the
+        stream, if any, and the rest of it into a pooled IOBuffer.
+        '''
+        if stream.waiting!=None and length>0:
+            num = min(len(stream.waiting), length)
+            self._recv_exact(self.socket, stream.waiting[:num])
+            stream.waiting = None
+            stream.deliver(num)
+            length -= num
+        if length>0:
+            iobuffer = IOBuffer.pool.acquire(None, length)
+            try:
+                self._recv_exact(self.socket, iobuffer.mem)
+            except:
+                iobuffer.free()
+                raise
+            iobuffer.length = length
+            stream.deliver(iobuffer)
+
+    def _run(self):
+        header = bytearray(self.FORMAT.size)
+        header_mem = memoryview(header)
+        try:
+            while True:
+                self._recv_exact(self.socket, header_mem)
+                frame_type, stream_id, length = self.FORMAT.unpack_from(header)
+                if frame_type==self.CREDIT:
+                    stream = self.streams.get(stream_id)
+                    if stream!=None:
+                        stream.grant(length)
+                    continue
+                stream = self.streams.get(stream_id)
+                if stream==None:
+                    # Streams are only opened by data frames with new ids,
+                    # frames of closed streams are dropped.
+                    if self.on_new_stream==None or stream_id<=self.last_id\
+                       or frame_type!=self.DATA:
+                        self._drop(length)
+                        continue
+                    self.last_id = stream_id
+                    stream = MultiplexedSocket(self, stream_id)
+                    self.streams[stream_id] = stream
+                    gevent.spawn(self.on_new_stream, stream)
+
+                if frame_type==self.DATA:
+                    self._recv_payload(stream, length)
+                elif frame_type==self.CLOSE:
+                    self.streams.pop(stream_id, None)
+                    stream.deliver(None)
+                    stream.peer_closed = True
+                    stream.window_event.set()
+                else:
+                    raise TypeError("Invalid multiplexed frame type %d."\
+                                    %(frame_type))
+        
+        except Exception as e:
+            if __debug__: self.logger.debug("Multiplexed connection closed: "
+                                            "%s", unicode(e))
+
+        finally:
+            self.closed = True
+            for stream in self.streams.itervalues():
+                stream.deliver(None)
+                stream.window_event.set()
+            self.streams.clear()
+            self.socket.close()
+
 @ClassLogger
 class ServerHandle(NetworkEndpoint):
     def __init__(self, server, socket, address):
@@ -274,6 +806,25 @@ class ServerHandle(NetworkEndpoint):
         raise NotImplementedError()
 
     def handle(self):
+        try:
+            while self._handle_query() and self._wait_query():
+                if __debug__: self.logger.debug("Reusing kept alive "
+                                                "connection.")
+        finally:
+            try:
+                if __debug__: self.logger.debug("Closing connection.")
+                self.socket.shutdown(socket.SHUT_WR)
+                self.socket.close()
+            except Exception as e:
+                if __debug__: self.logger.debug("ERROR: %s",unicode(e))
+                pass
+
+    def _handle_query(self):
+        '''
+        Processes one query and sends its ACK. Returns True if the client
+        asked to keep the connection alive and it is still usable.
+        '''
+        self.keep_alive = False
         send_ack = True
         response = False
         try:
@@ -303,19 +854,41 @@ class ServerHandle(NetworkEndpoint):
             try:
                 if send_ack:
                     self.send(0 if response else -1)
-                if __debug__: self.logger.debug("Closing connection.")
-                self.socket.shutdown(socket.SHUT_WR)
-                self.socket.close()
             except Exception as e:
                 if __debug__: self.logger.debug("ERROR: %s",unicode(e))
-                pass
+                response = False
+
+        return response and self.keep_alive
 
+    def _wait_query(self):
+        '''
+        Waits until the next query of a kept alive connection arrives. Returns
+        False if the client closes it or it stays idle too long.
+        '''
+        try:
+            with gevent.Timeout(self.server.keep_alive_timeout, False):
+                self._recv_ahead(1)
+                return True
+            if __debug__: self.logger.debug("Kept alive connection timeout.")
+            return False
+        except (IOError, socket.error):
+            return False
+
+@ClassLogger
 class Server():
+    # Seconds a kept alive connection waits for its next query.
+    keep_alive_timeout = 60
+    # Workers exiting sooner than this after being forked are restarted
+    # after this delay, so a failing worker does not spin the supervisor.
+    restart_delay = 1
+    backlog = 256
+
     def __init__(self, handle_class=ServerHandle, addr='', port=7777):
         self.address = (addr,port)
         self.server = gevent.server.StreamServer(self.address,
                                                  self.netser_handle)
         self.handle_class = handle_class
+        self.workers = {}
 
     '''
     def init_socket(self):
@@ -323,22 +896,196 @@ class Server():
         super(Server, self).init_socket()
     '''
         
-    def serve(self):
-        self.server.serve_forever()
+    def serve(self, workers=1):
+        if workers>1:
+            self.supervise(workers)
+        else:
+            self.server.serve_forever()
+
+    def listener(self):
+        '''
+        Listening socket of a worker. With SO_REUSEPORT each worker binds its
+        own socket and the kernel balances the connections among them.
+        '''
+        sock = gevent.socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(self.address)
+        sock.listen(self.backlog)
+        return sock
+
+    def supervise(self, workers):
+        '''
+        Pre-fork mode: keeps 'workers' processes serving the same port,
+        restarting the ones that exit, until SIGTERM or SIGINT.
+        '''
+        self.reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        if not self.reuse_port:
+            # Workers inherit and accept on the supervisor's socket.
+            self.server.init_socket()
+        self.logger.info("Supervising %d workers on port %d (SO_REUSEPORT: "
+                         "%s).", workers, self.address[1], self.reuse_port)
+
+        self.exited = gevent.queue.Queue()
+        self.term = gevent.signal_handler(signal.SIGTERM, self.exited.put, None)
+        try:
+            for i in xrange(workers):
+                self.fork_worker()
+            while True:
+                watcher = self.exited.get()
+                if watcher==None:
+                    break
+                started = self.workers.pop(watcher.pid)
+                self.logger.warning("Worker %d exited with status %d.",
+                                    watcher.pid, watcher.rstatus)
+                if time.time()-started<self.restart_delay:
+                    gevent.sleep(self.restart_delay)
+                self.fork_worker()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.term.cancel()
+            self.stop_workers()
+
+    def fork_worker(self):
+        # The child watchers are the only thing keeping the supervisor's hub
+        # alive when there is nothing else to wait for (isolated DataNodes).
+        pid = gevent.os.fork_and_watch(self.exited.put, ref=True)
+        if pid==0:
+            # Inside the worker, which must never return to supervise().
+            status = 0
+            try:
+                self.term.cancel()
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                self.workers.clear()
+                self.init_worker()
+                if self.reuse_port:
+                    self.server.socket = self.listener()
+                self.server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            except Exception:
+                self.logger.error("Worker %d failed:\n%s", os.getpid(),
+                                  traceback.format_exc())
+                status = 1
+            finally:
+                os._exit(status)
+
+        if __debug__: self.logger.debug("Forked worker %d.", pid)
+        self.workers[pid] = time.time()
+
+    def init_worker(self):
+        '''
+        Called in each worker process after fork.
+        '''
+        pass
+
+    def stop_workers(self):
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        for pid in self.workers.keys():
+            try:
+                gevent.os.waitpid(pid, 0)
+            except OSError:
+                pass
+        self.workers.clear()
 
     def netser_handle(self, s, address):
-        server_handle = self.handle_class(self, s, address)
-        server_handle.handle()
+        if s.recv(1, socket.MSG_PEEK)==chr(NetworkHeader.MULTIPLEX):
+            if __debug__: self.logger.debug("New multiplexed connection.")
+            on_new_stream = lambda stream: self.handle_class(self, stream, 
+                                                             address).handle()
+            connection = MultiplexedConnection.accept(s, on_new_stream)
+            connection.process.join()
+        else:
+            server_handle = self.handle_class(self, s, address)
+            server_handle.handle()
+
+@ClassLogger
+class ConnectionPool(object):
+    '''
+    Idle connections of pooled Clients, by address. Connections idle for 
+    more than 'idle_timeout' seconds, or that are readable (closed by the
+    server) when requested, are discarded.
+    '''
+    def __init__(self, max_idle=8, idle_timeout=30):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.idle = collections.defaultdict(list)
+
+    def _healthy(self, sock):
+        try:
+            readable, _, _ = select.select([sock.fileno()], [], [], 0)
+            return not readable
+        except (select.error, socket.error):
+            return False
+
+    def acquire(self, address):
+        idle = self.idle[address]
+        now = time.time()
+        while idle:
+            idle_since, sock = idle.pop()
+            if now-idle_since<self.idle_timeout and self._healthy(sock):
+                if __debug__: self.logger.debug("Reusing connection to %s.",
+                                                repr(address))
+                return sock
+            sock.close()
+        return None
+
+    def release(self, address, sock):
+        idle = self.idle[address]
+        now = time.time()
+        while idle and now-idle[0][0]>=self.idle_timeout:
+            idle.pop(0)[1].close()
+        if len(idle)<self.max_idle:
+            idle.append((now, sock))
+        else:
+            sock.close()
 
 @ClassLogger
 class Client(NetworkEndpoint):
-    def __init__(self, addr, port):
+    pool = ConnectionPool()
+
+    def __init__(self, addr, port, multiplexed=False, pooled=False):
+        '''
+        A 'multiplexed' client opens a new stream in the connection shared by
+        all the multiplexed clients of the process to the same address.
+        A 'pooled' client reuses an idle connection from Client.pool, and 
+        release() gives it back once the request has been acknowledged.
+        '''
         self.address = (addr, port)
+        self.pooled = pooled and not multiplexed
         try:
-            socket = gevent.socket.create_connection(self.address, timeout=None)
+            socket = None
+            if multiplexed:
+                socket = MultiplexedConnection.get(self.address).open_stream()
+            elif self.pooled:
+                socket = Client.pool.acquire(self.address)
+            if socket==None:
+                socket = gevent.socket.create_connection(self.address, 
+                                                         timeout=None)
         except:
             raise IOError("Cannot connect to "+unicode(self.address))
         NetworkEndpoint.__init__(self, socket)
+        if self.pooled:
+            self._send_header(NetworkHeader.KEEP_ALIVE)
+
+    def release(self):
+        '''
+        Closes the connection, or returns it to the pool if the client is
+        pooled and nothing is left to be received.
+        '''
+        if self.socket==None:
+            return
+        if self.pooled and self._partial_buffer==0 and\
+           self._rstart==self._rend:
+            Client.pool.release(self.address, self.socket)
+        else:
+            self.socket.close()
+        self.socket = None
  
     def assert_ack(self):
         ack = self.recv()
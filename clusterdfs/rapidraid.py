@@ -1,434 +1,356 @@
 from clusterdfs.common import ClassLogger
 from clusterdfs.coding import NetCodingOperations, NetCodingResolver,\
-                              RemoteNetCodingReader
+                              RemoteNetCodingReader, CodingException
 
 import re
+import random
+import itertools
 import galoisbuffer
 
-'''
-bf = 16
-xis = [48386, 55077, 40589, 63304, 49062, 47871, 17507, 49390,
-        54054, 45897, 55796, 27611, 50294, 30336, 882, 60087,
-        56842, 14836, 7618, 32265, 22869, 38138]
-psis = [11950, 26509, 16377, 40200, 35199, 3729, 10098, 16621,
-         3878, 45829, 1937, 60293, 38528, 31094, 7594, 45107,
-         15330, 63820, 41913, 20615, 58324, 16983]
-'''
+# Code parameters: n coded blocks of k parts, in GF(2^bf). Any 'failures' lost
+# nodes but the unavoidable() sets can be decoded: GF(2^8) has no such 
+# coefficients for the n-k=5 failures of a (16, 11) code. The coefficients
+# are drawn by choose_coefficients() from a Random seeded with 'seed', so 
+# every node derives the same ones.
+n = 16
+k = 11
 bf = 8
-xis = [141, 139, 79, 152, 152, 243, 2, 37, 149, 189, 174, 
-       149, 237, 31, 198, 15, 45, 138, 246, 100, 101, 16]
-psis = [129, 207, 158, 56, 171, 247, 145, 139, 137, 211, 190,
-        230, 140, 177, 75, 47, 94, 60, 244, 69, 190, 167]
-
-
-xisi = map(lambda x: galoisbuffer.inverse_val(x, bitfield=bf), xis)
-           
-psisi = map(lambda x: galoisbuffer.inverse_val(x, bitfield=bf), psis)
-
-# Decoding operations:
-
-dec_node0_aux = NetCodingOperations('dec_node0_aux', output='stream')
-dec_node0_aux.add(('POP','queue','temp'))
-dec_node0_aux.add(('COPY','stream','temp'))
-
-dec_node1_aux = NetCodingOperations('dec_node1_aux', output='stream')
-dec_node1_aux.add(('POP','queue','temp'))
-dec_node1_aux.add(('COPY','stream','temp'))
-
-dec_node2_aux = NetCodingOperations('dec_node2_aux', output='stream')
-dec_node2_aux.add(('POP','queue','temp'))
-dec_node2_aux.add(('COPY','stream','temp'))
-
-dec_node3_aux = NetCodingOperations('dec_node3_aux', output='stream')
-dec_node3_aux.add(('POP','queue','temp'))
-dec_node3_aux.add(('COPY','stream','temp'))
-
-dec_node4_aux = NetCodingOperations('dec_node4_aux', output='stream')
-dec_node4_aux.add(('POP','queue','temp'))
-dec_node4_aux.add(('COPY','stream','temp'))
-
-dec_node5_aux = NetCodingOperations('dec_node5_aux', output='stream')
-dec_node5_aux.add(('POP','queue','temp'))
-dec_node5_aux.add(('COPY','stream','temp'))
-
-# Decoding Operations:
-
-dec_node0 = NetCodingOperations('dec_node0', [('coded0', 'r'), ('orig0', 'w')],
-                                output='stream')
-dec_node0.add(('LOAD','temp','coded0'))
-dec_node0.add(('MULT', 'temp', xisi[0], 'temp'))
-dec_node0.add(('MULT', 'stream', psis[0], 'temp'))
-dec_node0.add(('WRITE', 'temp', 'orig0'))
-dec_node0.add(('PUSH', 'queue', 'temp'))
-
-dec_node1 = NetCodingOperations('dec_node1', [('coded1', 'r'), ('orig1', 'w'), 
-                                              ('dec_node0', 'r')], output='stream')
-dec_node1.add(('LOAD','temp','coded1'))
-dec_node1.add(('LOAD','prev','dec_node0'))
-dec_node1.add(('IADD', 'temp', 'prev'))
-dec_node1.add(('MULT', 'temp', xisi[1], 'temp'))
-dec_node1.add(('WRITE', 'temp', 'orig1'))
-dec_node1.add(('PUSH', 'queue', 'temp'))
-dec_node1.add(('COPY', 'stream', 'prev'))
-dec_node1.add(('MULADD', 'stream', psis[1],'temp'))
-
-dec_node2 = NetCodingOperations('dec_node2', [('coded2', 'r'), ('orig2', 'w'), 
-                                              ('dec_node1', 'r')], output='stream')
-dec_node2.add(('LOAD','temp','coded2'))
-dec_node2.add(('LOAD','prev','dec_node1'))
-dec_node2.add(('IADD', 'temp', 'prev'))
-dec_node2.add(('MULT', 'temp', xisi[2], 'temp'))
-dec_node2.add(('WRITE', 'temp', 'orig2'))
-dec_node2.add(('PUSH', 'queue', 'temp'))
-dec_node2.add(('COPY', 'stream', 'prev'))
-dec_node2.add(('MULADD', 'stream', psis[2],'temp'))
-
-dec_node3 = NetCodingOperations('dec_node3', [('coded3', 'r'), ('orig3', 'w'), 
-                                              ('dec_node2', 'r')], output='stream')
-dec_node3.add(('LOAD','temp','coded3'))
-dec_node3.add(('LOAD','prev','dec_node2'))
-dec_node3.add(('IADD', 'temp', 'prev'))
-dec_node3.add(('MULT', 'temp', xisi[3], 'temp'))
-dec_node3.add(('WRITE', 'temp', 'orig3'))
-dec_node3.add(('PUSH', 'queue', 'temp'))
-dec_node3.add(('COPY', 'stream', 'prev'))
-dec_node3.add(('MULADD', 'stream', psis[3],'temp'))
-
-dec_node4 = NetCodingOperations('dec_node4', [('coded4', 'r'), ('orig4', 'w'), 
-                                              ('dec_node3', 'r')], output='stream')
-dec_node4.add(('LOAD','temp','coded4'))
-dec_node4.add(('LOAD','prev','dec_node3'))
-dec_node4.add(('IADD', 'temp', 'prev'))
-dec_node4.add(('MULT', 'temp', xisi[4], 'temp'))
-dec_node4.add(('WRITE', 'temp', 'orig4'))
-dec_node4.add(('PUSH', 'queue', 'temp'))
-dec_node4.add(('COPY', 'stream', 'prev'))
-dec_node4.add(('MULADD', 'stream', psis[4],'temp'))
-
-dec_node5 = NetCodingOperations('dec_node5', [('coded5', 'r'), ('orig5', 'w'), 
-                                              ('dec_node4', 'r'), 
-                                              ('dec_node0_aux', 'r')], 
-                                output='stream')
-dec_node5.add(('LOAD','temp','coded5'))
-dec_node5.add(('LOAD','prev','dec_node4'))
-dec_node5.add(('LOAD','prevaux','dec_node0_aux'))
-dec_node5.add(('IADD', 'temp', 'prev'))
-dec_node5.add(('MULADD', 'temp', xis[5], 'prevaux'))
-dec_node5.add(('MULT', 'temp', xisi[6], 'temp'))
-dec_node5.add(('WRITE', 'temp', 'orig5'))
-dec_node5.add(('PUSH', 'queue', 'temp'))
-dec_node5.add(('COPY', 'stream', 'prev'))
-dec_node5.add(('MULADD', 'stream', psis[5],'prevaux'))
-dec_node5.add(('MULADD', 'stream', psis[6],'temp'))
-
-dec_node6 = NetCodingOperations('dec_node6', [('coded6', 'r'), ('orig6', 'w'), 
-                                              ('dec_node5', 'r'), 
-                                              ('dec_node1_aux', 'r')], 
-                                output='stream')
-dec_node6.add(('LOAD','temp','coded6'))
-dec_node6.add(('LOAD','prev','dec_node5'))
-dec_node6.add(('LOAD','prevaux','dec_node1_aux'))
-dec_node6.add(('IADD', 'temp', 'prev'))
-dec_node6.add(('MULADD', 'temp', xis[7], 'prevaux'))
-dec_node6.add(('MULT', 'temp', xisi[8], 'temp'))
-dec_node6.add(('WRITE', 'temp', 'orig6'))
-dec_node6.add(('COPY', 'stream', 'prev'))
-dec_node6.add(('MULADD', 'stream', psis[7],'prevaux'))
-dec_node6.add(('MULADD', 'stream', psis[8],'temp'))
-
-dec_node7 = NetCodingOperations('dec_node7', [('coded7', 'r'), ('orig7', 'w'), 
-                                              ('dec_node6', 'r'), 
-                                              ('dec_node2_aux', 'r')], 
-                                output='stream')
-dec_node7.add(('LOAD','temp','coded7'))
-dec_node7.add(('LOAD','prev','dec_node6'))
-dec_node7.add(('LOAD','prevaux','dec_node2_aux'))
-dec_node7.add(('IADD', 'temp', 'prev'))
-dec_node7.add(('MULADD', 'temp', xis[9], 'prevaux'))
-dec_node7.add(('MULT', 'temp', xisi[10], 'temp'))
-dec_node7.add(('WRITE', 'temp', 'orig7'))
-dec_node7.add(('COPY', 'stream', 'prev'))
-dec_node7.add(('MULADD', 'stream', psis[9],'prevaux'))
-dec_node7.add(('MULADD', 'stream', psis[10],'temp'))
-
-dec_node8 = NetCodingOperations('dec_node8', [('coded8', 'r'), ('orig8', 'w'), 
-                                              ('dec_node7', 'r'), 
-                                              ('dec_node3_aux', 'r')], 
-                                output='stream')
-dec_node8.add(('LOAD','temp','coded8'))
-dec_node8.add(('LOAD','prev','dec_node7'))
-dec_node8.add(('LOAD','prevaux','dec_node3_aux'))
-dec_node8.add(('IADD', 'temp', 'prev'))
-dec_node8.add(('MULADD', 'temp', xis[11], 'prevaux'))
-dec_node8.add(('MULT', 'temp', xisi[12], 'temp'))
-dec_node8.add(('WRITE', 'temp', 'orig8'))
-dec_node8.add(('COPY', 'stream', 'prev'))
-dec_node8.add(('MULADD', 'stream', psis[11],'prevaux'))
-dec_node8.add(('MULADD', 'stream', psis[12],'temp'))
-
-dec_node9 = NetCodingOperations('dec_node9', [('coded9', 'r'), ('orig9', 'w'), 
-                                              ('dec_node8', 'r'), 
-                                              ('dec_node4_aux', 'r')], 
-                                output='stream')
-dec_node9.add(('LOAD','temp','coded9'))
-dec_node9.add(('LOAD','prev','dec_node8'))
-dec_node9.add(('LOAD','prevaux','dec_node4_aux'))
-dec_node9.add(('IADD', 'temp', 'prev'))
-dec_node9.add(('MULADD', 'temp', xis[13], 'prevaux'))
-dec_node9.add(('MULT', 'temp', xisi[14], 'temp'))
-dec_node9.add(('WRITE', 'temp', 'orig9'))
-dec_node9.add(('COPY', 'stream', 'prev'))
-dec_node9.add(('MULADD', 'stream', psis[13],'prevaux'))
-dec_node9.add(('MULADD', 'stream', psis[14],'temp'))
-
-dec_node10 = NetCodingOperations('dec_node10', [('coded10', 'r'), 
-                                                ('orig10', 'w'), 
-                                                ('dec_node9', 'r'), 
-                                                ('dec_node5_aux', 'r')])
-dec_node10.add(('LOAD','temp','coded10'))
-dec_node10.add(('LOAD','prev','dec_node9'))
-dec_node10.add(('LOAD','prevaux','dec_node5_aux'))
-dec_node10.add(('IADD', 'temp', 'prev'))
-dec_node10.add(('MULADD', 'temp', xis[15], 'prevaux'))
-dec_node10.add(('MULT', 'temp', xisi[16], 'temp'))
-dec_node10.add(('WRITE', 'temp', 'orig10'))
-
-# Encoding operations:
-
-enc_node0 = NetCodingOperations('enc_node0', [('part0', 'r'), ('coded0', 'w')], 
-                                output='stream')
-enc_node0.add(('LOAD', 'temp', 'part0'))
-enc_node0.add(('MULT', 'stream', psis[0], 'temp'))
-#enc_node0.add(('MULT', 'temp', xis[0], 'temp'))
-enc_node0.add(('WRITE', 'temp', 'coded0'))
-
-enc_node1 = NetCodingOperations('enc_node1', [('part1', 'r'), ('coded1', 'w'), 
-                                              ('enc_node0','r')], 
-                                output='stream')
-enc_node1.add(('LOAD', 'local', 'part1'))
-enc_node1.add(('LOAD', 'prev', 'enc_node0'))
-enc_node1.add(('COPY', 'stream', 'prev'))
-enc_node1.add(('MULADD', 'stream', psis[1], 'local'))
-enc_node1.add(('MULADD', 'prev', xis[1], 'local'))
-enc_node1.add(('WRITE', 'prev', 'coded1'))
-
-enc_node2 = NetCodingOperations('enc_node2', [('part2', 'r'), ('coded2', 'w'), 
-                                              ('enc_node1','r')], 
-                                output='stream')
-enc_node2.add(('LOAD', 'local', 'part2'))
-enc_node2.add(('LOAD', 'prev', 'enc_node1'))
-enc_node2.add(('COPY', 'stream', 'prev'))
-enc_node2.add(('MULADD', 'stream', psis[2], 'local'))
-enc_node2.add(('MULADD', 'prev', xis[2], 'local'))
-enc_node2.add(('WRITE', 'prev', 'coded2'))
-
-enc_node3 = NetCodingOperations('enc_node3', [('part3', 'r'), ('coded3', 'w'), 
-                                              ('enc_node2','r')], 
-                                output='stream')
-enc_node3.add(('LOAD', 'local', 'part3'))
-enc_node3.add(('LOAD', 'prev', 'enc_node2'))
-enc_node3.add(('COPY', 'stream', 'prev'))
-enc_node3.add(('MULADD', 'stream', psis[3], 'local'))
-enc_node3.add(('MULADD', 'prev', xis[3], 'local'))
-enc_node3.add(('WRITE', 'prev', 'coded3'))
-
-enc_node4 = NetCodingOperations('enc_node4', [('part4', 'r'), ('coded4', 'w'), 
-                                              ('enc_node3','r')], 
-                                output='stream')
-enc_node4.add(('LOAD', 'local', 'part4'))
-enc_node4.add(('LOAD', 'prev', 'enc_node3'))
-enc_node4.add(('COPY', 'stream', 'prev'))
-enc_node4.add(('MULADD', 'stream', psis[4], 'local'))
-enc_node4.add(('MULADD', 'prev', xis[4], 'local'))
-enc_node4.add(('WRITE', 'prev', 'coded4'))
-
-enc_node5 = NetCodingOperations('enc_node5', [('part5', 'r'), ('part0', 'r'), 
-                                              ('coded5', 'w'), 
-                                              ('enc_node4','r')], 
-                                output='stream')
-enc_node5.add(('LOAD', 'local0', 'part0'))
-enc_node5.add(('LOAD', 'local5', 'part5'))
-enc_node5.add(('LOAD', 'prev', 'enc_node4'))
-enc_node5.add(('COPY', 'stream', 'prev'))
-enc_node5.add(('MULADD', 'stream', psis[5], 'local0'))
-enc_node5.add(('MULADD', 'stream', psis[6], 'local5'))
-enc_node5.add(('MULADD', 'prev', xis[5], 'local0'))
-enc_node5.add(('MULADD', 'prev', xis[6], 'local5'))
-enc_node5.add(('WRITE', 'prev', 'coded5'))
-
-enc_node6 = NetCodingOperations('enc_node6', [('part6', 'r'), ('part1', 'r'), 
-                                              ('coded6', 'w'), 
-                                              ('enc_node5','r')], 
-                                output='stream')
-enc_node6.add(('LOAD', 'local1', 'part1'))
-enc_node6.add(('LOAD', 'local6', 'part6'))
-enc_node6.add(('LOAD', 'prev', 'enc_node5'))
-enc_node6.add(('COPY', 'stream', 'prev'))
-enc_node6.add(('MULADD', 'stream', psis[7], 'local1'))
-enc_node6.add(('MULADD', 'stream', psis[8], 'local6'))
-enc_node6.add(('MULADD', 'prev', xis[7], 'local1'))
-enc_node6.add(('MULADD', 'prev', xis[8], 'local6'))
-enc_node6.add(('WRITE', 'prev', 'coded6'))
-
-enc_node7 = NetCodingOperations('enc_node7', [('part7', 'r'), ('part2', 'r'), 
-                                              ('coded7', 'w'), 
-                                              ('enc_node6','r')], 
-                                output='stream')
-enc_node7.add(('LOAD', 'local2', 'part2'))
-enc_node7.add(('LOAD', 'local7', 'part7'))
-enc_node7.add(('LOAD', 'prev', 'enc_node6'))
-enc_node7.add(('COPY', 'stream', 'prev'))
-enc_node7.add(('MULADD', 'stream', psis[9], 'local2'))
-enc_node7.add(('MULADD', 'stream', psis[10], 'local7'))
-enc_node7.add(('MULADD', 'prev', xis[9], 'local2'))
-enc_node7.add(('MULADD', 'prev', xis[10], 'local7'))
-enc_node7.add(('WRITE', 'prev', 'coded7'))
-
-enc_node8 = NetCodingOperations('enc_node8', [('part8', 'r'), ('part3', 'r'), 
-                                              ('coded8', 'w'),
-                                              ('enc_node7','r')], 
-                                output='stream')
-enc_node8.add(('LOAD', 'local3', 'part3'))
-enc_node8.add(('LOAD', 'local8', 'part8'))
-enc_node8.add(('LOAD', 'prev', 'enc_node7'))
-enc_node8.add(('COPY', 'stream', 'prev'))
-enc_node8.add(('MULADD', 'stream', psis[11], 'local3'))
-enc_node8.add(('MULADD', 'stream', psis[12], 'local8'))
-enc_node8.add(('MULADD', 'prev', xis[11], 'local3'))
-enc_node8.add(('MULADD', 'prev', xis[12], 'local8'))
-enc_node8.add(('WRITE', 'prev', 'coded8'))
-
-enc_node9 = NetCodingOperations('enc_node9', [('part9', 'r'), ('part4', 'r'), 
-                                              ('coded9', 'w'), 
-                                              ('enc_node8','r')], 
-                                output='stream')
-enc_node9.add(('LOAD', 'local4', 'part4'))
-enc_node9.add(('LOAD', 'local9', 'part9'))
-enc_node9.add(('LOAD', 'prev', 'enc_node8'))
-enc_node9.add(('COPY', 'stream', 'prev'))
-enc_node9.add(('MULADD', 'stream', psis[13], 'local4'))
-enc_node9.add(('MULADD', 'stream', psis[14], 'local9'))
-enc_node9.add(('MULADD', 'prev', xis[13], 'local4'))
-enc_node9.add(('MULADD', 'prev', xis[14], 'local9'))
-enc_node9.add(('WRITE', 'prev', 'coded9'))
-
-enc_node10 = NetCodingOperations('enc_node10', [('part10', 'r'), ('part5', 'r'), 
-                                                ('coded10', 'w'), 
-                                                ('enc_node9','r')], 
-                                 output='stream')
-enc_node10.add(('LOAD', 'local5', 'part5'))
-enc_node10.add(('LOAD', 'local10', 'part10'))
-enc_node10.add(('LOAD', 'prev', 'enc_node9'))
-enc_node10.add(('COPY', 'stream', 'prev'))
-enc_node10.add(('MULADD', 'stream', psis[15], 'local5'))
-enc_node10.add(('MULADD', 'stream', psis[16], 'local10'))
-enc_node10.add(('MULADD', 'prev', xis[15], 'local5'))
-enc_node10.add(('MULADD', 'prev', xis[16], 'local10'))
-enc_node10.add(('WRITE', 'prev', 'coded10'))
-
-enc_node11 = NetCodingOperations('enc_node11', [('part6', 'r'), 
-                                                ('coded11', 'w'), 
-                                                ('enc_node10','r')], 
-                                 output='stream')
-enc_node11.add(('LOAD', 'local', 'part6'))
-enc_node11.add(('LOAD', 'prev', 'enc_node10'))
-enc_node11.add(('COPY', 'stream', 'prev'))
-enc_node11.add(('MULADD', 'stream', psis[17], 'local'))
-enc_node11.add(('MULADD', 'prev', xis[17], 'local'))
-enc_node11.add(('WRITE', 'prev', 'coded11'))
-
-enc_node12 = NetCodingOperations('enc_node12', [('part7', 'r'), 
-                                                ('coded12', 'w'), 
-                                                ('enc_node11','r')], 
-                                 output='stream')
-enc_node12.add(('LOAD', 'local', 'part7'))
-enc_node12.add(('LOAD', 'prev', 'enc_node11'))
-enc_node12.add(('COPY', 'stream', 'prev'))
-enc_node12.add(('MULADD', 'stream', psis[18], 'local'))
-enc_node12.add(('MULADD', 'prev', xis[18], 'local'))
-enc_node12.add(('WRITE', 'prev', 'coded12'))
-
-enc_node13 = NetCodingOperations('enc_node13', [('part8', 'r'), 
-                                                ('coded13', 'w'), 
-                                                ('enc_node12','r')], 
-                                 output='stream')
-enc_node13.add(('LOAD', 'local', 'part8'))
-enc_node13.add(('LOAD', 'prev', 'enc_node12'))
-enc_node13.add(('COPY', 'stream', 'prev'))
-enc_node13.add(('MULADD', 'stream', psis[19], 'local'))
-enc_node13.add(('MULADD', 'prev', xis[19], 'local'))
-enc_node13.add(('WRITE', 'prev', 'coded13'))
-
-enc_node14 = NetCodingOperations('enc_node14', [('part9', 'r'), 
-                                                ('coded14', 'w'), 
-                                                ('enc_node13','r')], 
-                                 output='stream')
-enc_node14.add(('LOAD', 'local', 'part9'))
-enc_node14.add(('LOAD', 'prev', 'enc_node13'))
-enc_node14.add(('COPY', 'stream', 'prev'))
-enc_node14.add(('MULADD', 'stream', psis[20], 'local'))
-enc_node14.add(('MULADD', 'prev', xis[20], 'local'))
-enc_node14.add(('WRITE', 'prev', 'coded14'))
-
-enc_node15 = NetCodingOperations('enc_node15', [('part10', 'r'), 
-                                                ('coded15', 'w'), 
-                                                ('enc_node14','r')])
-enc_node15.add(('LOAD', 'local', 'part10'))
-enc_node15.add(('LOAD', 'prev', 'enc_node14'))
-enc_node15.add(('MULADD', 'prev', xis[21], 'local'))
-enc_node15.add(('WRITE', 'prev', 'coded15'))
-
-
-operations = {}
-operations['enc_node0'] = enc_node0
-operations['enc_node1'] = enc_node1
-operations['enc_node2'] = enc_node2
-operations['enc_node3'] = enc_node3
-operations['enc_node4'] = enc_node4
-operations['enc_node5'] = enc_node5
-operations['enc_node6'] = enc_node6
-operations['enc_node7'] = enc_node7
-operations['enc_node8'] = enc_node8
-operations['enc_node9'] = enc_node9
-operations['enc_node10'] = enc_node10
-operations['enc_node11'] = enc_node11
-operations['enc_node12'] = enc_node12
-operations['enc_node13'] = enc_node13
-operations['enc_node14'] = enc_node14
-operations['enc_node15'] = enc_node15
-
-operations['dec_node0'] = dec_node0
-operations['dec_node1'] = dec_node1
-operations['dec_node2'] = dec_node2
-operations['dec_node3'] = dec_node3
-operations['dec_node4'] = dec_node4
-operations['dec_node5'] = dec_node5
-operations['dec_node6'] = dec_node6
-operations['dec_node7'] = dec_node7
-operations['dec_node8'] = dec_node8
-operations['dec_node9'] = dec_node9
-operations['dec_node10'] = dec_node10
-
-operations['dec_node0_aux'] = dec_node0_aux
-operations['dec_node1_aux'] = dec_node1_aux
-operations['dec_node2_aux'] = dec_node2_aux
-operations['dec_node3_aux'] = dec_node3_aux
-operations['dec_node4_aux'] = dec_node4_aux
-operations['dec_node5_aux'] = dec_node5_aux
-
-test = NetCodingOperations('test', [('part10', 'r'), ('part5', 'r'), 
-                                    ('coded10', 'w'), ('part0','r')])
-test.add(('LOAD', 'local5', 'part5'))
-test.add(('LOAD', 'local10', 'part10'))
-test.add(('LOAD', 'prev', 'part0'))
-test.add(('COPY', 'local5', 'prev'))
-test.add(('MULADD', 'local5', psis[15], 'local5'))
-test.add(('MULADD', 'local5', psis[16], 'local10'))
-test.add(('MULADD', 'prev', xis[15], 'local5'))
-test.add(('MULADD', 'prev', xis[16], 'local10'))
-test.add(('WRITE', 'prev', 'coded10'))
-
-operations['test'] = test
+failures = 4
+seed = 0
+
+def placement(n, k):
+    '''
+    Parts of the original block held by each of the n nodes of the pipeline:
+    node i holds part i (if i<k) and part i-(n-k) (if i>=n-k), in the order
+    their coefficients are used. Coefficient j (of xis and psis) belongs to
+    the j-th part in this list of lists.
+    '''
+    if not 0<k<n<=2*k:
+        raise ValueError('RapidRAID needs 0<k<n<=2k (n=%d, k=%d).'%(n, k))
+    return [[part for part in (i-(n-k), i) if 0<=part<k] for i in xrange(n)]
+
+def generator_matrix(n, k, xis, psis, bitfield=8):
+    '''
+    Rows of the coefficients of the k parts in each of the n coded blocks.
+    '''
+    rows = []
+    stream = [0]*k
+    j = 0
+    for i, parts in enumerate(placement(n, k)):
+        # The first node stores its part as is: scaling a whole coded block
+        # does not change which blocks are decodable.
+        coded = list(stream) if i>0 else [0]*k
+        for part in parts:
+            coded[part] ^= xis[j] if i>0 else 1
+            stream[part] ^= psis[j]
+            j += 1
+        rows.append(coded)
+    return rows
+
+def rank(rows, bitfield=8):
+    '''
+    Rank of a matrix (a list of rows) in GF(2^bitfield).
+    '''
+    mult = lambda a, b: galoisbuffer.multiply_val(a, b, bitfield)
+    rows = [list(row) for row in rows]
+    found = 0
+    for col in xrange(len(rows[0]) if rows else 0):
+        pivots = [r for r in xrange(found, len(rows)) if rows[r][col]]
+        if not pivots:
+            continue
+        rows[found], rows[pivots[0]] = rows[pivots[0]], rows[found]
+        inverse = galoisbuffer.inverse_val(rows[found][col], bitfield=bitfield)
+        pivot = rows[found] = [mult(inverse, v) for v in rows[found]]
+        for r in xrange(found+1, len(rows)):
+            if rows[r][col]:
+                f = rows[r][col]
+                rows[r] = [v^mult(f, pv) for v, pv in zip(rows[r], pivot)]
+        found += 1
+    return found
+
+def undecodable(n, k, xis, psis, bitfield=8, failures=None):
+    '''
+    Sets of lost nodes, of size 'failures' (n-k by default), from which the
+    original block can not be decoded.
+    '''
+    if failures==None:
+        failures = n-k
+    if not 0<=failures<=n-k:
+        raise ValueError('Up to n-k=%d failures can be tolerated.'%(n-k))
+    rows = generator_matrix(n, k, xis, psis, bitfield)
+    lost = []
+    for alive in itertools.combinations(xrange(n), n-failures):
+        if rank([rows[i] for i in alive], bitfield)<k:
+            lost.append(tuple(sorted(set(xrange(n))-set(alive))))
+    return lost
+
+def unavoidable(n, k, failures=None, source=None):
+    '''
+    Sets of lost nodes that no coefficients can decode, as the pipeline mixes
+    some parts only in fixed proportions (21 sets of 5 nodes for n=16, k=11).
+    They are the ones undecodable with two random choices in GF(2^16): any
+    other set is that unlucky with probability ~(k/2^16)^2.
+    '''
+    if source==None:
+        source = random.Random()
+    lost = None
+    for i in xrange(2):
+        xis = [source.randint(1, 0xffff) for j in xrange(2*k)]
+        psis = [source.randint(1, 0xffff) for j in xrange(2*k)]
+        found = set(undecodable(n, k, xis, psis, 16, failures))
+        lost = found if lost==None else lost&found
+    return lost
+
+def choose_coefficients(n, k, bitfield=8, failures=None, source=None, 
+                        tries=100):
+    '''
+    Draws (xis, psis) from 'source' (a random.Random, seed it for repeatable
+    codes) until any 'failures' lost nodes (n-k by default) can be decoded,
+    but for the unavoidable() sets. Small fields rarely get there for large
+    (n, k): fewer failures trade reliability for codes that exist in 8 bits.
+    '''
+    if source==None:
+        source = random.Random()
+    allowed = unavoidable(n, k, failures, source)
+    maxv = (1<<bitfield)-1
+    for i in xrange(tries):
+        xis = [source.randint(1, maxv) for j in xrange(2*k)]
+        psis = [source.randint(1, maxv) for j in xrange(2*k)]
+        if allowed.issuperset(undecodable(n, k, xis, psis, bitfield, 
+                                          failures)):
+            return xis, psis
+    raise ValueError('No decodable coefficients found in %d tries.'%tries)
+
+# Coefficients found by choose_coefficients(n, k, bitfield, failures,
+# random.Random(seed)) by (n, k, bitfield, failures, seed), so that loading the
+# module does not search them again.
+known_coefficients = {
+    (16, 11, 8, 4, 0): ([229, 151, 243, 148, 115, 169, 255, 234, 203, 22, 157,
+                         125, 161, 216, 62, 187, 30, 57, 203, 85, 209, 26],
+                        [38, 178, 12, 147, 233, 137, 174, 7, 162, 155, 147, 
+                         100, 95, 251, 10, 6, 246, 48, 32, 54, 205, 239]),
+}
+
+def coefficients(n, k, bitfield=8, failures=None, seed=0):
+    '''
+    Returns the (xis, psis) of choose_coefficients() with a Random seeded
+    with 'seed', searched only if they are not known yet.
+    '''
+    key = (n, k, bitfield, failures, seed)
+    if key not in known_coefficients:
+        known_coefficients[key] = choose_coefficients(n, k, bitfield, failures,
+                                                      random.Random(seed))
+    return known_coefficients[key]
+
+def encoding_operations(n, k, xis, psis, bitfield=8):
+
+    '''
+    Returns the operations of the pipelined encoding: 'enc_node<i>' adds its
+    parts times psis to the stream from 'enc_node<i-1>' and forwards it, and
+    stores that stream plus its parts times xis as 'coded<i>'.
+    '''
+    layout = placement(n, k)
+    if min(len(xis), len(psis))<2*k:
+        raise ValueError('%d coefficients are needed.'%(2*k))
+    maxv = (1<<bitfield)-1
+    if not all(0<c<=maxv for c in itertools.chain(xis, psis)):
+        raise ValueError('Coefficients must be in 1..%d.'%maxv)
+
+    operations = {}
+    j = 0
+    for i, parts in enumerate(layout):
+        name = 'enc_node%d'%i
+        streams = [('part%d'%part, 'r') for part in parts]
+        streams.append(('coded%d'%i, 'w'))
+        if i>0:
+            streams.append(('enc_node%d'%(i-1), 'r'))
+        ops = NetCodingOperations(name, streams, 
+                                  output='stream' if i<n-1 else None)
+        for part in parts:
+            ops.add(('LOAD', 'local%d'%part, 'part%d'%part))
+
+        if i==0:
+            ops.add(('MULT', 'stream', psis[0], 'local0'))
+            ops.add(('WRITE', 'local0', 'coded0'))
+        else:
+            ops.add(('LOAD', 'prev', 'enc_node%d'%(i-1)))
+            if i<n-1:
+                ops.add(('COPY', 'stream', 'prev'))
+                for jj, part in enumerate(parts, j):
+                    ops.add(('MULADD', 'stream', psis[jj], 'local%d'%part))
+            for jj, part in enumerate(parts, j):
+                ops.add(('MULADD', 'prev', xis[jj], 'local%d'%part))
+            ops.add(('WRITE', 'prev', 'coded%d'%i))
+        j += len(parts)
+        operations[name] = ops
+    return operations
+
+def solve(rows, target, bitfield=8):
+    '''
+    Coefficients a with the sum of a[i]*rows[i] equal to target, in 
+    GF(2^bitfield), or None if there are none. Dependent rows get 0.
+    '''
+    mult = lambda a, b: galoisbuffer.multiply_val(a, b, bitfield)
+    m = len(rows)
+    # One equation for each column, with the target as the last term.
+    eqs = [[row[c] for row in rows]+[target[c]] for c in xrange(len(target))]
+    pivot_cols = []
+    for col in xrange(m):
+        found = len(pivot_cols)
+        pivots = [r for r in xrange(found, len(eqs)) if eqs[r][col]]
+        if not pivots:
+            continue
+        eqs[found], eqs[pivots[0]] = eqs[pivots[0]], eqs[found]
+        inverse = galoisbuffer.inverse_val(eqs[found][col], bitfield=bitfield)
+        pivot = eqs[found] = [mult(inverse, v) for v in eqs[found]]
+        for r in xrange(len(eqs)):
+            if r!=found and eqs[r][col]:
+                f = eqs[r][col]
+                eqs[r] = [v^mult(f, pv) for v, pv in zip(eqs[r], pivot)]
+        pivot_cols.append(col)
+    if any(eq[m] for eq in eqs[len(pivot_cols):]):
+        return None
+    coefficients = [0]*m
+    for eq, col in zip(eqs, pivot_cols):
+        coefficients[col] = eq[m]
+    return coefficients
+
+def plan_decoding(n, k, xis, psis, part, available, loads={}, bitfield=8):
+    '''
+    Returns the chain of nodes, among the 'available' ones, whose coded 
+    blocks are combined to decode 'part'. Each node costs a hop plus its
+    'loads' entry, and the chain should be cheap: nodes are taken, in order
+    of cost, of position in the pipeline or of distance to each node, until
+    the part can be decoded, and then the most costly ones are dropped while
+    it still can. The cheapest of these minimal sets (one MULADD per block) is used,
+    with the least loaded node last, as it writes the part and answers the
+    client.
+    '''
+    rows = generator_matrix(n, k, xis, psis, bitfield)
+    target = [int(p==part) for p in xrange(k)]
+    cost = lambda node: (1+loads.get(node, 0), node)
+    solved = {}
+    def decodes(nodes):
+        key = frozenset(nodes)
+        if key not in solved:
+            solved[key] = solve([rows[node] for node in nodes], target, 
+                                bitfield)!=None
+        return solved[key]
+
+    nodes = sorted(set(available), key=cost)
+    if not decodes(nodes):
+        raise CodingException('Part %d can not be decoded from nodes %s.'%
+                              (part, nodes))
+    orders = [nodes, sorted(nodes), sorted(nodes, reverse=True)]
+    orders += [sorted(nodes, key=lambda node: (abs(node-seed), 
+                                                      cost(node)))
+                      for seed in nodes]
+    best = None
+    for order in orders:
+        chain = next(order[:i] for i in xrange(1, len(order)+1) 
+                     if decodes(order[:i]))
+        for node in sorted(chain, key=cost, reverse=True):
+            rest = [other for other in chain if other!=node]
+            if rest and decodes(rest):
+                chain = rest
+        total = sum(cost(node)[0] for node in chain)
+        if best==None or total<best[0]:
+            best = (total, chain)
+    return sorted(best[1], key=cost, reverse=True)
+
+def decoding_id(part, chain, position=-1, fanin=1):
+    '''
+    Name of the operations of chain[position] decoding 'part' with 'chain',
+    as a tree with 'fanin' streams into each node (1 for a pipeline).
+    '''
+    name = 'dec_node%d_part%d_from%s'%(chain[position], part, 
+                                       '-'.join(map(str, chain)))
+    return name if fanin==1 else name+'_fanin%d'%fanin
+
+def decoding_tree(length, fanin=1):
+    '''
+    Positions of the chain whose streams are combined by each position. The
+    last one is the root and the positions before it fill the tree level by
+    level, so it is ceil(log_fanin(length)) hops deep (length-1 for 1).
+    '''
+    if fanin<1:
+        raise ValueError('The fan-in must be at least 1, not %d.'%fanin)
+    # Heap order from the root: h is the position length-1-h.
+    return [[length-1-child for child in xrange((length-1-i)*fanin+1, 
+                                                (length-1-i)*fanin+fanin+1)
+             if child<length] for i in xrange(length)]
+
+def decoding_operations(n, k, xis, psis, part, chain, bitfield=8, fanin=1):
+    '''
+    Returns the operations of the pipeline decoding 'part' from the coded 
+    blocks of 'chain' (see plan_decoding): each node adds its block times
+    its coefficient to the streams of its children in decoding_tree(), and
+    the last node writes the result as 'orig<part>'. With 'fanin'>1 the
+    nodes near the root, the least loaded, combine several streams and the
+    decoding latency grows with the log of the chain length.
+    '''
+    rows = generator_matrix(n, k, xis, psis, bitfield)
+    target = [int(p==part) for p in xrange(k)]
+    coefficients = solve([rows[node] for node in chain], target, bitfield)
+    if coefficients==None:
+        raise CodingException('Part %d can not be decoded from nodes %s.'%
+                              (part, chain))
+
+    operations = {}
+    tree = decoding_tree(len(chain), fanin)
+    for i, (node, coefficient) in enumerate(zip(chain, coefficients)):
+        name = decoding_id(part, chain, i, fanin)
+        last = i==len(chain)-1
+        children = [decoding_id(part, chain, child, fanin) 
+                    for child in tree[i]]
+        prevs = ['prev%d'%j if j else 'prev' for j in xrange(len(children))]
+        streams = [('coded%d'%node, 'r')]
+        streams += [(child, 'r') for child in children]
+        if last:
+            streams.append(('orig%d'%part, 'w'))
+        ops = NetCodingOperations(name, streams, 
+                                  output=None if last else 'stream')
+        ops.add(('LOAD', 'local', 'coded%d'%node))
+        dst = 'local' if last else 'stream'
+        if not children:
+            if coefficient!=1 or not last:
+                ops.add(('MULT', dst, coefficient, 'local'))
+        else:
+            dst = 'prev' if last else 'stream'
+            for prev, child in zip(prevs, children):
+                ops.add(('LOAD', prev, child))
+            if not last:
+                ops.add(('COPY', 'stream', 'prev'))
+            for prev in prevs[1:]:
+                ops.add(('IADD', dst, prev))
+            ops.add(('MULADD', dst, coefficient, 'local'))
+        if last:
+            ops.add(('WRITE', dst, 'orig%d'%part))
+        operations[name] = ops
+    return operations
+
+class Operations(dict):
+    '''
+    The operations of every node by name. Decoding pipelines named by
+    decoding_id() are built when first requested, as the chain (and so the
+    coefficients) is part of the name.
+    '''
+    # decoding_id() only names fan-ins larger than 1.
+    decoding = re.compile(r'dec_node\d+_part(\d+)_from(\d+(?:-\d+)*)'
+                          r'(?:_fanin([2-9]|[1-9]\d+))?$')
+
+    def __missing__(self, coding_id):
+        match = Operations.decoding.match(coding_id)
+        if match==None:
+            raise KeyError(coding_id)
+        part, chain = int(match.group(1)), map(int, match.group(2).split('-'))
+        fanin = int(match.group(3) or 1)
+        self.update(decoding_operations(n, k, xis, psis, part, chain, bf, 
+                                        fanin))
+        return dict.__getitem__(self, coding_id)
+
+xis, psis = coefficients(n, k, bf, failures, seed)
+operations = Operations(encoding_operations(n, k, xis, psis, bf))
 
 @ClassLogger
 class RapidRaidResolver(NetCodingResolver):
@@ -436,6 +358,14 @@ class RapidRaidResolver(NetCodingResolver):
         self.logger.info("RapidRaid in %d bits.", bf)
         self.dataenc_node_config = kwargs.pop('config')
         super(RapidRaidResolver, self).__init__(*args, **kwargs)
+        # All the buffers of a coding step must have the same size.
+        self.buffer_size = self.dataenc_node_config.coding_buffer_size
+        self.multiplexed = self.dataenc_node_config.multiplex
+        self.pooled = self.dataenc_node_config.keep_alive
+        # Executors hold a batch of buffers from each reader.
+        self.num_buffers = self.dataenc_node_config.coding_batch+1
+        self.read_ahead = self.dataenc_node_config.read_ahead
+        self.mapped = self.dataenc_node_config.mapped_reads
     
     def get_reader(self, key):
         if key.startswith('enc_node'):
@@ -443,24 +373,42 @@ class RapidRaidResolver(NetCodingResolver):
             coding_id_int = int(re.search("(\d*)",coding_id).group(0))         
             return RemoteNetCodingReader(self.get_enc_node(coding_id_int),
                                          self.block_id, key, self.stream_id, 
-                                         self.nodes, debug_name=key)
+                                         self.nodes, debug_name=key,
+                                         buffer_size=self.buffer_size,
+                                         num_buffers=self.num_buffers,
+                                         read_ahead=self.read_ahead,
+                                         multiplexed=self.multiplexed,
+                                         pooled=self.pooled)
         
         elif key.startswith('dec_node'):
             coding_id = key[8:]
             coding_id_int = int(re.search("(\d*)",coding_id).group(0))
             return RemoteNetCodingReader(self.get_enc_node(coding_id_int), 
                                          self.block_id, key, self.stream_id, 
-                                         self.nodes, debug_name=key)
+                                         self.nodes, debug_name=key,
+                                         buffer_size=self.buffer_size,
+                                         num_buffers=self.num_buffers,
+                                         read_ahead=self.read_ahead,
+                                         multiplexed=self.multiplexed,
+                                         pooled=self.pooled)
         
         elif key.startswith('part'):
             coding_id = int(key[4:])
             return self.block_store.get_reader(self.get_part(coding_id), 
-                                               debug_name=key)
+                                               debug_name=key,
+                                               buffer_size=self.buffer_size,
+                                               num_buffers=self.num_buffers,
+                                               read_ahead=self.read_ahead,
+                                               mapped=self.mapped)
         
         elif key.startswith('coded'):
             coding_id = int(key[5:])
             return self.block_store.get_reader(self.get_coded(coding_id), 
-                                               debug_name=key)
+                                               debug_name=key,
+                                               buffer_size=self.buffer_size,
+                                               num_buffers=self.num_buffers,
+                                               read_ahead=self.read_ahead,
+                                               mapped=self.mapped)
         
         else:
             assert False
@@ -491,5 +439,4 @@ class RapidRaidResolver(NetCodingResolver):
         #return 'girl.64mb.coded'
         return self.block_id+'.orig%d'%coding_id
 
-k = 11
 __all__ = [operations, RapidRaidResolver, k, bf]
@@ -51,6 +51,7 @@ POSSIBILITY OF SUCH DAMAGE.
 #include <string.h>
 
 #include "galois.h"
+#include "galois_simd.h"
 
 #define NONE (10)
 #define TABLE (11)
@@ -455,6 +456,9 @@ void galois_w08_region_multiply(char *region,      /* Region to multiply */
       exit(1);
   }
 
+  if (galois_simd_region_multiply(region, multby, nbytes, r2, add, 8,
+                                  prim_poly[8])) return;
+
   if (galois_mult_tables[8] == NULL) {
     if (galois_create_mult_tables(8) < 0) {
       fprintf(stderr, "galois_08_region_multiply -- couldn't make multiplication tables\n");
@@ -519,6 +523,9 @@ void galois_w16_region_multiply(char *region,      /* Region to multiply */
   return;
   */
 
+  if (galois_simd_region_multiply(region, multby, nbytes*2, r2, add, 16,
+                                  prim_poly[16])) return;
+
   if (multby == 0) {
     if (!add) {
       lp2 = (unsigned long *) ur2;
@@ -687,6 +694,11 @@ int *galois_get_ilog_table(int w)
   return galois_ilog_tables[w];
 }
 
+int galois_get_prim_poly(int w)
+{
+  return prim_poly[w];
+}
+
 void galois_w32_region_multiply(char *region,      /* Region to multiply */
                                   int multby,       /* Number to multiply by */
                                   int nbytes,        /* Number of bytes in region */
@@ -0,0 +1,258 @@
+/* galois_simd.c
+ * Region multiplication in GF(2^8) and GF(2^16) with split nibble tables:
+ * the product of every nibble of a word is looked up with PSHUFB, 16 or 32
+ * words at a time (SSSE3/AVX2). The instruction set is chosen at runtime,
+ * so the module is still built without any -m flag.
+ */
+
+#include <stdint.h>
+#include "galois_simd.h"
+
+#if defined(__GNUC__) && (defined(__x86_64__) || defined(__i386__)) && \
+    (__GNUC__ > 4 || (__GNUC__ == 4 && __GNUC_MINOR__ >= 9))
+#define GALOIS_SIMD_X86
+#include <immintrin.h>
+#endif
+
+static int simd_selected = -1;
+
+int galois_simd_support(void)
+{
+#ifdef GALOIS_SIMD_X86
+  __builtin_cpu_init();
+  if (__builtin_cpu_supports("avx2")) return GALOIS_SIMD_AVX2;
+  if (__builtin_cpu_supports("ssse3")) return GALOIS_SIMD_SSSE3;
+#endif
+  return GALOIS_SIMD_NONE;
+}
+
+int galois_simd_select(int level)
+{
+  int support;
+
+  support = galois_simd_support();
+  simd_selected = (level < support) ? level : support;
+  if (simd_selected < GALOIS_SIMD_NONE) simd_selected = GALOIS_SIMD_NONE;
+  return simd_selected;
+}
+
+int galois_simd_selected(void)
+{
+  if (simd_selected < 0) galois_simd_select(GALOIS_SIMD_AVX2);
+  return simd_selected;
+}
+
+/* tables[2*k+b][v] is byte b (0 low, 1 high) of multby*(v<<4k). The
+   products of single bits are obtained doubling multby, and the rest
+   by linearity. */
+void galois_simd_split_tables(int multby, int w, int prim_poly,
+                              uint8_t tables[][16])
+{
+  uint32_t bits[16], p, prod;
+  int i, k, v;
+
+  p = multby;
+  for (i = 0; i < w; i++) {
+    bits[i] = p;
+    p <<= 1;
+    if (p & (1 << w)) p ^= prim_poly;
+  }
+  for (k = 0; k < w/4; k++) {
+    for (v = 0; v < 16; v++) {
+      prod = 0;
+      for (i = 0; i < 4; i++) {
+        if (v & (1 << i)) prod ^= bits[4*k+i];
+      }
+      tables[2*k][v] = prod & 0xff;
+      tables[2*k+1][v] = prod >> 8;
+    }
+  }
+}
+
+#ifdef GALOIS_SIMD_X86
+
+__attribute__((target("ssse3")))
+static int w08_ssse3(uint8_t *src, uint8_t *dst, int nbytes,
+                     uint8_t tables[][16], int add)
+{
+  __m128i tlo, thi, mask, v, p;
+  int i;
+
+  tlo = _mm_loadu_si128((__m128i *) tables[0]);
+  thi = _mm_loadu_si128((__m128i *) tables[2]);
+  mask = _mm_set1_epi8(0x0f);
+  for (i = 0; i + 16 <= nbytes; i += 16) {
+    v = _mm_loadu_si128((__m128i *) (src+i));
+    p = _mm_xor_si128(_mm_shuffle_epi8(tlo, _mm_and_si128(v, mask)),
+          _mm_shuffle_epi8(thi, _mm_and_si128(_mm_srli_epi64(v, 4), mask)));
+    if (add) p = _mm_xor_si128(p, _mm_loadu_si128((__m128i *) (dst+i)));
+    _mm_storeu_si128((__m128i *) (dst+i), p);
+  }
+  return i;
+}
+
+__attribute__((target("avx2")))
+static int w08_avx2(uint8_t *src, uint8_t *dst, int nbytes,
+                    uint8_t tables[][16], int add)
+{
+  __m256i tlo, thi, mask, v, p;
+  int i;
+
+  tlo = _mm256_broadcastsi128_si256(_mm_loadu_si128((__m128i *) tables[0]));
+  thi = _mm256_broadcastsi128_si256(_mm_loadu_si128((__m128i *) tables[2]));
+  mask = _mm256_set1_epi8(0x0f);
+  for (i = 0; i + 32 <= nbytes; i += 32) {
+    v = _mm256_loadu_si256((__m256i *) (src+i));
+    p = _mm256_xor_si256(_mm256_shuffle_epi8(tlo, _mm256_and_si256(v, mask)),
+          _mm256_shuffle_epi8(thi,
+                              _mm256_and_si256(_mm256_srli_epi64(v, 4), mask)));
+    if (add) p = _mm256_xor_si256(p, _mm256_loadu_si256((__m256i *) (dst+i)));
+    _mm256_storeu_si256((__m256i *) (dst+i), p);
+  }
+  return i;
+}
+
+/* The low and high bytes of 16 words are split with PACKUSWB, multiplied
+   as two vectors of nibbles and interleaved back with PUNPCK. */
+__attribute__((target("ssse3")))
+static int w16_ssse3(uint8_t *src, uint8_t *dst, int nbytes,
+                     uint8_t tables[][16], int add)
+{
+  __m128i t[8], mask, low, a, b, l, h, n, rl, rh;
+  int i, k;
+
+  for (k = 0; k < 8; k++) t[k] = _mm_loadu_si128((__m128i *) tables[k]);
+  mask = _mm_set1_epi8(0x0f);
+  low = _mm_set1_epi16(0x00ff);
+  for (i = 0; i + 32 <= nbytes; i += 32) {
+    a = _mm_loadu_si128((__m128i *) (src+i));
+    b = _mm_loadu_si128((__m128i *) (src+i+16));
+    l = _mm_packus_epi16(_mm_and_si128(a, low), _mm_and_si128(b, low));
+    h = _mm_packus_epi16(_mm_srli_epi16(a, 8), _mm_srli_epi16(b, 8));
+    n = _mm_and_si128(l, mask);
+    rl = _mm_shuffle_epi8(t[0], n);
+    rh = _mm_shuffle_epi8(t[1], n);
+    n = _mm_and_si128(_mm_srli_epi64(l, 4), mask);
+    rl = _mm_xor_si128(rl, _mm_shuffle_epi8(t[2], n));
+    rh = _mm_xor_si128(rh, _mm_shuffle_epi8(t[3], n));
+    n = _mm_and_si128(h, mask);
+    rl = _mm_xor_si128(rl, _mm_shuffle_epi8(t[4], n));
+    rh = _mm_xor_si128(rh, _mm_shuffle_epi8(t[5], n));
+    n = _mm_and_si128(_mm_srli_epi64(h, 4), mask);
+    rl = _mm_xor_si128(rl, _mm_shuffle_epi8(t[6], n));
+    rh = _mm_xor_si128(rh, _mm_shuffle_epi8(t[7], n));
+    a = _mm_unpacklo_epi8(rl, rh);
+    b = _mm_unpackhi_epi8(rl, rh);
+    if (add) {
+      a = _mm_xor_si128(a, _mm_loadu_si128((__m128i *) (dst+i)));
+      b = _mm_xor_si128(b, _mm_loadu_si128((__m128i *) (dst+i+16)));
+    }
+    _mm_storeu_si128((__m128i *) (dst+i), a);
+    _mm_storeu_si128((__m128i *) (dst+i+16), b);
+  }
+  return i;
+}
+
+/* Same as w16_ssse3 on both 128 bit lanes: packing and unpacking within
+   the lanes leaves the words in their original order. */
+__attribute__((target("avx2")))
+static int w16_avx2(uint8_t *src, uint8_t *dst, int nbytes,
+                    uint8_t tables[][16], int add)
+{
+  __m256i t[8], mask, low, a, b, l, h, n, rl, rh;
+  int i, k;
+
+  for (k = 0; k < 8; k++) {
+    t[k] = _mm256_broadcastsi128_si256(_mm_loadu_si128((__m128i *) tables[k]));
+  }
+  mask = _mm256_set1_epi8(0x0f);
+  low = _mm256_set1_epi16(0x00ff);
+  for (i = 0; i + 64 <= nbytes; i += 64) {
+    a = _mm256_loadu_si256((__m256i *) (src+i));
+    b = _mm256_loadu_si256((__m256i *) (src+i+32));
+    l = _mm256_packus_epi16(_mm256_and_si256(a, low), _mm256_and_si256(b, low));
+    h = _mm256_packus_epi16(_mm256_srli_epi16(a, 8), _mm256_srli_epi16(b, 8));
+    n = _mm256_and_si256(l, mask);
+    rl = _mm256_shuffle_epi8(t[0], n);
+    rh = _mm256_shuffle_epi8(t[1], n);
+    n = _mm256_and_si256(_mm256_srli_epi64(l, 4), mask);
+    rl = _mm256_xor_si256(rl, _mm256_shuffle_epi8(t[2], n));
+    rh = _mm256_xor_si256(rh, _mm256_shuffle_epi8(t[3], n));
+    n = _mm256_and_si256(h, mask);
+    rl = _mm256_xor_si256(rl, _mm256_shuffle_epi8(t[4], n));
+    rh = _mm256_xor_si256(rh, _mm256_shuffle_epi8(t[5], n));
+    n = _mm256_and_si256(_mm256_srli_epi64(h, 4), mask);
+    rl = _mm256_xor_si256(rl, _mm256_shuffle_epi8(t[6], n));
+    rh = _mm256_xor_si256(rh, _mm256_shuffle_epi8(t[7], n));
+    a = _mm256_unpacklo_epi8(rl, rh);
+    b = _mm256_unpackhi_epi8(rl, rh);
+    if (add) {
+      a = _mm256_xor_si256(a, _mm256_loadu_si256((__m256i *) (dst+i)));
+      b = _mm256_xor_si256(b, _mm256_loadu_si256((__m256i *) (dst+i+32)));
+    }
+    _mm256_storeu_si256((__m256i *) (dst+i), a);
+    _mm256_storeu_si256((__m256i *) (dst+i+32), b);
+  }
+  return i;
+}
+
+#endif
+
+int galois_simd_region_multiply(char *region, int multby, int nbytes,
+                                char *r2, int add, int w, int prim_poly)
+{
+  uint8_t tables[8][16];
+
+  if (galois_simd_selected() == GALOIS_SIMD_NONE || (w != 8 && w != 16)) {
+    return 0;
+  }
+  galois_simd_split_tables(multby, w, prim_poly, tables);
+  return galois_simd_region_multiply_tables(tables, region, nbytes, r2, add, w);
+}
+
+int galois_simd_region_multiply_tables(uint8_t tables[][16], char *region,
+                                       int nbytes, char *r2, int add, int w)
+{
+  uint8_t *src, *dst, p0, p1;
+  int level, i;
+
+  level = galois_simd_selected();
+  if (level == GALOIS_SIMD_NONE || (w != 8 && w != 16)) return 0;
+
+  src = (uint8_t *) region;
+  dst = (r2 == NULL) ? src : (uint8_t *) r2;
+  if (r2 == NULL) add = 0;
+
+  i = 0;
+#ifdef GALOIS_SIMD_X86
+  if (w == 8) {
+    i = (level == GALOIS_SIMD_AVX2) ? w08_avx2(src, dst, nbytes, tables, add)
+                                    : w08_ssse3(src, dst, nbytes, tables, add);
+  } else {
+    i = (level == GALOIS_SIMD_AVX2) ? w16_avx2(src, dst, nbytes, tables, add)
+                                    : w16_ssse3(src, dst, nbytes, tables, add);
+  }
+#endif
+
+  /* Remaining bytes (or words, little endian) that fill no vector. */
+  if (w == 8) {
+    for (; i < nbytes; i++) {
+      p0 = tables[0][src[i] & 0xf] ^ tables[2][src[i] >> 4];
+      dst[i] = add ? dst[i] ^ p0 : p0;
+    }
+  } else {
+    for (; i + 2 <= nbytes; i += 2) {
+      p0 = tables[0][src[i] & 0xf] ^ tables[2][src[i] >> 4] ^
+           tables[4][src[i+1] & 0xf] ^ tables[6][src[i+1] >> 4];
+      p1 = tables[1][src[i] & 0xf] ^ tables[3][src[i] >> 4] ^
+           tables[5][src[i+1] & 0xf] ^ tables[7][src[i+1] >> 4];
+      if (add) {
+        p0 ^= dst[i];
+        p1 ^= dst[i+1];
+      }
+      dst[i] = p0;
+      dst[i+1] = p1;
+    }
+  }
+  return 1;
+}
@@ -0,0 +1,34 @@
+/* galois_simd.h
+ * Vectorized region multiplication for w=8 and w=16 (see galois_simd.c).
+ */
+
+#ifndef _GALOIS_SIMD_H
+#define _GALOIS_SIMD_H
+
+#define GALOIS_SIMD_NONE  (0)
+#define GALOIS_SIMD_SSSE3 (1)
+#define GALOIS_SIMD_AVX2  (2)
+
+/* Best instruction set supported by the CPU (GALOIS_SIMD_*). */
+extern int galois_simd_support(void);
+
+/* Instruction set in use, at most 'level' (GALOIS_SIMD_NONE disables it).
+   Returns the level selected. */
+extern int galois_simd_select(int level);
+extern int galois_simd_selected(void);
+
+/* Same arguments as galois_w08/w16_region_multiply, plus the primitive
+   polynomial of w. Returns 0, without touching the regions, when no SIMD
+   instruction set is selected or w is not 8 or 16. */
+extern int galois_simd_region_multiply(char *region, int multby, int nbytes,
+                                       char *r2, int add, int w, int prim_poly);
+
+/* The same split in two, so the tables of a constant are built only once:
+   tables[2*k+b][v] is byte b of multby*(v<<4k), for w=8 and w=16. */
+extern void galois_simd_split_tables(int multby, int w, int prim_poly,
+                                     unsigned char tables[][16]);
+extern int galois_simd_region_multiply_tables(unsigned char tables[][16],
+                                              char *region, int nbytes,
+                                              char *r2, int add, int w);
+
+#endif
@@ -1,8 +1,106 @@
+cimport cython
 cimport numpy
 import numpy
 from jerasure cimport *
+from libc.stdlib cimport malloc, free
+from libc.string cimport memcpy, memset
 import logging
 
+# The region multiplications run without the GIL, so the tables they create
+# on first use are built here instead, before any thread can race for them.
+galois_create_mult_tables(8)
+galois_create_log_tables(16)
+galois_create_split_w8_tables()
+
+simd_backends = ['none', 'ssse3', 'avx2']
+galois_simd_selected()
+
+# Bytes of every buffer combine() processes at a time: the destination chunks
+# stay in cache while all the sources are accumulated into them.
+DEF CHUNK = 4096
+
+cdef inline void region_multiply(int w, char *src, int multby, int nbytes, 
+                                 char *dst, int add) nogil:
+    if w==8:
+        galois_w08_region_multiply(src, multby, nbytes, dst, add)
+    elif w==16:
+        galois_w16_region_multiply(src, multby, nbytes, dst, add)
+    else:
+        galois_w32_region_multiply(src, multby, nbytes, dst, add)
+
+cdef inline void table_multiply(galois_split_table *tables, int multby, int w,
+                                char *src, int nbytes, char *dst, int add) nogil:
+    if w==32 or not galois_simd_region_multiply_tables(tables, src, nbytes, 
+                                                       dst, add, w):
+        region_multiply(w, src, multby, nbytes, dst, add)
+
+cdef void combine_regions(int n, int w, int nbytes, char *dst, char *dst2,
+                          char *base_bytes, char **srcs, int *coefs, 
+                          galois_split_table **tables) nogil:
+    cdef int j, offset, length
+    for offset from 0 <= offset < nbytes by CHUNK:
+        length = min(CHUNK, nbytes-offset)
+        # Both results are initialized before base can be modified.
+        if base_bytes==NULL:
+            memset(dst+offset, 0, length)
+        elif base_bytes!=dst:
+            memcpy(dst+offset, base_bytes+offset, length)
+        if dst2!=NULL:
+            if base_bytes==NULL:
+                memset(dst2+offset, 0, length)
+            elif base_bytes!=dst2:
+                memcpy(dst2+offset, base_bytes+offset, length)
+        for j in range(n):
+            table_multiply(tables[j], coefs[j], w, srcs[j]+offset, 
+                           length, dst+offset, 1)
+            if dst2!=NULL:
+                table_multiply(tables[n+j], coefs[n+j], w, 
+                               srcs[j]+offset, length, dst2+offset, 1)
+
+@cython.auto_pickle(False)
+cdef class GaloisMultiplier:
+    '''
+    Multiplication by a constant, with its split tables built only once.
+    '''
+    cdef readonly int value
+    cdef readonly int bitfield
+    cdef galois_split_table tables[8]
+
+    def __init__(self, value, bitfield=8):
+        if bitfield not in [8,16,32]:
+            raise ValueError("Incompatible bitfield. Use 8, 16 or 32.")
+        if type(value)!=int:
+            raise TypeError("Multiplication operand must be an integer.")
+        if value<0 or value>(1<<bitfield)-1:
+            raise ValueError("Value out of range: 0<=%d<=%d"%(value,
+                                                             (1<<bitfield)-1))
+        self.value = value
+        self.bitfield = bitfield
+        if bitfield!=32:
+            galois_simd_split_tables(value, bitfield, 
+                                     galois_get_prim_poly(bitfield), self.tables)
+
+    cdef void multiply(self, char *src, int nbytes, char *dst, int add) nogil:
+        table_multiply(self.tables, self.value, self.bitfield, src, nbytes, 
+                       dst, add)
+
+    def __int__(self):
+        return self.value
+
+    def __repr__(self):
+        return 'GaloisMultiplier(%d, bitfield=%d)'%(self.value, self.bitfield)
+
+multipliers = {}
+
+def multiplier(value, bitfield=8):
+    '''
+    Returns the GaloisMultiplier of value, creating it on first use.
+    '''
+    m = multipliers.get((value, bitfield))
+    if m is None:
+        m = multipliers[(value, bitfield)] = GaloisMultiplier(value, bitfield)
+    return m
+
 class GaloisBuffer:
     def __init__(self, size, buffer=None, bitfield=8):
         self.size = size
@@ -15,7 +113,7 @@ class GaloisBuffer:
         if (self.size*8)%self.bitfield!=0:
             raise ValueError("Buffer size should be multiple of bitfield (size is %d and bitfield %d)."%(self.size, self.bitfield))
         
-        if buffer==None:
+        if buffer is None:
             self.buff = numpy.ndarray(shape=(self.size,), dtype=numpy.uint8)
         else:
             if len(buffer)<self.size:
@@ -40,30 +138,33 @@ class GaloisBuffer:
         return self
 
     def __mul__(self, other):
-        if type(other)!=int:
-            raise TypeError("Multiplication operand must be an integer.")
-        
-        if other<0 or other>self.maxv:
-            raise ValueError("Value out of range: 0<=%d<=%d"%(other,self.maxv))
-
         return self.multadd(other, dest=GaloisBuffer(self.size, bitfield=self.bitfield), add=False)
 
     def __imul__(self, other):
-        if type(other)!=int:
-            raise TypeError("Multiplication operand must be an integer.")
-       
-        if other<0 or other>self.maxv:
-            raise ValueError("Value out of range: 0<=%d<=%d"%(other,self.maxv))
-
         return self.multadd(other, dest=self, add=False)
 
-    def multadd(self, other, dest=None, add=False):
+    def _multiplier(self, other):
+        if isinstance(other, GaloisMultiplier):
+            if other.bitfield!=self.bitfield:
+                raise ValueError("Multiplier bitfield is %d instead of %d."%(
+                                 other.bitfield, self.bitfield))
+            return other
+
         if type(other)!=int:
             raise TypeError("Multiplication operand must be an integer.")
         
         if other<0 or other>self.maxv:
             raise ValueError("Value out of range: 0<=%d<=%d"%(other,self.maxv))
 
+        return multiplier(other, self.bitfield)
+
+    def multadd(self, other, dest=None, add=False):
+        '''
+        Multiplies by other, an integer or a GaloisMultiplier, into dest (or
+        self), adding the product to its contents when add is set.
+        '''
+        cdef GaloisMultiplier m = self._multiplier(other)
+
         if dest!=None and not isinstance(dest, GaloisBuffer):
             raise TypeError("dest operand must be a GaloisBuffer.")
 
@@ -71,19 +172,97 @@ class GaloisBuffer:
             raise ValueError("Buffers must have the same size.")
 
         dest = dest if dest else self
-        add = 1 if add else 0
-
-        if self.bitfield==8:
-            galois_w08_region_multiply(numpy.PyArray_BYTES(self.buff), other, self.size, numpy.PyArray_BYTES(dest.buff), add)
-        elif self.bitfield==16:
-            galois_w16_region_multiply(numpy.PyArray_BYTES(self.buff), other, self.size, numpy.PyArray_BYTES(dest.buff), add)
-        elif self.bitfield==32:
-            galois_w32_region_multiply(numpy.PyArray_BYTES(self.buff), other, self.size, numpy.PyArray_BYTES(dest.buff), add)
-        else:
-            assert False
+
+        # The GIL is released while multiplying, so other threads can run.
+        cdef char *src_bytes = numpy.PyArray_BYTES(self.buff)
+        cdef char *dst_bytes = numpy.PyArray_BYTES(dest.buff)
+        cdef int nbytes = self.size
+        cdef int c_add = 1 if add else 0
+
+        with nogil:
+            m.multiply(src_bytes, nbytes, dst_bytes, c_add)
       
         return dest
 
+    def _multipliers(self, coefficients, n):
+        if len(coefficients)!=n:
+            raise ValueError("There must be one coefficient per source.")
+        return [self._multiplier(c) for c in coefficients]
+
+    def combine(self, sources, coefficients, base=None, other=None, 
+                other_coefficients=None):
+        '''
+        Sets self to base+sum(coefficients[i]*sources[i]) and, when other is
+        given, other to base+sum(other_coefficients[i]*sources[i]), in a 
+        single pass over the buffers. A None base is zero; base can be self
+        or other, but the sources cannot be any of the results. Coefficients
+        are integers or GaloisMultipliers.
+        '''
+        mults = self._check_combine(sources, coefficients, base, other,
+                                    other_coefficients)
+        cdef int n = len(sources)
+        cdef int w = self.bitfield
+        cdef int nbytes = self.size
+        cdef int i
+        cdef GaloisMultiplier m
+        cdef char *dst = numpy.PyArray_BYTES(self.buff)
+        cdef char *dst2 = NULL
+        cdef char *base_bytes = NULL
+        cdef char **srcs = <char **>malloc(n*sizeof(char *))
+        cdef int *coefs = <int *>malloc(2*n*sizeof(int))
+        cdef galois_split_table **tables = <galois_split_table **>malloc(
+                                             2*n*sizeof(galois_split_table *))
+        if srcs==NULL or coefs==NULL or tables==NULL:
+            free(srcs)
+            free(coefs)
+            free(tables)
+            raise MemoryError()
+        
+        # The multipliers in mults own the tables until the end.
+        for i in range(n):
+            srcs[i] = numpy.PyArray_BYTES(sources[i].buff)
+        for i in range(len(mults)):
+            m = mults[i]
+            coefs[i] = m.value
+            tables[i] = m.tables
+        if other is not None:
+            dst2 = numpy.PyArray_BYTES(other.buff)
+        if base is not None:
+            base_bytes = numpy.PyArray_BYTES(base.buff)
+
+        with nogil:
+            combine_regions(n, w, nbytes, dst, dst2, base_bytes, srcs, coefs,
+                            tables)
+        free(srcs)
+        free(coefs)
+        free(tables)
+        return self
+
+    def _check_combine(self, sources, coefficients, base, other, 
+                       other_coefficients):
+        '''
+        Checks the operands of combine() and returns their multipliers.
+        '''
+        buffers = list(sources)
+        mults = self._multipliers(coefficients, len(buffers))
+        if other is not None:
+            mults += self._multipliers(other_coefficients, len(buffers))
+            buffers.append(other)
+            if numpy.may_share_memory(self.buff, other.buff):
+                raise ValueError("Both results cannot share memory.")
+        if base is not None:
+            buffers.append(base)
+        for b in buffers:
+            if not isinstance(b, GaloisBuffer):
+                raise TypeError("Operands must be GaloisBuffers.")
+            if b.size!=self.size:
+                raise ValueError("Buffers must have the same size.")
+        for src in sources:
+            if numpy.may_share_memory(self.buff, src.buff) or (other is not None
+               and numpy.may_share_memory(other.buff, src.buff)):
+                raise ValueError("Sources cannot share memory with a result.")
+        return mults
+
     def inverse_val(self, val):
         if type(val)!=int:
             raise TypeError("Inversion operand must be an integer.")
@@ -93,6 +272,120 @@ class GaloisBuffer:
 
         return galois_inverse(val, self.bitfield)
 
+def multadd_many(sources, other, dests, add=False):
+    '''
+    Same as sources[i].multadd(other, dests[i], add) for every i, in a 
+    single call without the GIL.
+    '''
+    if len(dests)!=len(sources):
+        raise ValueError("There must be one dest per source.")
+    cdef int count = len(sources)
+    if count==0:
+        return
+    cdef GaloisMultiplier m = sources[0]._multiplier(other)
+    for src, dest in zip(sources, dests):
+        if not isinstance(src, GaloisBuffer) or\
+           not isinstance(dest, GaloisBuffer):
+            raise TypeError("Operands must be GaloisBuffers.")
+        if src.size!=dest.size:
+            raise ValueError("Buffers must have the same size.")
+        if src.bitfield!=m.bitfield or dest.bitfield!=m.bitfield:
+            raise ValueError("Buffers must have the same bitfield.")
+
+    cdef int k
+    cdef int c_add = 1 if add else 0
+    cdef char **srcs = <char **>malloc(count*sizeof(char *))
+    cdef char **dsts = <char **>malloc(count*sizeof(char *))
+    cdef int *sizes = <int *>malloc(count*sizeof(int))
+    if srcs==NULL or dsts==NULL or sizes==NULL:
+        free(srcs)
+        free(dsts)
+        free(sizes)
+        raise MemoryError()
+    for k in range(count):
+        srcs[k] = numpy.PyArray_BYTES(sources[k].buff)
+        dsts[k] = numpy.PyArray_BYTES(dests[k].buff)
+        sizes[k] = sources[k].size
+
+    with nogil:
+        for k in range(count):
+            m.multiply(srcs[k], sizes[k], dsts[k], c_add)
+    free(srcs)
+    free(dsts)
+    free(sizes)
+
+def combine_many(dests, sources, coefficients, bases=None, others=None,
+                 other_coefficients=None):
+    '''
+    Same as dests[i].combine(sources[i], coefficients, bases[i], others[i],
+    other_coefficients) for every i, in a single call without the GIL. 
+    'bases' and 'others' are lists or None.
+    '''
+    cdef int count = len(dests)
+    if len(sources)!=count or (bases is not None and len(bases)!=count) or\
+       (others is not None and len(others)!=count):
+        raise ValueError("There must be as many sources, bases and others "
+                         "as dests.")
+    if count==0:
+        return
+    mults = None
+    for k in range(count):
+        if dests[k].bitfield!=dests[0].bitfield:
+            raise ValueError("Buffers must have the same bitfield.")
+        mults = dests[k]._check_combine(sources[k], coefficients, 
+                                        bases[k] if bases else None,
+                                        others[k] if others else None,
+                                        other_coefficients)
+
+    cdef int n = len(coefficients)
+    cdef int w = dests[0].bitfield
+    cdef int i
+    cdef GaloisMultiplier m
+    cdef char **dsts = <char **>malloc(count*sizeof(char *))
+    cdef char **dsts2 = <char **>malloc(count*sizeof(char *))
+    cdef char **base_bytes = <char **>malloc(count*sizeof(char *))
+    cdef int *sizes = <int *>malloc(count*sizeof(int))
+    cdef char **srcs = <char **>malloc(count*n*sizeof(char *))
+    cdef int *coefs = <int *>malloc(2*n*sizeof(int))
+    cdef galois_split_table **tables = <galois_split_table **>malloc(
+                                         2*n*sizeof(galois_split_table *))
+    if dsts==NULL or dsts2==NULL or base_bytes==NULL or sizes==NULL or\
+       srcs==NULL or coefs==NULL or tables==NULL:
+        free(dsts)
+        free(dsts2)
+        free(base_bytes)
+        free(sizes)
+        free(srcs)
+        free(coefs)
+        free(tables)
+        raise MemoryError()
+
+    # The multipliers in mults own the tables until the end.
+    for i in range(len(mults)):
+        m = mults[i]
+        coefs[i] = m.value
+        tables[i] = m.tables
+    for k in range(count):
+        dsts[k] = numpy.PyArray_BYTES(dests[k].buff)
+        dsts2[k] = numpy.PyArray_BYTES(others[k].buff) if others else NULL
+        base_bytes[k] = numpy.PyArray_BYTES(bases[k].buff)\
+                        if bases and bases[k] is not None else NULL
+        sizes[k] = dests[k].size
+        for i in range(n):
+            srcs[k*n+i] = numpy.PyArray_BYTES(sources[k][i].buff)
+
+    with nogil:
+        for i in range(count):
+            combine_regions(n, w, sizes[i], dsts[i], dsts2[i], base_bytes[i],
+                            srcs+i*n, coefs, tables)
+    free(dsts)
+    free(dsts2)
+    free(base_bytes)
+    free(sizes)
+    free(srcs)
+    free(coefs)
+    free(tables)
+
 def inverse_val(val, bitfield=8):
     if type(val)!=int:
         raise TypeError("Inversion operand must be an integer.")
@@ -102,3 +395,28 @@ def inverse_val(val, bitfield=8):
         raise ValueError("Value out of range: 0<=%d<=%d"%(val,maxv))
 
     return galois_inverse(val, bitfield)
+
+def multiply_val(a, b, bitfield=8):
+    if type(a)!=int or type(b)!=int:
+        raise TypeError("Multiplication operands must be integers.")
+    
+    maxv = (1<<bitfield)-1
+    if a<0 or a>maxv or b<0 or b>maxv:
+        raise ValueError("Value out of range: 0<=%d,%d<=%d"%(a,b,maxv))
+
+    return galois_single_multiply(a, b, bitfield)
+
+def simd_backend():
+    '''
+    Instruction set used for w=8 and w=16 region multiplications.
+    '''
+    return simd_backends[galois_simd_selected()]
+
+def set_simd_backend(name):
+    '''
+    Selects 'avx2', 'ssse3' or 'none', or the best one the CPU supports below
+    it. Returns the one selected.
+    '''
+    if name not in simd_backends:
+        raise ValueError("Unknown SIMD backend: %s."%name)
+    return simd_backends[galois_simd_select(simd_backends.index(name))]
@@ -50,11 +50,21 @@ cdef extern from "galois.h":
     extern int *galois_get_div_table(int w)
     extern int *galois_get_log_table(int w)
     extern int *galois_get_ilog_table(int w)
+    extern int galois_get_prim_poly(int w)
 
     void galois_region_xor(char *r1, char *r2, char *r3, int nbytes)
-    void galois_w08_region_multiply(char *region, int multby, int nbytes, char *r2, int add)
-    void galois_w16_region_multiply(char *region, int multby, int nbytes, char *r2, int add)
-    void galois_w32_region_multiply(char *region, int multby, int nbytes, char *r2, int add)
+    void galois_w08_region_multiply(char *region, int multby, int nbytes, char *r2, int add) nogil
+    void galois_w16_region_multiply(char *region, int multby, int nbytes, char *r2, int add) nogil
+    void galois_w32_region_multiply(char *region, int multby, int nbytes, char *r2, int add) nogil
+
+ctypedef unsigned char galois_split_table[16]
+
+cdef extern from "galois_simd.h":
+    int galois_simd_support()
+    int galois_simd_select(int level)
+    int galois_simd_selected()
+    void galois_simd_split_tables(int multby, int w, int prim_poly, galois_split_table *tables)
+    int galois_simd_region_multiply_tables(galois_split_table *tables, char *region, int nbytes, char *r2, int add, int w) nogil
 
 cdef extern from "jerasure.h":
     int *jerasure_matrix_to_bitmatrix(int k, int m, int w, int *matrix)
@@ -13,14 +13,14 @@ ext_modules = []
 
 if use_cython:
     ext_modules += [
-        Extension("cauchyec", ["cauchyec.pyx","jerasure.c","galois.c","cauchy.c"], extra_compile_args=['-O4']),
-        Extension("galoisbuffer", ["galoisbuffer.pyx","jerasure.c","galois.c"], extra_compile_args=['-O4'])
+        Extension("cauchyec", ["cauchyec.pyx","jerasure.c","galois.c","galois_simd.c","cauchy.c"], extra_compile_args=['-O4']),
+        Extension("galoisbuffer", ["galoisbuffer.pyx","jerasure.c","galois.c","galois_simd.c"], extra_compile_args=['-O4'])
     ]
     cmdclass.update({ 'build_ext': build_ext })
 else:
     ext_modules += [
-        Extension("cauchyec", ["cauchyec.c","jerasure.c","galois.c","cauchy.c"], extra_compile_args=['-O4']),
-        Extension("galoisbuffer", ["galoisbuffer.c","jerasure.c","galois.c"], extra_compile_args=['-O4'])
+        Extension("cauchyec", ["cauchyec.c","jerasure.c","galois.c","galois_simd.c","cauchy.c"], extra_compile_args=['-O4']),
+        Extension("galoisbuffer", ["galoisbuffer.c","jerasure.c","galois.c","galois_simd.c"], extra_compile_args=['-O4'])
     ]
 
 setup(cmdclass=cmdclass, ext_modules=ext_modules)
@@ -0,0 +1,56 @@
+import ast
+import sys
+sys.path.append('./lib/')
+import timeit
+
+from clusterdfs.headers import DataNodeHeader
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import avro.io
+
+'''
+Encode/decode throughput of DataNodeHeader for a coding request of a 16
+nodes RapidRAID pipeline, with the binary codec, the cached Avro codec and
+the per request DatumReader/DatumWriter it replaces.
+'''
+
+nodes = [('datanode%02d.cluster'%i, 3900+i) for i in xrange(16)]
+args = (DataNodeHeader.OP_CODING, 'girl.64mb', 'enc_node15', 
+        'f2b3a1e0c4d5e6f708192a3b4c5d6e7f', nodes)
+
+def generate_datum(operation, block_id, coding_id, stream_id, nodes):
+    writer = StringIO()
+    encoder = avro.io.BinaryEncoder(writer)
+    datum_writer = avro.io.DatumWriter(writers_schema=DataNodeHeader.schema)
+    datum_writer.write({'operation':operation,'block_id':block_id,
+                        'coding_id':coding_id,'stream_id':stream_id,
+                        'nodes':';'.join(map(str, nodes))}, encoder)
+    return writer.getvalue()
+
+def parse_datum(s):
+    decoder = avro.io.BinaryDecoder(StringIO(s))
+    datum_reader = avro.io.DatumReader(writers_schema=DataNodeHeader.schema,
+                                       readers_schema=DataNodeHeader.schema)
+    header = datum_reader.read(decoder)
+    nodes = header['nodes']
+    header['nodes'] = map(ast.literal_eval, nodes.split(';')) if nodes else []
+    return header
+
+def bench(name, generate, parse, number=20000):
+    s = generate(*args)
+    tg = timeit.timeit(lambda: generate(*args), number=number)
+    tp = timeit.timeit(lambda: parse(s), number=number)
+    print '%-8s %4d bytes  generate %7.2f us  parse %7.2f us'%(name, len(s), 
+                                                   1e6*tg/number, 1e6*tp/number)
+
+assert DataNodeHeader.parse(DataNodeHeader.generate(*args))['nodes']==nodes
+assert DataNodeHeader.parse(DataNodeHeader.generate_avro(*args))['nodes']==nodes
+assert DataNodeHeader.generate_avro(*args)==generate_datum(*args)
+
+bench('binary', DataNodeHeader.generate, DataNodeHeader.parse)
+bench('avro', DataNodeHeader.generate_avro, DataNodeHeader.parse_avro)
+bench('datum', generate_datum, parse_datum, number=2000)
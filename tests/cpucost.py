@@ -4,6 +4,7 @@ import time
 
 from clusterdfs.bufferedio import IOBuffer
 from cauchyec import CauchyEC
+import galoisbuffer
 from galoisbuffer import GaloisBuffer
 
 def test_ec(k=11, m=5, w=4, iters=1000):
@@ -27,7 +28,7 @@ def test_pipe(iters=1000, bits=8):
     
     for b in iobuffers:
         array = b.as_numpy_byte_array()
-        array += rr*random.randrange(0,mx)
+        array += (rr*random.randrange(0,mx)).astype(numpy.uint8)
         
     t = time.time()
     for it in xrange(iters):
@@ -39,5 +40,8 @@ def test_pipe(iters=1000, bits=8):
 
 iters = 500
 print 'caucy', test_ec(iters=iters)
-print 'pipe8', test_pipe(iters=iters, bits=8)
-print 'pipe16', test_pipe(iters=iters, bits=16)
\ No newline at end of file
+for backend in galoisbuffer.simd_backends:
+    if galoisbuffer.set_simd_backend(backend)!=backend:
+        continue
+    print 'pipe8', backend, test_pipe(iters=iters, bits=8)
+    print 'pipe16', backend, test_pipe(iters=iters, bits=16)
\ No newline at end of file
@@ -0,0 +1,77 @@
+import sys
+sys.path.append('./lib/')
+
+from clusterdfs.bufferedio import IOBuffer, IOBufferPool
+
+'''
+IOBufferPool: buffers are recycled, double frees ignored, free blocks are
+split and merged across size classes, and buffers out of the slab are
+capped.
+'''
+
+pool = IOBuffer.pool = IOBufferPool(capacity=64*1024, max_class=32*1024,
+                                    overflow=16*1024)
+
+# Recycling: a freed buffer is handed out again for its size class.
+a = pool.acquire(None, 4096)
+a.free()
+b = pool.acquire(None, 4000)
+assert b is a and b.size==4000 and b.length==0
+
+# Double free: the buffer is only put back once.
+b.free()
+b.free()
+assert len(pool.free_lists[4096])==1
+c, d = pool.acquire(None, 4096), pool.acquire(None, 4096)
+assert c is not d
+c.free()
+d.free()
+
+# Blocks are aligned to their class and do not overlap.
+buffers = [pool.acquire(None, size) for size in (4096, 16384, 8192, 4096)]
+for i, iobuffer in enumerate(buffers):
+    assert iobuffer.offset%iobuffer.size_class==0, iobuffer.offset
+    iobuffer.mem[:] = chr(i+1)*iobuffer.size
+for i, iobuffer in enumerate(buffers):
+    assert iobuffer.mem.tobytes()==chr(i+1)*iobuffer.size, i
+for iobuffer in buffers:
+    iobuffer.free()
+
+# The whole slab carved in the smallest class is merged back for the
+# largest one, and split again for the small ones.
+small = []
+while True:
+    iobuffer = pool.acquire(None, 4096)
+    if iobuffer.size_class==None:
+        iobuffer.free()
+        break
+    small.append(iobuffer)
+assert len(small)==16, len(small)
+for iobuffer in small:
+    iobuffer.free()
+large = [pool.acquire(None, 32768) for i in xrange(2)]
+assert all(iobuffer.size_class==32768 for iobuffer in large)
+assert pool.overflow_used==0
+large[1].free()
+small = [pool.acquire(None, 4096) for i in xrange(8)]
+assert all(iobuffer.size_class==4096 for iobuffer in small)
+assert len(set(iobuffer.offset for iobuffer in small))==8
+
+# The slab is full: buffers out of it are capped.
+over = [pool.acquire(None, 8192) for i in xrange(2)]
+assert all(iobuffer.size_class==None for iobuffer in over)
+assert pool.overflow_used==16384
+try:
+    pool.acquire(None, 4096)
+    assert False, 'the overflow cap was not enforced'
+except MemoryError:
+    pass
+over[0].free()
+over[0].free()
+assert pool.overflow_used==8192
+over.append(pool.acquire(None, 8192))
+for iobuffer in over+small+large[:1]:
+    iobuffer.free()
+assert pool.overflow_used==0
+
+print 'ok'
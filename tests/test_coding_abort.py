@@ -0,0 +1,80 @@
+import os
+import sys
+sys.path.append('./lib/')
+import random
+import tempfile
+
+import gevent
+
+from clusterdfs.datanode import DataNodeConfig, DataNode, DataNodeClient
+from clusterdfs.coding import NetCodingExecutor, CodingException
+from clusterdfs.bufferedio import FileOutputStream
+
+'''
+A RapidRAID encoding where the node running enc_node7 fails, either in the
+middle of the stream or once it has sent it all (its block commit fails, so
+the next node gets an error instead of the ACK). No temporary block file
+may be left behind, and the blocks that are committed must be complete.
+'''
+
+n = 16
+k = 11
+size = 300000
+base = 4500
+
+datadir = tempfile.mkdtemp()
+random.seed(1)
+for i in xrange(k):
+    with open(os.path.join(datadir, 'blk.part%d'%i), 'wb') as f:
+        f.write(''.join(chr(random.randrange(256)) for j in xrange(size)))
+
+nodes = [('localhost', base+i) for i in xrange(n)]
+for i in xrange(n):
+    config = DataNodeConfig.from_dict({'datadir':datadir, 'isolated':True,
+                                       'port':base+i, 'keep_alive':True})
+    gevent.spawn(DataNode(config).init)
+gevent.sleep(0.3)
+
+execute_steps = NetCodingExecutor.execute_steps
+def failing_steps(self, outputs):
+    if self.operations.node=='enc_node7' and self.processed>=size//2:
+        raise CodingException('Injected failure.')
+    return execute_steps(self, outputs)
+
+commit = FileOutputStream.commit
+def failing_commit(self):
+    if self.filename.endswith('.coded7'):
+        self.remove()
+        raise IOError('Injected commit failure.')
+    return commit(self)
+
+def check(name):
+    try:
+        DataNodeClient(*nodes[-1]).coding('blk', 'enc_node15', nodes)
+        assert False, name+': the encoding did not fail'
+    except AssertionError:
+        raise
+    except Exception:
+        pass
+    # Let the nodes finish tearing their pipelines down.
+    gevent.sleep(1)
+    files = os.listdir(datadir)
+    assert not [f for f in files if f.endswith('.tmp')], (name, files)
+    for f in files:
+        if '.coded' in f:
+            assert os.path.getsize(os.path.join(datadir, f))==size, (name, f)
+            os.unlink(os.path.join(datadir, f))
+
+NetCodingExecutor.execute_steps = failing_steps
+try:
+    check('mid-stream')
+finally:
+    NetCodingExecutor.execute_steps = execute_steps
+
+FileOutputStream.commit = failing_commit
+try:
+    check('after the stream')
+finally:
+    FileOutputStream.commit = commit
+
+print 'ok'
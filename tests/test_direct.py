@@ -0,0 +1,78 @@
+import os
+import sys
+sys.path.append('./lib/')
+import errno
+import tempfile
+
+from clusterdfs.bufferedio import DirectFileOutputStream, FileOutputStream,\
+                                  IOBuffer
+
+'''
+DirectFileOutputStream: the writes are whole staging buffers and a last one
+padded to the alignment, and the file is truncated back to its length; the
+file is written through the page cache where O_DIRECT is not supported; and
+the periodic fsyncs follow the interval.
+'''
+
+DirectFileOutputStream.write_size = 16*1024
+alignment = DirectFileOutputStream.alignment
+datadir = tempfile.mkdtemp()
+data = os.urandom(3*DirectFileOutputStream.write_size+1234)
+
+writes = []
+fsyncs = []
+os_write, os_open, os_fsync = os.write, os.open, os.fsync
+def counted_write(fd, data):
+    writes.append(len(data))
+    return os_write(fd, data)
+def counted_fsync(fd):
+    fsyncs.append(fd)
+    os_fsync(fd)
+os.write, os.fsync = counted_write, counted_fsync
+
+def store(name, chunk=5000):
+    path = os.path.join(datadir, name)
+    stream = DirectFileOutputStream(path, atomic=True)
+    for offset in xrange(0, len(data), chunk):
+        iobuffer = IOBuffer.pool.acquire(None, chunk)
+        iobuffer.length = len(data[offset:offset+chunk])
+        iobuffer.mem[:iobuffer.length] = data[offset:offset+chunk]
+        stream.write(iobuffer)
+        iobuffer.free()
+    stream.finalize()
+    assert open(path, 'rb').read()==data, name
+    return stream
+
+# Padding and truncation of the tail.
+store('blk0')
+assert writes[:3]==[DirectFileOutputStream.write_size]*3, writes
+assert writes[3]==-(-1234//alignment)*alignment, writes
+assert len(writes)==4, writes
+
+# Without O_DIRECT support the file is opened without it.
+refused = []
+def no_direct(path, flags, mode=0777):
+    if flags&getattr(os, 'O_DIRECT', 0):
+        refused.append(path)
+        raise OSError(errno.EINVAL, os.strerror(errno.EINVAL))
+    return os_open(path, flags, mode)
+os.open = no_direct
+store('blk1')
+os.open = os_open
+assert len(refused)==1, refused
+
+# Periodic fsyncs.
+FileOutputStream.fsync = 'periodic'
+FileOutputStream.fsync_interval = 3600.0
+del fsyncs[:]
+store('blk2')
+assert len(fsyncs)==1, fsyncs
+FileOutputStream.fsync_interval = 0.0
+del fsyncs[:]
+store('blk3', chunk=len(data)//4+1)
+assert len(fsyncs)==5, fsyncs
+FileOutputStream.fsync = 'none'
+os.write, os.fsync = os_write, os_fsync
+
+assert sorted(os.listdir(datadir))==['blk0', 'blk1', 'blk2', 'blk3']
+print 'ok'
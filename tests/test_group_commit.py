@@ -0,0 +1,41 @@
+import os
+import sys
+sys.path.append('./lib/')
+import tempfile
+
+import gevent
+
+from clusterdfs.bufferedio import FileOutputStream, GroupCommit, IOBuffer
+
+'''
+GroupCommit: the files committed together are renamed in one group, and a
+file whose rename fails does not fail the others of its group.
+'''
+
+FileOutputStream.group_commit = GroupCommit(delay=0.05)
+datadir = tempfile.mkdtemp()
+# A non-empty directory can not be replaced by a file.
+os.makedirs(os.path.join(datadir, 'blk2', 'busy'))
+
+def store(name):
+    stream = FileOutputStream(os.path.join(datadir, name), atomic=True)
+    iobuffer = IOBuffer.pool.acquire(None, len(name))
+    iobuffer.mem[:] = name
+    iobuffer.length = len(name)
+    stream.write(iobuffer)
+    iobuffer.free()
+    stream.finalize()
+
+stores = [gevent.spawn(store, 'blk%d'%i) for i in xrange(4)]
+gevent.joinall(stores)
+for i, greenlet in enumerate(stores):
+    if i==2:
+        assert isinstance(greenlet.exception, OSError), greenlet.exception
+    else:
+        assert greenlet.successful(), (i, greenlet.exception)
+        path = os.path.join(datadir, 'blk%d'%i)
+        assert open(path, 'rb').read()=='blk%d'%i
+# Only the committed files and the directory are left.
+assert sorted(os.listdir(datadir))==['blk0', 'blk1', 'blk2', 'blk3']
+
+print 'ok'
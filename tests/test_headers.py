@@ -0,0 +1,44 @@
+import sys
+sys.path.append('./lib/')
+
+from clusterdfs.headers import DataNodeHeader
+
+'''
+DataNodeHeader round trips: generate() -> parse() with the binary codec,
+and the former Avro headers still parsed by it.
+'''
+
+nodes = [('datanode%02d.cluster'%i, 3900+i) for i in xrange(16)]
+headers = [(DataNodeHeader.OP_CODING, 'girl.64mb', 'enc_node15',
+            'f2b3a1e0c4d5e6f708192a3b4c5d6e7f', nodes),
+           (DataNodeHeader.OP_STORE, 'blk', '', '', []),
+           (DataNodeHeader.OP_RETRIEVE, u'bl\xf6ck', 'dec_node3_fanin2',
+            '', [('localhost', 65535)])]
+
+for operation, block_id, coding_id, stream_id, nodes in headers:
+    expected = {'operation':operation, 'block_id':block_id,
+                'coding_id':coding_id, 'stream_id':stream_id,
+                'nodes':nodes}
+    for generate in (DataNodeHeader.generate_avro, DataNodeHeader.generate):
+        if generate==DataNodeHeader.generate and isinstance(block_id, unicode):
+            # The binary codec returns the UTF-8 bytes, Avro unicode.
+            expected['block_id'] = block_id.encode('utf-8')
+        s = generate(operation, block_id, coding_id, stream_id, nodes)
+        header = DataNodeHeader.parse(s)
+        assert header==expected, (generate.__name__, header, expected)
+
+try:
+    DataNodeHeader.generate(DataNodeHeader.OP_CODING, 'blk', 'enc_node15',
+                            '', ';'.join(map(str, nodes)))
+    assert False, 'nodes as a string must be rejected'
+except TypeError:
+    pass
+
+try:
+    DataNodeHeader.parse(DataNodeHeader.generate(DataNodeHeader.OP_STORE,
+                                                 'blk')+'x')
+    assert False, 'trailing bytes must be rejected'
+except ValueError:
+    pass
+
+print 'ok'
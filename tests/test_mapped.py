@@ -0,0 +1,57 @@
+import os
+import sys
+sys.path.append('./lib/')
+import mmap
+import tempfile
+
+from clusterdfs.bufferedio import MappedFileInputStream, InputStreamReader,\
+                                  IOBufferFactory
+
+'''
+MappedFileInputStream: whole buffers are views over the map and the tail of
+the file is copied, writes to the views never reach the file, and only the
+pages before the first buffer not freed are dropped.
+'''
+
+page = mmap.PAGESIZE
+data = os.urandom(3*page+100)
+fd, path = tempfile.mkstemp()
+os.write(fd, data)
+os.close(fd)
+
+# Views and tail fallback.
+stream = MappedFileInputStream(path)
+reader = InputStreamReader(stream, buffer_size=2*page)
+head = reader.get()
+assert head.size_class==None and head.buff.ctypes.data==stream.array.ctypes.data
+tail = reader.get()
+assert tail.size_class!=None and tail.length==page+100, tail.length
+assert head.mem.tobytes()+tail.mem[:tail.length].tobytes()==data
+tail.free()
+
+# Writes to a view are copy-on-write.
+head.mem[:] = '\0'*head.size
+assert head.mem.tobytes()=='\0'*head.size
+assert open(path, 'rb').read()==data
+head.free()
+reader.finalize(True)
+
+# Pages are only dropped behind the first buffer still in use.
+stream = MappedFileInputStream(path)
+factory = IOBufferFactory(max_active=4)
+views = [stream.view(factory, page, page) for i in xrange(3)]
+assert stream.dropped==0
+views[1].free()
+stream.drop()
+assert stream.dropped==0, stream.dropped
+views[0].free()
+stream.drop()
+assert stream.dropped==2*page, stream.dropped
+assert views[2].mem.tobytes()==data[2*page:3*page]
+views[2].free()
+stream.drop()
+assert stream.dropped==3*page, stream.dropped
+stream.finalize()
+
+os.unlink(path)
+print 'ok'
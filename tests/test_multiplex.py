@@ -0,0 +1,107 @@
+import sys
+sys.path.append('./lib/')
+import time
+import random
+
+import gevent
+
+from clusterdfs.networking import Server, ServerHandle, Client,\
+                                  MultiplexedConnection
+from clusterdfs.bufferedio import InputStream, IOBuffer
+
+'''
+Streams multiplexed over one connection: a fast stream is not held back by
+a slow consumer, whose sender is throttled by the CREDIT window; CLOSE
+drops the streams, plain connections still work on the same port, and a
+lost connection fails its streams.
+'''
+
+port = 4570
+window = MultiplexedConnection.window = 64*1024
+buffer_size = 16*1024
+
+received = {}
+queued = {}
+
+class Sink(ServerHandle):
+    def process_query(self):
+        name = self.recv()
+        data = []
+        queued[name] = 0
+        for iobuffer in self.recv_reader(buffer_size=buffer_size):
+            data.append(iobuffer.mem[:iobuffer.length].tobytes())
+            iobuffer.free()
+            if name=='slow':
+                gevent.sleep(0.01)
+            if hasattr(self.socket, 'queue'):
+                pending = sum(item.length for item in self.socket.queue.queue
+                              if isinstance(item, IOBuffer))
+                queued[name] = max(queued[name], pending)
+        received[name] = (''.join(data), time.time())
+
+server = Server(Sink, port=port)
+gevent.spawn(server.serve)
+gevent.sleep(0.2)
+
+def send(name, data, multiplexed=True):
+    client = Client('localhost', port, multiplexed=multiplexed)
+    try:
+        client.send(name)
+        client.send(InputStream(len(data)))
+        writer = client.new_writer()
+        for offset in xrange(0, len(data), buffer_size):
+            chunk = data[offset:offset+buffer_size]
+            iobuffer = IOBuffer.pool.acquire(None, len(chunk))
+            iobuffer.mem[:] = chunk
+            iobuffer.length = len(chunk)
+            writer.write(iobuffer)
+        writer.finalize()
+        writer.join()
+        client.assert_ack()
+        return client.socket
+    finally:
+        client.kill()
+
+random.seed(3)
+payloads = {'slow':''.join(chr(random.randrange(256)) for i in xrange(1<<19)),
+            'fast':''.join(chr(random.randrange(256)) for i in xrange(1<<21))}
+slow = gevent.spawn(send, 'slow', payloads['slow'])
+gevent.sleep(0.05)
+fast = gevent.spawn(send, 'fast', payloads['fast'])
+gevent.joinall([slow, fast], raise_error=True)
+
+for name, data in payloads.iteritems():
+    assert received[name][0]==data, name
+assert received['fast'][1]<received['slow'][1], 'fast stream held back'
+# The slow reader never had more than a window (plus a frame) queued.
+assert queued['slow']<=window+buffer_size, queued['slow']
+connection = slow.value.connection
+assert fast.value.connection is connection
+assert len(MultiplexedConnection.connections)==1
+# Both streams were closed by CLOSE frames.
+gevent.sleep(0.1)
+assert not connection.streams, connection.streams
+
+# Plain connections share the port (the handshake is only peeked).
+send('plain', payloads['slow'], multiplexed=False)
+assert received['plain'][0]==payloads['slow']
+
+# A lost connection ends its streams with an error, and the next client
+# opens a new one.
+client = Client('localhost', port, multiplexed=True)
+client.send('lost')
+client.send(InputStream(1<<20))
+waiting = gevent.spawn(client.recv)
+gevent.sleep(0.1)
+connection.socket.close()
+try:
+    waiting.get(timeout=5)
+    assert False, 'the stream survived its connection'
+except (IOError, EnvironmentError):
+    pass
+assert connection.closed
+send('again', payloads['slow'])
+assert received['again'][0]==payloads['slow']
+assert MultiplexedConnection.connections.values()[0] is not connection
+
+print 'ok'
@@ -0,0 +1,52 @@
+import os
+import sys
+sys.path.append('./lib/')
+import math
+import time
+import signal
+import tempfile
+
+from clusterdfs.datanode import DataNodeConfig, DataNode, DataNodeClient
+
+'''
+Isolated DataNode in pre-fork mode: the supervisor must keep serving with
+nothing but its workers to wait for.
+'''
+
+datadir = tempfile.mkdtemp()
+config = DataNodeConfig.from_dict({'datadir':datadir, 'isolated':True,
+                                   'port':4427, 'workers':2})
+
+data = os.urandom(1000003)
+local_path = os.path.join(datadir, '_test_prefork_a')
+with open(local_path, 'wb') as f:
+    f.write(data)
+
+pid = os.fork()
+if pid==0:
+    datanode = DataNode(config)
+    try:
+        datanode.init()
+    finally:
+        os._exit(0)
+
+try:
+    time.sleep(2)
+    client = DataNodeClient('localhost', config.port)
+    client.insert('prefork', local_path)
+
+    k = config.coding_mod.k
+    block_size = int(math.ceil(float(len(data))/k))
+    for i in (0, k-2):
+        part_path = os.path.join(datadir, '_test_prefork_part%d'%i)
+        client = DataNodeClient('localhost', config.port)
+        client.retrieve('prefork_part%d'%i, part_path)
+        expected = data[i*block_size:(i+1)*block_size]
+        assert open(part_path, 'rb').read()==expected, i
+
+    assert os.waitpid(pid, os.WNOHANG)==(0, 0), 'supervisor exited'
+    print 'ok'
+
+finally:
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
@@ -0,0 +1,91 @@
+import os
+import sys
+sys.path.append('./lib/')
+import random
+import tempfile
+
+import gevent
+
+from clusterdfs.datanode import DataNodeConfig, DataNode, DataNodeClient
+from clusterdfs.coding import CodingException
+from clusterdfs import rapidraid
+
+'''
+RapidRAID coefficients and decoding plans. The known coefficients are the
+ones choose_coefficients() finds, and decode any 'failures' lost nodes but
+the unavoidable() sets. A block is encoded, some nodes are lost, and every part is decoded (as a
+pipeline and as a tree) from the chain given by plan_decoding() and compared
+with the original. Sets of undecodable() nodes must be rejected by the
+planner.
+'''
+
+n = rapidraid.n
+k = rapidraid.k
+xis, psis, bf = rapidraid.xis, rapidraid.psis, rapidraid.bf
+
+for (n_, k_, bf_, failures, seed), known in \
+    rapidraid.known_coefficients.items():
+    found = rapidraid.choose_coefficients(n_, k_, bf_, failures, 
+                                          random.Random(seed))
+    assert found==known, (n_, k_, bf_, failures, seed)
+lost = rapidraid.undecodable(n, k, xis, psis, bf, rapidraid.failures)
+assert rapidraid.unavoidable(n, k, rapidraid.failures).issuperset(lost), lost
+
+# Only the names decoding_id() gives are built.
+for name in ('dec_node3_part0_from1-2-3_fanin1', 
+             'dec_node3_part0_from1-2-3_fanin0'):
+    try:
+        rapidraid.operations[name]
+        assert False, name
+    except KeyError:
+        pass
+
+size = 30000
+base = 4530
+
+datadir = tempfile.mkdtemp()
+random.seed(2)
+parts = []
+for i in xrange(k):
+    parts.append(''.join(chr(random.randrange(256)) for j in xrange(size)))
+    with open(os.path.join(datadir, 'blk.part%d'%i), 'wb') as f:
+        f.write(parts[-1])
+
+nodes = [('localhost', base+i) for i in xrange(n)]
+for i in xrange(n):
+    config = DataNodeConfig.from_dict({'datadir':datadir, 'isolated':True,
+                                       'port':base+i})
+    gevent.spawn(DataNode(config).init)
+gevent.sleep(0.3)
+
+DataNodeClient(*nodes[-1]).coding('blk', 'enc_node%d'%(n-1), nodes)
+# The parts of the lost nodes are gone too: only coded blocks are read.
+for i in xrange(k):
+    os.rename(os.path.join(datadir, 'blk.part%d'%i),
+              os.path.join(datadir, 'blk.saved%d'%i))
+
+lost = (3, 7, 15)
+available = [i for i in xrange(n) if i not in lost]
+loads = dict((i, random.randrange(3)) for i in available)
+for fanin in (1, 2):
+    for part in xrange(k):
+        chain = rapidraid.plan_decoding(n, k, xis, psis, part, available,
+                                        loads, bf)
+        assert not set(chain)&set(lost), chain
+        coding_id = rapidraid.decoding_id(part, chain, -1, fanin)
+        DataNodeClient(*nodes[chain[-1]]).coding('blk', coding_id, nodes)
+        path = os.path.join(datadir, 'blk.orig%d'%part)
+        assert open(path, 'rb').read()==parts[part], (fanin, part, chain)
+        os.unlink(path)
+
+for lost in rapidraid.undecodable(n, k, xis, psis, bf)[:3]:
+    available = [i for i in xrange(n) if i not in lost]
+    failed = 0
+    for part in xrange(k):
+        try:
+            rapidraid.plan_decoding(n, k, xis, psis, part, available, {}, bf)
+        except CodingException:
+            failed += 1
+    assert failed, lost
+
+print 'ok'
@@ -45,12 +45,11 @@ try:
     time.sleep(2)
     n = 16
     block_id = 'girl.64mb'
-    nodes = nodes=';'.join(map(str, (('localhost',3900+i) for i in xrange(16))))
+    nodes = [('localhost',3900+i) for i in xrange(16)]
 
     t = time.time()
     client = DataNodeClient('localhost', config.port+15)
-    client.coding(block_id, 'test', nodes)
-    #client.coding(block_id, 'enc_node15', nodes)
+    client.coding(block_id, 'enc_node15', nodes)
     print 'Encoding time: %.2fs'%(time.time()-t)
     '''  
     client = DataNodeClient('localhost', config.port+10)
@@ -0,0 +1,91 @@
+import sys
+sys.path.append('./lib/')
+
+import gevent
+
+from clusterdfs.bufferedio import InputStream, InputStreamReader, ReadAhead,\
+                                  IOBuffer
+
+'''
+ReadAhead: the depth follows the consumer rate times the read time within
+its bounds. Async readers count the bytes queued (the whole read_many()
+batches too), stop reading at the depth and are woken up by the consumer.
+'''
+
+buffer_size = 16*1024
+
+# Depth bounds.
+ahead = ReadAhead(buffer_size, 16*buffer_size)
+assert ahead.depth==buffer_size
+ahead.consumed(buffer_size)
+gevent.sleep(0.01)
+ahead.waiting()
+assert 0<ahead.rate<=buffer_size/0.01, ahead.rate
+rate = ahead.rate
+# Waiting for a buffer is not consumer time.
+gevent.sleep(0.05)
+ahead.waiting()
+assert ahead.rate==rate
+ahead.read(10.0)
+assert ahead.depth==16*buffer_size, ahead.depth
+ahead = ReadAhead(buffer_size, 16*buffer_size)
+ahead.consumed(buffer_size)
+gevent.sleep(0.01)
+ahead.waiting()
+ahead.read(1e-6)
+assert ahead.depth==buffer_size, ahead.depth
+depth = int(ahead.factor*ahead.rate*0.02)
+assert buffer_size<depth<16*buffer_size, depth
+for i in xrange(60):
+    ahead.read(0.02)
+assert abs(ahead.depth-depth)<=1, (ahead.depth, depth)
+
+class CountingInputStream(InputStream):
+    def __init__(self, size):
+        InputStream.__init__(self, size)
+        self.reads = 0
+
+    def read(self, iobuffer, nbytes=None):
+        self.reads += 1
+        iobuffer.length = min(iobuffer.size, nbytes, self.bytes_left)
+        iobuffer.mem[:iobuffer.length] = chr(self.reads%256)*iobuffer.length
+        self.bytes_left -= iobuffer.length
+        return iobuffer.length
+
+class BatchInputStream(CountingInputStream):
+    def read_many(self, iobuffers):
+        return [self.read(iobuffer, iobuffer.size) for iobuffer in iobuffers]
+
+def held(reader):
+    return sum(item.length for item in list(reader.queue.queue)+
+                                       list(reader.pending)
+               if isinstance(item, IOBuffer))
+
+# The reader stops at the depth and the consumer wakes it up.
+stream = CountingInputStream(64*buffer_size)
+reader = InputStreamReader(stream, async=True, buffer_size=buffer_size,
+                           read_ahead=4*buffer_size)
+gevent.sleep(0.05)
+assert stream.reads==1 and reader.queued==buffer_size, stream.reads
+reader.get().free()
+gevent.sleep(0.01)
+assert stream.reads==2, stream.reads
+reader.finalize(True)
+
+# Batches are counted as queued as soon as they are read.
+size = 64*buffer_size+100
+stream = BatchInputStream(size)
+reader = InputStreamReader(stream, async=True, buffer_size=buffer_size,
+                           num_buffers=5, batch=4, read_ahead=8*buffer_size)
+read = peak = 0
+for iobuffer in reader:
+    assert reader.queued==held(reader), (reader.queued, held(reader))
+    assert reader.queued<=reader.read_ahead.depth+4*buffer_size
+    peak = max(peak, reader.queued)
+    read += iobuffer.length
+    iobuffer.free()
+    gevent.sleep(0.001)
+assert read==size and reader.queued==0, (read, reader.queued)
+assert peak>=3*buffer_size, peak
+
+print 'ok'
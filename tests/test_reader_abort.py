@@ -0,0 +1,68 @@
+import os
+import sys
+sys.path.append('./lib/')
+import tempfile
+
+import gevent
+import gevent.event
+
+from clusterdfs.bufferedio import InputStream, FileInputStream,\
+                                  InputStreamReader, IOBufferFactory,\
+                                  ByteBudget
+
+'''
+Readers finalized before their end give their buffers back to the node
+budget: the ones read ahead and queued, the ones of a read_many() batch not
+taken yet, and the one of a read the reader was killed in.
+'''
+
+budget = IOBufferFactory.budget = ByteBudget(1<<20)
+buffer_size = 16*1024
+
+class BlockedInputStream(InputStream):
+    '''Never completes a read.'''
+    def read(self, iobuffer, nbytes=None):
+        gevent.event.Event().wait()
+
+class BatchInputStream(InputStream):
+    def read_many(self, iobuffers):
+        for iobuffer in iobuffers:
+            iobuffer.length = min(iobuffer.size, self.bytes_left)
+            self.bytes_left -= iobuffer.length
+        return [iobuffer.length for iobuffer in iobuffers]
+
+fd, path = tempfile.mkstemp()
+os.write(fd, os.urandom(1<<20))
+os.close(fd)
+
+def aborted(reader, taken=1):
+    for i in xrange(taken):
+        reader.get().free()
+    gevent.sleep(0.05)
+    reader.finalize(True)
+    assert budget.used==0, budget.used
+    assert reader.buffer_fact.bytes.used==0, reader.buffer_fact.bytes.used
+
+# Read ahead and queued.
+reader = InputStreamReader(FileInputStream(path), async=True,
+                           buffer_size=buffer_size, read_ahead=256*1024)
+aborted(reader)
+reader = InputStreamReader(FileInputStream(path), async=True, num_buffers=4,
+                           buffer_size=buffer_size)
+aborted(reader, 0)
+
+# Killed in the middle of a read.
+reader = InputStreamReader(BlockedInputStream(1<<20), async=True,
+                           buffer_size=buffer_size)
+aborted(reader, 0)
+
+# Batches not taken yet, by sync and async readers.
+reader = InputStreamReader(BatchInputStream(1<<20), num_buffers=5, batch=4,
+                           buffer_size=buffer_size)
+aborted(reader)
+reader = InputStreamReader(BatchInputStream(1<<20), async=True,
+                           num_buffers=5, batch=4, buffer_size=buffer_size)
+aborted(reader)
+
+os.unlink(path)
+print 'ok'